@@ -1,16 +1,21 @@
 from typing import Any, Dict, List, Optional
 import os
+import base64
 import hashlib
+import hmac
 import secrets
+import time
 from datetime import datetime, timedelta
 import json
+import asyncio
 import logging
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request, status
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from jose import jwt, JWTError
 from langchain_core.messages import HumanMessage, AIMessage
@@ -22,9 +27,12 @@ from .services import azure_openai as llm
 from .services import langchain_agent
 from .services import tts
 from .services import mms_tts
+from .services.audio_cache import audio_cache, detect_mime_type
 from .services import health_planner
 
 from .services import pinecone_db
+from .services import ingest
+from .services import uploads
 from .models.schema import (
     HealthPlanCreate, HealthPlanUpdate, ActivityLog, MealLog,
     GoalType, PlanStatus, IntensityLevel, MealType, ActivityUpdate
@@ -44,6 +52,15 @@ app = FastAPI(
 
 # CORS cấu hình cho production
 allowed_origins = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "*").split(",") if o.strip()]
+# Từ chối upload quá lớn trước khi body được đọc (base64 lớn hơn dữ liệu gốc khoảng 4/3)
+app.add_middleware(
+    uploads.UploadSizeLimitMiddleware,
+    limits=[
+        (r"^/api/profiles/\d+/documents$", uploads.MAX_DOCUMENT_UPLOAD_BYTES + uploads.MB),
+        (r"^/api/speech/recognize-base64$", uploads.MAX_AUDIO_UPLOAD_BYTES * 4 // 3 + uploads.MB),
+        (r"^/api/speech/recognize$", uploads.MAX_AUDIO_UPLOAD_BYTES + uploads.MB),
+    ],
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
@@ -120,7 +137,9 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Validate JWT and return current user"""
-    token = credentials.credentials
+    return _get_user_from_token(credentials.credentials)
+
+def _get_user_from_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = int(payload.get("sub"))
@@ -172,13 +191,32 @@ def on_startup():
         )
         print("✅ Created default admin: admin@example.com / admin123")
 
+    # Ghi nốt các tin nhắn còn chờ trong outbox Pinecone từ lần chạy trước
+    pinecone_db.chat_memory_writer.start()
+
+    # Xử lý tiếp các tài liệu upload còn chờ từ lần chạy trước
+    ingest.document_ingestion_worker.start()
+
+    # Tải trước model MMS-TTS ở background để user đầu tiên không phải chờ
+    if os.getenv("MMS_TTS_WARMUP", "false").lower() == "true" and mms_tts.is_mms_tts_available():
+        mms_tts.mms_tts_service.start_warmup()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await langchain_agent.close_clients()
+    await run_in_threadpool(pinecone_db.chat_memory_writer.stop)
+    await run_in_threadpool(ingest.document_ingestion_worker.stop)
+    pdfsvc.shutdown_pool()
+    db.close_pool()
+
 
 # (Mount static sẽ thực hiện ở cuối file để không che các API routes)
 
 
 # ====== PUBLIC ENDPOINTS ======
 @app.get("/api/health")
-def health_check():
+async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "version": "2.0.0"}
 
@@ -375,39 +413,49 @@ async def upload_document(
     file: UploadFile = File(...),
     profile=Depends(get_user_profile)
 ):
-    """Upload tài liệu y tế"""
+    """Upload tài liệu y tế (xử lý bất đồng bộ, trả về job ID ngay)"""
 
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Chỉ hỗ trợ file PDF")
 
-    # Read and process PDF
-    content = await file.read()
-
+    # Ghi file ra đĩa theo từng đoạn (kiểm tra header PDF và giới hạn dung lượng trong lúc ghi)
+    worker = ingest.document_ingestion_worker
+    job_id, file_path = worker.prepare_upload()
     try:
-        # Extract text from PDF
-        extracted_text = pdfsvc.extract_text_from_pdf(content)
-
-        # Summarize with AI
-        ai_summary = llm.summarize_medical_document(extracted_text)
-
-        # Save to database
-        doc_id = db.add_document(
-            health_profile_id=profile_id,
-            filename=file.filename,
-            original_content=extracted_text,
-            ai_summary=ai_summary,
-            file_type="pdf",
-            file_size=len(content)
+        file_size, content_hash = await uploads.save_upload(
+            file, file_path, uploads.MAX_DOCUMENT_UPLOAD_BYTES, magic=b"%PDF-"
         )
+    except uploads.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Chỉ hỗ trợ file PDF")
 
-        return {
-            "message": "Upload tài liệu thành công",
-            "document_id": doc_id,
-            "summary": ai_summary
-        }
+    # Trích xuất, tóm tắt và lưu được xử lý ở background; client theo dõi qua job ID
+    try:
+        job_status = await run_in_threadpool(
+            worker.submit, job_id, profile_id, file.filename, file_path, file_size, content_hash
+        )
+    except Exception:
+        ingest.remove_upload_file(file_path)
+        raise
+
+    return JSONResponse(
+        status_code=202,
+        content={
+            "message": "Đã nhận tài liệu, đang xử lý" if job_status == "queued" else "Upload tài liệu thành công",
+            "job_id": job_id,
+            "status": job_status,
+            "status_url": f"/api/profiles/{profile_id}/documents/jobs/{job_id}",
+        },
+    )
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Lỗi xử lý tài liệu: {str(e)}")
+@app.get("/api/profiles/{profile_id}/documents/jobs/{job_id}")
+def get_document_job_status(profile_id: int, job_id: str, profile=Depends(get_user_profile)):
+    """Trạng thái xử lý tài liệu: queued → extracting → summarizing → saving → done / failed"""
+    job = db.get_document_job(job_id, profile_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @app.get("/api/profiles/{profile_id}/documents")
 def list_profile_documents(profile_id: int, profile=Depends(get_user_profile)):
@@ -420,9 +468,9 @@ def get_document_detail(doc_id: int, current_user=Depends(get_current_user)):
     """Lấy chi tiết tài liệu (với ownership check qua profile)"""
     # Complex ownership check through profile
     with db.get_conn() as conn:
-        doc = conn.execute("""
-            SELECT d.*, hp.user_id
-            FROM documents d
+        doc = conn.execute(f"""
+            SELECT {db.DOCUMENT_COLUMNS}, hp.user_id
+            FROM {db.DOCUMENT_FROM}
             JOIN health_profiles hp ON d.health_profile_id = hp.id
             WHERE d.id = ? AND hp.user_id = ?
         """, (doc_id, current_user["id"])).fetchone()
@@ -464,145 +512,215 @@ def get_chat_messages(session_id: int, current_user=Depends(get_current_user)):
     messages = db.list_chat_messages(session_id)
     return messages
 
-@app.post("/api/chats/{session_id}/messages")
-def send_chat_message(session_id: int, data: ChatMessageCreate, current_user=Depends(get_current_user)):
-    """Gửi tin nhắn chat"""
-
-    # Check ownership and get profile info
+def _get_chat_session(session_id: int, user_id: int):
+    """Lấy phiên chat kèm thông tin hồ sơ (với ownership check)"""
     with db.get_conn() as conn:
         session = conn.execute("""
             SELECT cs.*, hp.user_id, hp.conditions_text, hp.conditions_json, hp.weight, hp.height, hp.age, hp.gender
             FROM chat_sessions cs
             JOIN health_profiles hp ON cs.health_profile_id = hp.id
             WHERE cs.id = ? AND hp.user_id = ?
-        """, (session_id, current_user["id"])).fetchone()
+        """, (session_id, user_id)).fetchone()
 
     if not session:
         raise HTTPException(status_code=404, detail="Chat session not found")
+    return session
 
+
+def _get_vector_store():
+    """Lấy vector store Pinecone nếu dịch vụ khả dụng (có thể khởi tạo kết nối nên chạy trong threadpool)"""
+    if pinecone_db.pinecone_service.is_available():
+        return pinecone_db.pinecone_service.get_vector_store()
+    return None
+
+
+async def _prepare_chat_turn(session, data: ChatMessageCreate, user_id: int) -> Dict[str, Any]:
+    """Lưu tin nhắn người dùng và chuẩn bị lịch sử + input cho Agent.
+
+    Truy vấn DB chạy trong threadpool, truy xuất Pinecone dùng API async, nên event loop không bị chặn.
+    """
+    session_id = session["id"]
     # Extract profile_id from session
     profile_id = session["health_profile_id"]
 
+    # Save user message with image data if present
+    message_metadata = {}
+    if data.image_data:
+        message_metadata["has_image"] = True
+        # Store base64 image in metadata for display
+        message_metadata["image_data"] = data.image_data
+
+    # Đánh dấu nếu là voice input
+    if data.auto_play_response:
+        message_metadata["voice_input"] = True
+
+    # Save user message to database
+    message_id = await run_in_threadpool(
+        db.add_chat_message, session_id, "user", data.content, data.message_type, message_metadata
+    )
+
+    # --- TÍCH HỢP LANGCHAIN AGENT VÀ PINECONE ---
+
+    # 1. Lấy dữ liệu hồ sơ cho AI context
+    profile_data = dict(session)
+
+    # 2. Lấy lịch sử chat từ Pinecone (nếu có) và DB
+    chat_history_list = []
+    vector_store = await run_in_threadpool(_get_vector_store)
+    if vector_store:
+        retriever = vector_store.as_retriever(search_kwargs={
+            'k': 5,
+            'filter': {
+                'user_id': user_id,
+                'profile_id': profile_id,
+                'chat_id': session_id
+            }
+        })
+        # Lấy các document liên quan từ Pinecone
+        try:
+            context_docs = await retriever.ainvoke(data.content)
+        except Exception as e:
+            # Kết nối lại ở lượt sau, lượt này chỉ dùng lịch sử từ DB
+            logger.error(f"Pinecone retrieval failed: {e}")
+            # refresh() chờ lock mà _initialize giữ trong lúc gọi mạng, không chạy trên event loop
+            await run_in_threadpool(pinecone_db.pinecone_service.refresh)
+            context_docs = []
+        for doc in context_docs:
+            chat_history_list.append({"role": doc.metadata.get('role', 'user'), "content": doc.page_content})
+
+    # Luôn lấy thêm các tin nhắn gần đây từ DB để đảm bảo luồng hội thoại
+    db_messages = await run_in_threadpool(db.list_chat_messages, session_id, 6)
+    # Tránh thêm trùng lặp
+    seen_contents = {msg['content'] for msg in chat_history_list}
+    for msg in reversed(db_messages):
+        if msg['content'] not in seen_contents:
+            chat_history_list.insert(0, {"role": msg["role"], "content": msg["content"]})
+
+    # 3. Chuyển đổi lịch sử chat sang định dạng của LangChain
+    langchain_chat_history = []
+    for msg in chat_history_list:
+        if msg["role"] == "user":
+            langchain_chat_history.append(HumanMessage(content=msg["content"]))
+        elif msg["role"] == "assistant":
+            langchain_chat_history.append(AIMessage(content=msg["content"]))
+
+    # 4. Chuẩn bị input cho Agent
+    agent_input = {"input": data.content, "chat_history": langchain_chat_history}
+    if data.message_type == "image" and data.image_data:
+        # Vision model support
+        agent_input["input"] = [
+            {"type": "text", "text": data.content or "Hãy phân tích thực phẩm trong ảnh này và tư vấn cho tôi."},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{data.image_data}"}}
+        ]
+
+    return {
+        "session_id": session_id,
+        "profile_id": profile_id,
+        "profile_data": profile_data,
+        "message_id": message_id,
+        "agent_input": agent_input,
+    }
+
+
+# Giữ tham chiếu tới các task chạy nền để không bị garbage collect giữa chừng
+_background_tasks = set()
+
+
+def _spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+
+def _on_background_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()}")
+
+
+async def _finalize_chat_turn(turn: Dict[str, Any], data: ChatMessageCreate, user_id: int, ai_response: str,
+                              synthesize_audio: bool = True) -> Dict[str, Any]:
+    """Lưu phản hồi AI, đồng bộ Pinecone và tạo audio nếu được yêu cầu"""
+    session_id = turn["session_id"]
+    profile_id = turn["profile_id"]
+    message_id = turn["message_id"]
+
+    # Save AI response to database
+    ai_message_id = await run_in_threadpool(db.add_chat_message, session_id, "assistant", ai_response)
+
+    # Đưa tin nhắn vào hàng đợi write-behind để ghi vào Pinecone ở background
+    # (kể cả khi đang mất kết nối: outbox giữ lại và worker sẽ thử ghi lại)
+    if pinecone_db.pinecone_service.is_configured():
+        await run_in_threadpool(
+            pinecone_db.chat_memory_writer.enqueue,
+            texts=[data.content, ai_response],
+            metadatas=[
+                {
+                    "role": "user",
+                    "user_id": user_id,
+                    "profile_id": profile_id,
+                    "chat_id": session_id
+                },
+                {
+                    "role": "assistant",
+                    "user_id": user_id,
+                    "profile_id": profile_id,
+                    "chat_id": session_id
+                }
+            ],
+            ids=[f"msg_{message_id}", f"msg_{ai_message_id}"]
+        )
+        logger.info(f"Queued user and AI messages for Pinecone: msg_{message_id}, msg_{ai_message_id}")
+
+    # Tự động tạo audio nếu được yêu cầu (trả về URL thay vì base64 data URL)
+    audio_url = None
+    if synthesize_audio and data.auto_play_response and tts.is_tts_available():
+        try:
+            result = await run_in_threadpool(tts.generate_audio_bytes, ai_response)
+            if result:
+                audio_url = _audio_url(result[0])
+                logger.info("Auto-generated audio for AI response")
+        except Exception as audio_error:
+            logger.warning(f"Failed to generate auto-play audio: {audio_error}")
+
+    return {
+        "message": "Tin nhắn đã được gửi",
+        "ai_response": ai_response,
+        "auto_play_audio": audio_url
+    }
+
+
+AGENT_FALLBACK_RESPONSE = "Xin lỗi, tôi chưa thể trả lời câu hỏi này."
+AGENT_ERROR_RESPONSE = "Đã có lỗi xảy ra trong quá trình xử lý với AI. Vui lòng thử lại sau."
+
+
+@app.post("/api/chats/{session_id}/messages")
+async def send_chat_message(session_id: int, data: ChatMessageCreate, current_user=Depends(get_current_user)):
+    """Gửi tin nhắn chat"""
+
+    # Check ownership and get profile info
+    session = await run_in_threadpool(_get_chat_session, session_id, current_user["id"])
+
     try:
-        # Save user message with image data if present
-        message_metadata = {}
-        if data.image_data:
-            message_metadata["has_image"] = True
-            # Store base64 image in metadata for display
-            message_metadata["image_data"] = data.image_data
-
-        # Đánh dấu nếu là voice input
-        if data.auto_play_response:
-            message_metadata["voice_input"] = True
-
-        # Save user message to database
-        message_id = db.add_chat_message(session_id, "user", data.content, data.message_type, message_metadata)
-
-        # --- TÍCH HỢP LANGCHAIN AGENT VÀ PINECONE ---
-
-        # 1. Lấy dữ liệu hồ sơ cho AI context
-        profile_data = dict(session)
-
-        # 2. Lấy lịch sử chat từ Pinecone (nếu có) và DB
-        chat_history_list = []
-        if pinecone_db.pinecone_service.is_available():
-            vector_store = pinecone_db.pinecone_service.get_vector_store()
-            if vector_store:
-                retriever = vector_store.as_retriever(search_kwargs={
-                    'k': 5,
-                    'filter': {
-                        'user_id': current_user["id"],
-                        'profile_id': profile_id,
-                        'chat_id': session_id
-                    }
-                })
-                # Lấy các document liên quan từ Pinecone bằng phương thức invoke mới
-                context_docs = retriever.invoke(data.content)
-                for doc in context_docs:
-                    chat_history_list.append({"role": doc.metadata.get('role', 'user'), "content": doc.page_content})
-
-        # Luôn lấy thêm các tin nhắn gần đây từ DB để đảm bảo luồng hội thoại
-        db_messages = db.list_chat_messages(session_id, limit=6)
-        # Tránh thêm trùng lặp
-        seen_contents = {msg['content'] for msg in chat_history_list}
-        for msg in reversed(db_messages):
-            if msg['content'] not in seen_contents:
-                chat_history_list.insert(0, {"role": msg["role"], "content": msg["content"]})
-
-        # 3. Chuyển đổi lịch sử chat sang định dạng của LangChain
-        langchain_chat_history = []
-        for msg in chat_history_list:
-            if msg["role"] == "user":
-                langchain_chat_history.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "assistant":
-                langchain_chat_history.append(AIMessage(content=msg["content"]))
-
-        # 4. Tạo Agent Executor
+        turn = await _prepare_chat_turn(session, data, current_user["id"])
+
+        # Tạo Agent Executor
         agent_executor = langchain_agent.create_chatbot_agent(
             user_id=current_user["id"],
-            profile_id=profile_id,
-            session_data=profile_data
+            profile_id=turn["profile_id"],
+            session_data=turn["profile_data"]
         )
 
-        # 5. Chuẩn bị input cho Agent
-        agent_input = {"input": data.content, "chat_history": langchain_chat_history}
-        if data.message_type == "image" and data.image_data:
-            # Vision model support
-            agent_input["input"] = [
-                {"type": "text", "text": data.content or "Hãy phân tích thực phẩm trong ảnh này và tư vấn cho tôi."},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{data.image_data}"}}
-            ]
-
-        # 5. Gọi Agent để lấy phản hồi
+        # Gọi Agent để lấy phản hồi
         try:
-            response = agent_executor.invoke(agent_input)
-            ai_response = response.get("output", "Xin lỗi, tôi chưa thể trả lời câu hỏi này.")
+            response = await agent_executor.ainvoke(turn["agent_input"])
+            ai_response = response.get("output", AGENT_FALLBACK_RESPONSE)
         except Exception as e:
             logger.error(f"LangChain agent invocation error: {e}")
-            ai_response = "Đã có lỗi xảy ra trong quá trình xử lý với AI. Vui lòng thử lại sau."
-
-        # Save AI response to database
-        ai_message_id = db.add_chat_message(session_id, "assistant", ai_response)
-
-        # Save user and AI messages to Pinecone for future context
-        if pinecone_db.pinecone_service.is_available():
-            vector_store = pinecone_db.pinecone_service.get_vector_store()
-            if vector_store:
-                vector_store.add_texts(
-                    texts=[data.content, ai_response],
-                    metadatas=[
-                        {
-                            "role": "user",
-                            "user_id": current_user["id"],
-                            "profile_id": profile_id,
-                            "chat_id": session_id
-                        },
-                        {
-                            "role": "assistant",
-                            "user_id": current_user["id"],
-                            "profile_id": profile_id,
-                            "chat_id": session_id
-                        }
-                    ],
-                    ids=[f"msg_{message_id}", f"msg_{ai_message_id}"]
-                )
-                logger.info(f"Added user and AI messages to Pinecone: msg_{message_id}, msg_{ai_message_id}")
-
-        # Tự động tạo audio nếu được yêu cầu
-        audio_data_url = None
-        if data.auto_play_response and tts.is_tts_available():
-            try:
-                audio_data_url = tts.generate_audio(ai_response)
-                if audio_data_url:
-                    logger.info("Auto-generated audio for AI response")
-            except Exception as audio_error:
-                logger.warning(f"Failed to generate auto-play audio: {audio_error}")
+            ai_response = AGENT_ERROR_RESPONSE
 
-        return {
-            "message": "Tin nhắn đã được gửi",
-            "ai_response": ai_response,
-            "auto_play_audio": audio_data_url
-        }
+        return await _finalize_chat_turn(turn, data, current_user["id"], ai_response)
 
     except Exception as e:
         import traceback
@@ -611,9 +729,106 @@ def send_chat_message(session_id: int, data: ChatMessageCreate, current_user=Dep
         raise HTTPException(status_code=500, detail=f"Lỗi xử lý chat: {str(e)}")
 
 
+def _sse(event: str, payload: Dict[str, Any]) -> str:
+    """Định dạng một sự kiện Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/chats/{session_id}/messages/stream")
+async def stream_chat_message(session_id: int, data: ChatMessageCreate, current_user=Depends(get_current_user)):
+    """Gửi tin nhắn chat và nhận phản hồi dạng stream (Server-Sent Events).
+
+    Sự kiện: ``token`` (từng đoạn văn bản, kèm ``run_id`` của lượt gọi model), ``discard`` (lượt gọi model
+    đó hóa ra là bước gọi tool: client bỏ các token của ``run_id`` này), ``tool_start``/``tool_end``
+    (tiến trình gọi tool), ``error`` và cuối cùng ``done`` với payload giống
+    ``POST /api/chats/{session_id}/messages``.
+    """
+    user_id = current_user["id"]
+    session = await run_in_threadpool(_get_chat_session, session_id, user_id)
+
+    try:
+        turn = await _prepare_chat_turn(session, data, user_id)
+        agent_executor = langchain_agent.create_chatbot_agent(
+            user_id=user_id,
+            profile_id=turn["profile_id"],
+            session_data=turn["profile_data"],
+            streaming=True
+        )
+    except Exception as e:
+        logger.error(f"Error preparing streamed chat: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Lỗi xử lý chat: {str(e)}")
+
+    async def event_stream():
+        # Token theo từng lượt gọi model; chỉ lượt không gọi tool mới là câu trả lời cuối
+        run_tokens: Dict[str, List[str]] = {}
+        answer_tokens: List[str] = []
+        ai_response: Optional[str] = None
+        finalize_task: Optional[asyncio.Task] = None
+        try:
+            try:
+                async for event in agent_executor.astream_events(turn["agent_input"], version="v2"):
+                    kind = event["event"]
+                    if kind == "on_chat_model_stream":
+                        chunk = event["data"]["chunk"]
+                        if getattr(chunk, "tool_call_chunks", None):
+                            continue
+                        content = chunk.content
+                        if content and isinstance(content, str):
+                            run_tokens.setdefault(event["run_id"], []).append(content)
+                            yield _sse("token", {"content": content, "run_id": event["run_id"]})
+                    elif kind == "on_chat_model_end":
+                        run_output = run_tokens.pop(event["run_id"], [])
+                        message = event["data"].get("output")
+                        if getattr(message, "tool_calls", None):
+                            # Văn bản của lượt gọi tool không phải câu trả lời: báo client xóa khỏi màn hình
+                            if run_output:
+                                yield _sse("discard", {"run_id": event["run_id"]})
+                        elif run_output:
+                            answer_tokens = run_output
+                    elif kind == "on_tool_start":
+                        yield _sse("tool_start", {"tool": event["name"]})
+                    elif kind == "on_tool_end":
+                        yield _sse("tool_end", {"tool": event["name"]})
+                    elif kind == "on_chain_end" and event["name"] == "AgentExecutor":
+                        output = event["data"].get("output")
+                        if isinstance(output, dict):
+                            ai_response = output.get("output")
+            except Exception as e:
+                logger.error(f"LangChain agent streaming error: {e}")
+                ai_response = AGENT_ERROR_RESPONSE
+                yield _sse("error", {"detail": ai_response})
+
+            if not ai_response:
+                ai_response = "".join(answer_tokens) or AGENT_FALLBACK_RESPONSE
+
+            # Chạy trong task riêng để client ngắt kết nối lúc này cũng không làm mất phản hồi đã lưu dở
+            finalize_task = _spawn_background(_finalize_chat_turn(turn, data, user_id, ai_response))
+            try:
+                result = await asyncio.shield(finalize_task)
+            except Exception as e:
+                logger.error(f"Error finalizing streamed chat: {str(e)}")
+                yield _sse("error", {"detail": f"Lỗi xử lý chat: {str(e)}"})
+                return
+            yield _sse("done", result)
+        finally:
+            if finalize_task is None:
+                # Client ngắt kết nối giữa chừng: vẫn lưu phần trả lời đã nhận để phiên chat không thiếu lượt trả lời
+                partial = "".join(answer_tokens or [t for tokens in run_tokens.values() for t in tokens])
+                logger.info(f"Chat stream for session {session_id} closed early, saving partial response")
+                _spawn_background(_finalize_chat_turn(
+                    turn, data, user_id, partial or AGENT_FALLBACK_RESPONSE, synthesize_audio=False
+                ))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 # ====== TEXT-TO-SPEECH ======
 class TTSRequest(BaseModel):
-    text: str = Field(..., max_length=1000, description="Text to convert to speech")
+    text: str = Field(..., max_length=20000, description="Text to convert to speech")
 
 @app.post("/api/tts/generate")
 def generate_tts_audio(data: TTSRequest, current_user=Depends(get_current_user)):
@@ -630,9 +845,9 @@ def generate_tts_audio(data: TTSRequest, current_user=Depends(get_current_user))
 
     try:
         # Sinh audio từ text
-        audio_data_url = tts.generate_audio(data.text)
+        result = tts.generate_audio_bytes(data.text)
 
-        if audio_data_url is None:
+        if result is None:
             raise HTTPException(
                 status_code=500,
                 detail="Không thể tạo audio. Vui lòng thử lại với text khác."
@@ -640,7 +855,9 @@ def generate_tts_audio(data: TTSRequest, current_user=Depends(get_current_user))
 
         return {
             "success": True,
-            "audio_data_url": audio_data_url,
+            "audio_id": result[0],
+            "audio_url": _audio_url(result[0]),
+            "audio_data_url": _audio_data_url(result[1]),
             "text": data.text[:100] + "..." if len(data.text) > 100 else data.text
         }
 
@@ -650,6 +867,142 @@ def generate_tts_audio(data: TTSRequest, current_user=Depends(get_current_user))
             detail=f"Lỗi tạo audio: {str(e)}"
         )
 
+# Audio được định danh bằng hash nội dung nên không bao giờ thay đổi, cho phép cache lâu dài
+AUDIO_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+# Thời hạn của link audio có chữ ký (thẻ <audio> không gửi được header Authorization)
+AUDIO_URL_TTL_SECONDS = int(os.getenv("AUDIO_URL_TTL_SECONDS", "3600"))
+
+
+def _audio_signature(audio_id: str, expires: int) -> str:
+    message = f"{audio_id}:{expires}".encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+
+def _audio_url(audio_id: str) -> str:
+    """Link audio có chữ ký HMAC và hạn dùng, chỉ người nhận được link mới tải được"""
+    expires = int(time.time()) + AUDIO_URL_TTL_SECONDS
+    return f"/api/audio/{audio_id}?expires={expires}&sig={_audio_signature(audio_id, expires)}"
+
+
+def _audio_data_url(audio: bytes) -> str:
+    return f"data:{detect_mime_type(audio)};base64,{base64.b64encode(audio).decode('ascii')}"
+
+
+def _audio_response(request: Request, audio: bytes, audio_id: str) -> Response:
+    """Trả về audio dạng binary, hỗ trợ Range (seek trong thẻ <audio>) và ETag"""
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Cache-Control": AUDIO_CACHE_CONTROL,
+        "ETag": f'"{audio_id}"',
+        "X-Audio-Id": audio_id,
+        "Content-Location": _audio_url(audio_id),
+    }
+    media_type = detect_mime_type(audio)
+
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if not range_header:
+        return Response(content=audio, media_type=media_type, headers=headers)
+
+    total = len(audio)
+    try:
+        unit, _, spec = range_header.partition("=")
+        start_text, _, end_text = spec.split(",")[0].strip().partition("-")
+        if unit.strip() != "bytes":
+            raise ValueError(unit)
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else total - 1
+        else:
+            # bytes=-N: N byte cuối
+            start = max(total - int(end_text), 0)
+            end = total - 1
+        end = min(end, total - 1)
+        if start > end:
+            raise ValueError(range_header)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{total}"})
+
+    headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    return Response(content=audio[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+@app.get("/api/audio/{audio_id}")
+async def get_audio(audio_id: str, request: Request, expires: int = 0, sig: str = ""):
+    """Lấy audio đã tổng hợp theo ID.
+
+    Không dùng token để làm src trực tiếp cho thẻ <audio>; thay vào đó link phải có chữ ký
+    (expires, sig) do server cấp kèm audio_url và còn hạn.
+    """
+    if expires < time.time() or not hmac.compare_digest(sig.encode(), _audio_signature(audio_id, expires).encode()):
+        raise HTTPException(status_code=403, detail="Link audio không hợp lệ hoặc đã hết hạn")
+    if len(audio_id) != 64 or any(c not in "0123456789abcdef" for c in audio_id):
+        raise HTTPException(status_code=404, detail="Audio not found")
+    audio = await run_in_threadpool(audio_cache.get, audio_id)
+    if audio is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    return _audio_response(request, audio, audio_id)
+
+@app.post("/api/tts/audio")
+async def generate_tts_audio_binary(data: TTSRequest, request: Request, current_user=Depends(get_current_user)):
+    """Như /api/tts/generate nhưng trả về MP3 trực tiếp thay vì JSON"""
+    if not tts.is_tts_available():
+        raise HTTPException(
+            status_code=503,
+            detail="Azure Speech Service chưa được cấu hình. Vui lòng thiết lập AZURE_SPEECH_KEY và cài đặt azure-cognitiveservices-speech"
+        )
+
+    if not data.text or not data.text.strip():
+        raise HTTPException(status_code=400, detail="Text không được để trống")
+
+    result = await run_in_threadpool(tts.generate_audio_bytes, data.text)
+    if result is None:
+        raise HTTPException(status_code=500, detail="Không thể tạo audio. Vui lòng thử lại với text khác.")
+    return _audio_response(request, result[1], result[0])
+
+async def _stream_audio_response(chunks, media_type: str) -> StreamingResponse:
+    """Chờ câu đầu tiên tổng hợp xong (để lỗi trả về đúng status code) rồi stream phần còn lại"""
+    try:
+        first_chunk = await run_in_threadpool(next, chunks, None)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi tạo audio: {str(e)}")
+    if first_chunk is None:
+        raise HTTPException(status_code=400, detail="Text không được để trống")
+
+    async def body():
+        try:
+            yield first_chunk
+            while True:
+                # Không bị hủy giữa chừng: khi client ngắt kết nối vẫn chờ thread trả về rồi mới thoát
+                chunk = await run_in_threadpool(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        except Exception as e:
+            logger.error(f"Audio stream interrupted: {e}")
+        finally:
+            # Đóng generator ngay (kể cả khi client ngắt kết nối) để hủy các câu chưa tổng hợp
+            chunks.close()
+
+    return StreamingResponse(body(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+@app.post("/api/tts/stream")
+async def stream_tts_audio(data: TTSRequest, current_user=Depends(get_current_user)):
+    """Stream MP3 theo từng câu (Azure Speech), phát được ngay khi câu đầu tiên sẵn sàng"""
+    if not tts.is_tts_available():
+        raise HTTPException(
+            status_code=503,
+            detail="Azure Speech Service chưa được cấu hình. Vui lòng thiết lập AZURE_SPEECH_KEY và cài đặt azure-cognitiveservices-speech"
+        )
+
+    if not data.text or not data.text.strip():
+        raise HTTPException(status_code=400, detail="Text không được để trống")
+
+    return await _stream_audio_response(tts.stream_audio(data.text), "audio/mpeg")
+
 @app.post("/api/speech/recognize")
 async def recognize_speech_audio(
     audio_file: UploadFile = File(...),
@@ -667,12 +1020,16 @@ async def recognize_speech_audio(
     if not audio_file.content_type or not audio_file.content_type.startswith('audio/'):
         raise HTTPException(status_code=400, detail="File phải là định dạng audio")
 
-    try:
-        # Đọc audio data
-        audio_data = await audio_file.read()
+    # Starlette đã spool file upload ra đĩa; SDK đọc trực tiếp từ file thay vì một bản copy bytes
+    if uploads.spooled_upload_size(audio_file) > uploads.MAX_AUDIO_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File vượt quá giới hạn {uploads.MAX_AUDIO_UPLOAD_BYTES // uploads.MB} MB"
+        )
 
+    try:
         # Nhận diện giọng nói
-        recognized_text = tts.recognize_speech(audio_data)
+        recognized_text = await run_in_threadpool(tts.recognize_speech, audio_file.file)
 
         if recognized_text:
             return {
@@ -725,9 +1082,9 @@ def generate_mms_tts_audio(data: TTSRequest, current_user=Depends(get_current_us
 
     try:
         # Sinh audio từ text
-        audio_data_url = mms_tts.generate_audio_mms(data.text)
+        result = mms_tts.generate_audio_bytes_mms(data.text)
 
-        if audio_data_url is None:
+        if result is None:
             raise HTTPException(
                 status_code=500,
                 detail="Không thể tạo audio. Vui lòng thử lại với text khác."
@@ -735,7 +1092,9 @@ def generate_mms_tts_audio(data: TTSRequest, current_user=Depends(get_current_us
 
         return {
             "success": True,
-            "audio_data_url": audio_data_url,
+            "audio_id": result[0],
+            "audio_url": _audio_url(result[0]),
+            "audio_data_url": _audio_data_url(result[1]),
             "text": data.text[:100] + "..." if len(data.text) > 100 else data.text,
             "service": "Facebook MMS-TTS-VIE"
         }
@@ -746,11 +1105,50 @@ def generate_mms_tts_audio(data: TTSRequest, current_user=Depends(get_current_us
             detail=f"Lỗi tạo audio: {str(e)}"
         )
 
+@app.post("/api/mms-tts/audio")
+async def generate_mms_tts_audio_binary(data: TTSRequest, request: Request, current_user=Depends(get_current_user)):
+    """Như /api/mms-tts/generate nhưng trả về audio trực tiếp thay vì JSON"""
+    if not mms_tts.is_mms_tts_available():
+        raise HTTPException(
+            status_code=503,
+            detail="Facebook MMS-TTS-VIE chưa được cấu hình. Vui lòng cài đặt transformers, torch, torchaudio"
+        )
+
+    if not data.text or not data.text.strip():
+        raise HTTPException(status_code=400, detail="Text không được để trống")
+
+    result = await run_in_threadpool(mms_tts.generate_audio_bytes_mms, data.text)
+    if result is None:
+        raise HTTPException(status_code=500, detail="Không thể tạo audio. Vui lòng thử lại với text khác.")
+    return _audio_response(request, result[1], result[0])
+
+@app.post("/api/mms-tts/stream")
+async def stream_mms_tts_audio(data: TTSRequest, current_user=Depends(get_current_user)):
+    """Stream WAV theo từng câu (MMS-TTS-VIE), phát được ngay khi câu đầu tiên sẵn sàng"""
+    if not mms_tts.is_mms_tts_available():
+        raise HTTPException(
+            status_code=503,
+            detail="Facebook MMS-TTS-VIE chưa được cấu hình. Vui lòng cài đặt transformers, torch, torchaudio"
+        )
+
+    if not data.text or not data.text.strip():
+        raise HTTPException(status_code=400, detail="Text không được để trống")
+
+    return await _stream_audio_response(mms_tts.stream_audio_mms(data.text), "audio/wav")
+
+@app.get("/api/mms-tts/ready")
+async def get_mms_tts_readiness():
+    """Readiness probe cho MMS-TTS: 200 khi model đã tải và chạy thử xong, 503 nếu chưa"""
+    status_data = mms_tts.mms_tts_service.get_status()
+    return JSONResponse(status_data, status_code=200 if status_data["ready"] else 503)
+
 @app.get("/api/mms-tts/status")
 def get_mms_tts_status(current_user=Depends(get_current_user)):
     """Kiểm tra trạng thái của Facebook MMS-TTS-VIE"""
     return {
         "available": mms_tts.is_mms_tts_available(),
+        "ready": mms_tts.mms_tts_service.is_ready(),
+        "state": mms_tts.mms_tts_service.state,
         "service": "Facebook MMS-TTS-VIE",
         "model_id": "facebook/mms-tts-vie",
         "supported_language": "Vietnamese",
@@ -758,8 +1156,8 @@ def get_mms_tts_status(current_user=Depends(get_current_user)):
             "text_to_speech": True,
             "speech_to_text": False
         },
-        "format": "WAV",
-        "sample_rate": 24000,
+        "format": mms_tts.mms_tts_service.audio_format.upper(),
+        "sample_rate": mms_tts.mms_tts_service.sample_rate,
         "model_info": mms_tts.mms_tts_service.get_model_info() if mms_tts.is_mms_tts_available() else None
     }
 
@@ -805,16 +1203,20 @@ async def recognize_speech_base64(
             detail="Azure Speech Service chưa được cấu hình. Vui lòng thiết lập AZURE_SPEECH_KEY"
         )
 
-    audio_data = request.audio_data
-    mime_type = request.mime_type
-
+    # Giải mã base64 theo từng đoạn vào file tạm thay vì tạo thêm một bản copy bytes lớn
     try:
-        # Decode base64 to bytes
-        import base64
-        audio_bytes = base64.b64decode(audio_data)
+        audio = await run_in_threadpool(
+            uploads.decode_base64_to_file, request.audio_data, uploads.MAX_AUDIO_UPLOAD_BYTES
+        )
+    except uploads.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dữ liệu base64 không hợp lệ")
 
+    try:
         # Nhận diện giọng nói
-        recognized_text = tts.recognize_speech(audio_bytes)
+        with audio:
+            recognized_text = await run_in_threadpool(tts.recognize_speech, audio)
 
         if recognized_text:
             return {
@@ -835,6 +1237,77 @@ async def recognize_speech_base64(
             detail=f"Lỗi nhận diện giọng nói: {str(e)}"
         )
 
+@app.websocket("/api/speech/stream")
+async def stream_speech_recognition(websocket: WebSocket):
+    """Nhận diện giọng nói theo thời gian thực qua WebSocket.
+
+    Query: ``token`` (JWT, vì trình duyệt không gửi được header Authorization cho WebSocket) và
+    ``format`` (pcm = PCM16 16kHz mono, ogg = Ogg/Opus, webm). Client gửi audio dạng binary frame,
+    gửi text ``{"type": "stop"}`` khi nói xong; server trả về JSON ``partial``/``final``/``error``/``end``.
+    """
+    try:
+        # Tra cứu user chạm SQLite, không chạy trên event loop
+        await run_in_threadpool(_get_user_from_token, websocket.query_params.get("token", ""))
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+
+    audio_format = websocket.query_params.get("format", "pcm")
+    if not tts.is_speech_available() or audio_format not in tts.StreamingRecognitionSession.SUPPORTED_FORMATS:
+        await websocket.close(code=4400 if tts.is_speech_available() else 4503)
+        return
+
+    await websocket.accept()
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def on_event(event: Dict[str, Any]) -> None:
+        # Được gọi từ thread của Speech SDK
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    try:
+        session = await run_in_threadpool(tts.azure_speech_service.create_recognition_session, on_event, audio_format)
+        await run_in_threadpool(session.start)
+    except Exception as e:
+        logger.error(f"Failed to start streaming recognition: {e}")
+        await websocket.send_json({"type": "error", "error": str(e)})
+        await websocket.close()
+        return
+
+    async def forward_events():
+        while True:
+            event = await events.get()
+            await websocket.send_json(event)
+            if event["type"] == "end":
+                return
+
+    sender = asyncio.create_task(forward_events())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes"):
+                session.write(message["bytes"])
+            elif message.get("text"):
+                try:
+                    command = json.loads(message["text"])
+                except ValueError:
+                    command = {}
+                if command.get("type") == "stop":
+                    break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await run_in_threadpool(session.stop)
+
+    # Chờ kết quả cuối cùng sau khi đóng stream rồi mới đóng kết nối
+    try:
+        await asyncio.wait_for(sender, timeout=10)
+        await websocket.close()
+    except Exception:
+        sender.cancel()
+
 # Backward compatibility
 @app.get("/api/tts/status")
 def get_tts_status(current_user=Depends(get_current_user)):
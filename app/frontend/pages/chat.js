@@ -260,6 +260,42 @@ function formatMessageContent(content) {
 // Biến global để quản lý audio
 let currentAudio = null;
 let currentTTSButton = null;
+const ttsFallbacks = new WeakMap();
+
+// Tạo audio phát từ audio_url. Link có thể không dùng được nữa (audio đã bị xóa khỏi cache → 404,
+// link hết hạn → 403): khi đó lấy lại audio một lần qua resynthesize() (trả về data URL) rồi phát tiếp
+function createTTSAudio(url, resynthesize) {
+    const audio = new Audio(url);
+    // Đăng ký trước các listener 'error' khác để lỗi của link cũ không làm reset trạng thái nút
+    audio.addEventListener('error', (e) => {
+        if (ttsFallbacks.has(audio) || audio.src.startsWith('data:')) return;
+        e.stopImmediatePropagation();
+        const fallback = Promise.resolve()
+            .then(resynthesize)
+            .then((dataUrl) => {
+                if (!dataUrl) throw new Error('Không thể tạo lại audio');
+                audio.src = dataUrl;
+                return audio.play();
+            })
+            .catch((error) => {
+                audio.dispatchEvent(new Event('error'));
+                throw error;
+            });
+        ttsFallbacks.set(audio, fallback);
+    });
+    return audio;
+}
+
+async function playTTSAudio(audio) {
+    try {
+        await audio.play();
+    } catch (error) {
+        // play() bị từ chối vì link lỗi: chờ bản tạo lại (sự kiện 'error' luôn đến trước)
+        const fallback = ttsFallbacks.get(audio);
+        if (!fallback) throw error;
+        await fallback;
+    }
+}
 
 // Biến global để quản lý voice chat - Press & Hold mode
 let isRecording = false;
@@ -314,13 +350,13 @@ async function playTextAsAudio(text, event) {
             noLoading: true  // Không hiển thị loading global
         });
 
-        if (response.success && response.audio_data_url) {
+        if (response.success && response.audio_url) {
             // Hiển thị trạng thái đang tải audio
             button.innerHTML = '<i class="fas fa-download fa-pulse"></i>';
             button.title = 'Đang tải âm thanh...';
 
             // Tạo audio element
-            currentAudio = new Audio(response.audio_data_url);
+            currentAudio = createTTSAudio(response.audio_url, () => response.audio_data_url);
             currentTTSButton = button;
 
             // Sự kiện khi audio sẵn sàng phát
@@ -356,7 +392,7 @@ async function playTextAsAudio(text, event) {
 
             // Bắt đầu phát audio
             try {
-                await currentAudio.play();
+                await playTTSAudio(currentAudio);
                 button.disabled = false;  // Cho phép click để dừng
             } catch (playError) {
                 throw new Error('Không thể phát audio: ' + playError.message);
@@ -439,13 +475,13 @@ async function playTextAsAudioMMS(text, event) {
             noLoading: true  // Không hiển thị loading global
         });
 
-        if (response.success && response.audio_data_url) {
+        if (response.success && response.audio_url) {
             // Hiển thị trạng thái đang tải audio
             button.innerHTML = '<i class="fas fa-download fa-pulse"></i>';
             button.title = 'Đang tải âm thanh...';
 
             // Tạo audio element
-            currentAudio = new Audio(response.audio_data_url);
+            currentAudio = createTTSAudio(response.audio_url, () => response.audio_data_url);
             currentTTSButton = button;
 
             // Sự kiện khi audio sẵn sàng phát
@@ -481,7 +517,7 @@ async function playTextAsAudioMMS(text, event) {
 
             // Bắt đầu phát audio
             try {
-                await currentAudio.play();
+                await playTTSAudio(currentAudio);
                 button.disabled = false;  // Cho phép click để dừng
             } catch (playError) {
                 throw new Error('Không thể phát audio: ' + playError.message);
@@ -1087,7 +1123,14 @@ async function handleVoiceResult(result, messagesContainer, typingIndicator) {
                 try {
                     typingIndicator.innerHTML = '<small><i class="fas fa-volume-up fa-pulse"></i> Đang phát âm thanh...</small>';
                     
-                    const autoAudio = new Audio(chatResponse.auto_play_audio);
+                    const autoAudio = createTTSAudio(chatResponse.auto_play_audio, async () => {
+                        const regenerated = await api('/api/tts/generate', {
+                            method: 'POST',
+                            body: JSON.stringify({ text: chatResponse.ai_response }),
+                            noLoading: true
+                        });
+                        return regenerated.audio_data_url;
+                    });
                     
                     autoAudio.onended = () => {
                         typingIndicator.style.display = 'none';
@@ -1097,7 +1140,7 @@ async function handleVoiceResult(result, messagesContainer, typingIndicator) {
                         typingIndicator.style.display = 'none';
                     };
                     
-                    await autoAudio.play();
+                    await playTTSAudio(autoAudio);
                 } catch (playError) {
                     console.warn('Auto-play failed:', playError);
                     typingIndicator.style.display = 'none';
@@ -1273,6 +1316,57 @@ function removeSelectedImage() {
     resizeChatLayout();
 }
 
+// Gửi tin nhắn qua endpoint SSE, trả về payload của sự kiện "done"
+async function streamChatMessage(sessionId, requestData, handlers = {}) {
+    const token = localStorage.getItem('auth_token');
+    const response = await fetch(`/api/chats/${sessionId}/messages/stream`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            ...(token ? { Authorization: `Bearer ${token}` } : {})
+        },
+        body: JSON.stringify(requestData)
+    });
+    if (!response.ok || !response.body) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = 'message';
+            let dataLines = [];
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+            });
+            if (!dataLines.length) continue;
+            const payload = JSON.parse(dataLines.join('\n'));
+
+            if (eventName === 'token' && handlers.onToken) handlers.onToken(payload.content, payload.run_id);
+            else if (eventName === 'discard' && handlers.onDiscard) handlers.onDiscard(payload.run_id);
+            else if (eventName === 'tool_start' && handlers.onTool) handlers.onTool(payload.tool);
+            else if (eventName === 'done') result = payload;
+            else if (eventName === 'error') console.warn('Chat stream error:', payload.detail);
+        }
+    }
+
+    if (!result) throw new Error('Kết nối bị gián đoạn trước khi nhận được phản hồi');
+    return result;
+}
+
 async function sendMessage() {
     const chatInput = document.getElementById('chat-input');
     const sendButton = document.getElementById('send-button');
@@ -1309,18 +1403,47 @@ async function sendMessage() {
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
 
         // Prepare request
-        const { api } = window.__APP__;
         const requestData = { content: message, message_type: userMessage.message_type };
         if (userMessage.message_type === 'image') requestData.image_data = userMessage.metadata.image_data;
 
         // Clear selected image after sending (UI)
         if (selectedImageData) removeSelectedImage();
 
-        // Send to API
-        const response = await api(`/api/chats/${currentSessionId}/messages`, {
-            method: 'POST',
-            body: JSON.stringify(requestData),
-            noLoading: true
+        // Send to API (stream từng token để hiển thị ngay khi có)
+        let streamingEl = null;
+        // Văn bản theo từng lượt gọi model; lượt hóa ra là bước gọi tool sẽ bị server yêu cầu bỏ (discard)
+        const runTexts = new Map();
+        const renderStreamed = () => {
+            const streamedText = Array.from(runTexts.values()).join('');
+            if (!streamedText) {
+                if (streamingEl) {
+                    streamingEl.remove();
+                    streamingEl = null;
+                    typingIndicator.style.display = 'block';
+                }
+                return;
+            }
+            if (!streamingEl) {
+                typingIndicator.style.display = 'none';
+                streamingEl = createMessageElement({ role: 'assistant', content: streamedText, message_type: 'text' });
+                messagesContainer.appendChild(streamingEl);
+            }
+            const textEl = streamingEl.querySelector('.chat-text');
+            if (textEl) textEl.innerHTML = formatMessageContent(streamedText);
+            messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        };
+        const response = await streamChatMessage(currentSessionId, requestData, {
+            onToken: (content, runId) => {
+                runTexts.set(runId, (runTexts.get(runId) || '') + content);
+                renderStreamed();
+            },
+            onDiscard: (runId) => {
+                runTexts.delete(runId);
+                renderStreamed();
+            },
+            onTool: (tool) => {
+                typingIndicator.innerHTML = `<small><i class="fas fa-circle-notch fa-spin"></i> Trợ lý đang xử lý (${tool})...</small>`;
+            }
         });
 
         // AI response
@@ -1331,7 +1454,11 @@ async function sendMessage() {
             timestamp: new Date().toISOString()
         };
         const aiMessageEl = createMessageElement(aiMessage);
-        messagesContainer.appendChild(aiMessageEl);
+        if (streamingEl) {
+            messagesContainer.replaceChild(aiMessageEl, streamingEl);
+        } else {
+            messagesContainer.appendChild(aiMessageEl);
+        }
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
 
         chatMessages.push(userMessage, aiMessage);
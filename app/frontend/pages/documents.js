@@ -153,18 +153,42 @@ async function handleUpload() {
     const formData = new FormData(form);
     
     try {
-        await apiForm(`/profiles/${profile.id}/documents`, formData);
+        const job = await apiForm(`/profiles/${profile.id}/documents`, formData);
         
         $('#modal-container').classList.add('hidden');
-        showToast('Upload tài liệu thành công!');
+        showToast('Đã upload, AI đang phân tích tài liệu...');
         
-        // Reload documents
-        renderDocuments();
+        waitForDocumentJob(profile.id, job.job_id);
     } catch (error) {
         // Error already handled by apiForm
     }
 }
 
+async function waitForDocumentJob(profileId, jobId) {
+    const { api, showToast } = window.__APP__;
+    
+    // Hỏi trạng thái job định kỳ tới khi xử lý xong hoặc lỗi
+    while (true) {
+        let job;
+        try {
+            job = await api(`/profiles/${profileId}/documents/jobs/${jobId}`);
+        } catch (error) {
+            return;
+        }
+        
+        if (job.status === 'done') {
+            showToast('Upload tài liệu thành công!');
+            renderDocuments();
+            return;
+        }
+        if (job.status === 'failed') {
+            showToast(`Lỗi xử lý tài liệu: ${job.error || ''}`, 'error');
+            return;
+        }
+        await new Promise(resolve => setTimeout(resolve, 2000));
+    }
+}
+
 // Global functions
 window.showUploadModal = showUploadModal;
 window.handleUpload = handleUpload;
\ No newline at end of file
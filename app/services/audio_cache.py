@@ -0,0 +1,162 @@
+"""
+Content-addressed cache cho audio TTS (dùng chung cho Azure và MMS-TTS)
+"""
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger("audio_cache")
+
+DEFAULT_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "audio_cache"))
+
+
+class AudioCache:
+    """Cache audio hai tầng: LRU trong bộ nhớ và thư mục trên đĩa.
+
+    Key là hash của (engine, voice, format, text đã chuẩn hóa) nên cùng một nội dung
+    luôn trả về cùng một file audio. Cả hai tầng đều giới hạn theo tổng dung lượng;
+    tầng đĩa xóa file ít được dùng nhất (theo mtime) khi vượt giới hạn.
+    """
+
+    def __init__(self):
+        self.cache_dir = os.getenv("AUDIO_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.max_memory_bytes = int(float(os.getenv("AUDIO_CACHE_MEMORY_MB", "64")) * 1024 * 1024)
+        self.max_disk_bytes = int(float(os.getenv("AUDIO_CACHE_DISK_MB", "512")) * 1024 * 1024)
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(engine: str, voice: str, audio_format: str, text: str) -> str:
+        """Tạo key từ text đã chuẩn hóa và các tham số ảnh hưởng tới audio"""
+        raw = "\0".join([engine, voice, audio_format, text])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Lấy audio theo key, hoặc None nếu chưa có trong cache"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        if self.max_disk_bytes <= 0:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Cập nhật mtime để file vừa dùng không bị xóa trước
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Failed to read cached audio {key}: {e}")
+            return None
+
+        self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Lưu audio vào cả hai tầng cache"""
+        if not data:
+            return
+        self._remember(key, data)
+        if self.max_disk_bytes <= 0 or len(data) > self.max_disk_bytes:
+            return
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            existed = os.path.exists(path)
+            # Ghi vào file tạm rồi rename để reader không bao giờ thấy file ghi dở
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write cached audio {key}: {e}")
+            return
+
+        if not existed:
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _scan_disk(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict_disk(self) -> None:
+        """Xóa file cũ nhất khi thư mục cache vượt quá AUDIO_CACHE_DISK_MB"""
+        with self._lock:
+            if self._disk_bytes is not None and self._disk_bytes <= self.max_disk_bytes:
+                return
+            entries = self._scan_disk()
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_disk_bytes:
+                entries.sort()
+                # Xóa xuống còn 90% giới hạn để không phải quét lại sau mỗi lần ghi
+                target = int(self.max_disk_bytes * 0.9)
+                removed = 0
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    total -= size
+                    removed += 1
+                logger.info(f"Evicted {removed} cached audio files, {total} bytes remaining")
+            self._disk_bytes = total
+
+    def clear_memory(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+def detect_mime_type(data: bytes) -> str:
+    """Đoán MIME type từ magic bytes của audio"""
+    if data.startswith(b"RIFF"):
+        return "audio/wav"
+    if data.startswith(b"fLaC"):
+        return "audio/flac"
+    if data.startswith(b"OggS"):
+        return "audio/ogg"
+    return "audio/mpeg"
+
+
+# Singleton instance
+audio_cache = AudioCache()
@@ -1,14 +1,27 @@
 import base64
 import json
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 
+try:
+    import tiktoken
+except ImportError:  # tiktoken đi kèm langchain-openai; thiếu thì ước lượng theo số ký tự
+    tiktoken = None
+
 
 load_dotenv()
 
+# Map-reduce tóm tắt tài liệu dài: kích thước mỗi phần (token) và số lời gọi song song tối đa
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000"))
+SUMMARY_MAX_CONCURRENCY = int(os.getenv("SUMMARY_MAX_CONCURRENCY", "4"))
+# Ước lượng khi không có tiktoken (tiếng Việt có dấu tốn nhiều token hơn tiếng Anh)
+_CHARS_PER_TOKEN = 2.5
+
 
 def get_client() -> AzureOpenAI:
     endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -50,22 +63,175 @@ def standardize_conditions(free_text: str) -> Dict[str, Any]:
         return {"conditions": [], "allergies": [], "medications": [], "notes": content}
 
 
-def summarize_medical_text(text: str) -> str:
-    client = get_client()
-    model = get_chat_model_name()
-    system = (
-        "Bạn là trợ lý y tế. Hãy tóm tắt và biên soạn hồ sơ khám sức khoẻ dưới dạng gạch đầu dòng rõ ràng,"
-        " ưu tiên chẩn đoán, kết quả xét nghiệm bất thường, và khuyến nghị."
-    )
-    user = f"Văn bản hồ sơ (đã trích xuất từ PDF):\n{text}\n\nYêu cầu: tóm tắt rõ ràng, ngắn gọn."
+_SUMMARY_SYSTEM = (
+    "Bạn là trợ lý y tế. Hãy tóm tắt và biên soạn hồ sơ khám sức khoẻ dưới dạng gạch đầu dòng rõ ràng,"
+    " ưu tiên chẩn đoán, kết quả xét nghiệm bất thường, và khuyến nghị."
+)
+_SECTION_SYSTEM = (
+    "Bạn là trợ lý y tế. Đây là một phần của hồ sơ khám sức khoẻ dài. Hãy ghi lại dưới dạng gạch đầu dòng"
+    " mọi chẩn đoán, kết quả xét nghiệm (kèm giá trị và đơn vị), thuốc và khuyến nghị có trong phần này."
+    " Không suy đoán nội dung của các phần khác."
+)
+_MERGE_SYSTEM = (
+    "Bạn là trợ lý y tế. Hãy gộp các bản tóm tắt từng phần của cùng một hồ sơ khám sức khoẻ thành một bản"
+    " tóm tắt duy nhất dạng gạch đầu dòng: bỏ trùng lặp, giữ nguyên số liệu, ưu tiên chẩn đoán,"
+    " kết quả xét nghiệm bất thường, và khuyến nghị."
+)
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return int(len(text) / _CHARS_PER_TOKEN) + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _hard_split(text: str, max_tokens: int) -> List[str]:
+    """Cắt một đoạn quá dài thành các phần đúng max_tokens token"""
+    encoding = _get_encoding()
+    if encoding is None:
+        size = int(max_tokens * _CHARS_PER_TOKEN)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+
+def split_into_sections(text: str, max_tokens: int = SUMMARY_CHUNK_TOKENS) -> List[str]:
+    """Chia văn bản thành các phần tối đa max_tokens token, ưu tiên cắt theo đoạn rồi theo dòng"""
+    sections: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            sections.append("\n".join(current))
+        current, current_tokens = [], 0
+
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        tokens = count_tokens(paragraph)
+        if tokens > max_tokens:
+            pieces = []
+            for line in paragraph.splitlines():
+                if count_tokens(line) > max_tokens:
+                    pieces.extend(_hard_split(line, max_tokens))
+                else:
+                    pieces.append(line)
+        else:
+            pieces = [paragraph]
+
+        for piece in pieces:
+            tokens = count_tokens(piece)
+            # Tính cả dấu xuống dòng nối các phần trong cùng một section
+            if current and current_tokens + 1 + tokens > max_tokens:
+                flush()
+            current_tokens += tokens + (1 if current else 0)
+            current.append(piece)
+    flush()
+    return sections
+
+
+def _complete(client: AzureOpenAI, system: str, user: str) -> str:
     resp = client.chat.completions.create(
-        model=model,
+        model=get_chat_model_name(),
         messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
         temperature=0.2,
     )
     return resp.choices[0].message.content or ""
 
 
+def _group_partials(partials: List[str], max_tokens: int) -> List[List[str]]:
+    """Gom các bản tóm tắt liền nhau (giữ thứ tự) thành nhóm tối đa max_tokens token.
+
+    Mỗi nhóm có ít nhất hai bản (trừ nhóm cuối) để số bản luôn giảm sau mỗi vòng gộp.
+    """
+    groups: List[List[str]] = []
+    current: List[str] = []
+    current_tokens = 0
+    for partial in partials:
+        tokens = count_tokens(partial)
+        if len(current) >= 2 and current_tokens + tokens > max_tokens:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(partial)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _merge_summaries(client: AzureOpenAI, partials: List[str], executor: ThreadPoolExecutor,
+                     previous_tokens: Optional[int] = None) -> str:
+    """Gộp các bản tóm tắt; nếu quá dài cho một lời gọi thì gộp theo nhóm song song rồi gộp tiếp.
+
+    Bản tóm tắt dài hơn nửa SUMMARY_CHUNK_TOKENS được chia thành nhiều phần (không bỏ nội dung) để một
+    nhóm hai phần vẫn vừa một lời gọi. Nếu vòng gộp trước không làm tổng số token giảm (mô hình không
+    rút gọn được) thì gộp tất cả trong một lời gọi thay vì lặp tiếp.
+    """
+    limit = max(1, SUMMARY_CHUNK_TOKENS // 2)
+    partials = [
+        piece
+        for partial in partials
+        for piece in ([partial] if count_tokens(partial) <= limit else _hard_split(partial, limit))
+    ]
+    total_tokens = sum(count_tokens(partial) for partial in partials)
+    groups = _group_partials(partials, SUMMARY_CHUNK_TOKENS)
+    if len(groups) > 1 and (previous_tokens is None or total_tokens < previous_tokens):
+        partials = list(executor.map(
+            lambda group: group[0] if len(group) == 1 else _complete(
+                client, _MERGE_SYSTEM, "Các bản tóm tắt từng phần:\n" + "\n\n".join(group)
+            ),
+            groups,
+        ))
+        return _merge_summaries(client, partials, executor, total_tokens)
+
+    joined = "\n\n".join(f"--- Phần {i} ---\n{partial}" for i, partial in enumerate(partials, 1))
+    return _complete(
+        client,
+        _MERGE_SYSTEM,
+        f"Các bản tóm tắt từng phần (theo thứ tự trong hồ sơ):\n{joined}\n\nYêu cầu: tóm tắt rõ ràng, ngắn gọn.",
+    )
+
+
+def summarize_medical_text(text: str) -> str:
+    """Tóm tắt hồ sơ y tế. Văn bản dài được tóm tắt theo map-reduce:
+    chia thành các phần theo token, tóm tắt song song (tối đa SUMMARY_MAX_CONCURRENCY lời gọi)
+    rồi gộp các bản tóm tắt từng phần.
+    """
+    client = get_client()
+    sections = split_into_sections(text, SUMMARY_CHUNK_TOKENS)
+    if len(sections) <= 1:
+        user = f"Văn bản hồ sơ (đã trích xuất từ PDF):\n{text}\n\nYêu cầu: tóm tắt rõ ràng, ngắn gọn."
+        return _complete(client, _SUMMARY_SYSTEM, user)
+
+    total = len(sections)
+    with ThreadPoolExecutor(max_workers=max(1, min(SUMMARY_MAX_CONCURRENCY, total))) as executor:
+        partials = list(executor.map(
+            lambda item: _complete(
+                client,
+                _SECTION_SYSTEM,
+                f"Phần {item[0]}/{total} của hồ sơ (đã trích xuất từ PDF):\n{item[1]}",
+            ),
+            enumerate(sections, 1),
+        ))
+        return _merge_summaries(client, partials, executor)
+
+
 def to_image_data_url(image_bytes: bytes, mime: str) -> str:
     b64 = base64.b64encode(image_bytes).decode("utf-8")
     return f"data:{mime};base64,{b64}"
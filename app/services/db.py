@@ -1,29 +1,163 @@
 import csv
+import hashlib
 import json
+import logging
 import os
+import queue
 import sqlite3
+import threading
+import unicodedata
 from contextlib import contextmanager
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 
 DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "chatgpu.db"))
-SCHEMA_VERSION = 3
+# Version của schema gốc tạo bởi init_db; mọi thay đổi sau đó đi qua MIGRATIONS
+BASE_SCHEMA_VERSION = 3
+
+# Số kết nối rảnh tối đa được giữ lại trong pool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+
+# PRAGMA profile áp dụng cho mọi kết nối (WAL cho phép reader không bị chặn bởi writer)
+DB_PRAGMAS: Dict[str, str] = {
+    "journal_mode": os.getenv("DB_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": os.getenv("DB_BUSY_TIMEOUT_MS", "5000"),
+    "cache_size": os.getenv("DB_CACHE_SIZE", "-20000"),  # số âm = KiB
+    "mmap_size": os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "temp_store": os.getenv("DB_TEMP_STORE", "MEMORY"),
+}
+
+_PRAGMA_CHOICES = {
+    "journal_mode": {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"},
+    "synchronous": {"OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3"},
+    "temp_store": {"DEFAULT", "FILE", "MEMORY", "0", "1", "2"},
+}
+
+logger = logging.getLogger(__name__)
 
 
 def _now() -> str:
     return datetime.utcnow().isoformat()
 
 
+def _apply_pragmas(conn: sqlite3.Connection) -> None:
+    """Áp dụng DB_PRAGMAS; giá trị không hợp lệ sẽ bị bỏ qua kèm cảnh báo."""
+    for name, value in DB_PRAGMAS.items():
+        value = str(value).strip()
+        if not value:
+            continue
+        choices = _PRAGMA_CHOICES.get(name)
+        if choices is not None:
+            value = value.upper()
+            valid = value in choices
+        else:
+            valid = value.lstrip("-").isdigit()
+        if not valid:
+            logger.warning(f"Ignoring invalid PRAGMA {name}={value!r}")
+            continue
+        try:
+            conn.execute(f"PRAGMA {name}={value}")
+        except sqlite3.Error as e:
+            logger.warning(f"Could not apply PRAGMA {name}={value}: {e}")
+
+
+def _connect() -> sqlite3.Connection:
+    """Mở và cấu hình một kết nối SQLite mới (chỉ chạy một lần cho mỗi kết nối trong pool)."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    _apply_pragmas(conn)
+    return conn
+
+
+class ConnectionPool:
+    """Pool kết nối SQLite dùng lại giữa các request.
+
+    Kết nối rảnh được giữ trong một LIFO queue giới hạn ``max_idle``. Khi pool rỗng,
+    một kết nối mới được mở thay vì chờ, nên các lời gọi ``get_conn()`` lồng nhau
+    không bao giờ bị deadlock; kết nối dư sẽ được đóng khi trả về pool đã đầy.
+    """
+
+    def __init__(self, max_idle: int = DB_POOL_SIZE):
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=max(0, max_idle))
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self) -> sqlite3.Connection:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return _connect()
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                self._discard(conn)
+                return
+        with self._lock:
+            if not self._closed:
+                try:
+                    self._idle.put_nowait(conn)
+                    return
+                except queue.Full:
+                    pass
+        self._discard(conn)
+
+    def close_all(self) -> None:
+        """Đóng toàn bộ kết nối rảnh (gọi khi shutdown)."""
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                self._discard(conn)
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _discard(conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+_pool = ConnectionPool()
+
+
 @contextmanager
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = _pool.acquire()
     try:
         yield conn
     finally:
-        conn.commit()
-        conn.close()
+        try:
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Commit failed, discarding connection: {e}")
+            ConnectionPool._discard(conn)
+            raise
+        _pool.release(conn)
+
+
+def close_pool() -> None:
+    """Đóng các kết nối đang được giữ trong pool (dùng cho shutdown của app)."""
+    _pool.close_all()
 
 
 def _get_schema_version(conn: sqlite3.Connection) -> int:
@@ -47,15 +181,161 @@ def _set_schema_version(conn: sqlite3.Connection, version: int) -> None:
     )
 
 
+def _migrate_v4(conn: sqlite3.Connection) -> None:
+    """Index cho danh sách phiên chat theo profile, sắp xếp theo tin nhắn cuối."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_profile_last ON chat_sessions(health_profile_id, last_message_at);"
+    )
+
+
+def _migrate_v5(conn: sqlite3.Connection) -> None:
+    """Hàng đợi write-behind cho các tin nhắn chờ ghi vào vector store."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS vector_outbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          doc_id TEXT UNIQUE NOT NULL,
+          text TEXT NOT NULL,
+          metadata_json TEXT,
+          attempts INTEGER DEFAULT 0,
+          next_attempt_at TEXT,
+          last_error TEXT,
+          created_at TEXT
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vector_outbox_next ON vector_outbox(next_attempt_at);")
+
+
+def _migrate_v6(conn: sqlite3.Connection) -> None:
+    """Cache embedding theo hash nội dung (vector float32 lưu dạng BLOB)."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+          key TEXT PRIMARY KEY,
+          model TEXT,
+          vector BLOB NOT NULL,
+          created_at TEXT
+        );
+        """
+    )
+
+
+def _migrate_v7(conn: sqlite3.Connection) -> None:
+    """Job xử lý tài liệu upload ở background (file gốc giữ trong content tới khi xong)."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS document_jobs (
+          id TEXT PRIMARY KEY,
+          health_profile_id INTEGER NOT NULL,
+          filename TEXT NOT NULL,
+          file_type TEXT DEFAULT 'pdf',
+          file_size INTEGER DEFAULT 0,
+          content BLOB,
+          status TEXT NOT NULL DEFAULT 'queued',
+          document_id INTEGER,
+          error TEXT,
+          created_at TEXT,
+          updated_at TEXT,
+          FOREIGN KEY(health_profile_id) REFERENCES health_profiles(id) ON DELETE CASCADE,
+          FOREIGN KEY(document_id) REFERENCES documents(id) ON DELETE SET NULL
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_document_jobs_status ON document_jobs(status, created_at);")
+
+
+def _migrate_v8(conn: sqlite3.Connection) -> None:
+    """Dedup tài liệu: nội dung và tóm tắt lưu một lần theo hash của text đã chuẩn hóa."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS document_contents (
+          text_hash TEXT PRIMARY KEY,
+          original_content TEXT NOT NULL,
+          ai_summary TEXT,
+          created_at TEXT
+        );
+        """
+    )
+    conn.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT;")
+    conn.execute("ALTER TABLE documents ADD COLUMN text_hash TEXT;")
+    conn.execute("ALTER TABLE document_jobs ADD COLUMN content_hash TEXT;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_text_hash ON documents(text_hash);")
+
+    # Đưa tài liệu cũ vào document_contents để các lần upload sau dùng lại được tóm tắt
+    rows = conn.execute(
+        "SELECT id, original_content, ai_summary, uploaded_at FROM documents WHERE original_content IS NOT NULL ORDER BY id"
+    ).fetchall()
+    for row in rows:
+        text_hash = document_text_hash(row["original_content"])
+        conn.execute(
+            "INSERT OR IGNORE INTO document_contents(text_hash, original_content, ai_summary, created_at) VALUES (?, ?, ?, ?)",
+            (text_hash, row["original_content"], row["ai_summary"], row["uploaded_at"])
+        )
+        conn.execute("UPDATE documents SET text_hash = ? WHERE id = ?", (text_hash, row["id"]))
+
+
+def _migrate_v9(conn: sqlite3.Connection) -> None:
+    """File upload của job được lưu trên đĩa thay vì BLOB trong DB."""
+    conn.execute("ALTER TABLE document_jobs ADD COLUMN file_path TEXT;")
+
+
+def _migrate_v10(conn: sqlite3.Connection) -> None:
+    """Lease cho job đang xử lý: worker nào đang giữ job và lần cuối báo còn sống."""
+    conn.execute("ALTER TABLE document_jobs ADD COLUMN worker_id TEXT;")
+    conn.execute("ALTER TABLE document_jobs ADD COLUMN heartbeat_at TEXT;")
+
+
+# Danh sách migration theo thứ tự: (version đích, hàm nâng cấp).
+# Chỉ thêm vào cuối; không sửa migration đã phát hành.
+MIGRATIONS: List[Tuple[int, Callable[[sqlite3.Connection], None]]] = [
+    (4, _migrate_v4),
+    (5, _migrate_v5),
+    (6, _migrate_v6),
+    (7, _migrate_v7),
+    (8, _migrate_v8),
+    (9, _migrate_v9),
+    (10, _migrate_v10),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0] if MIGRATIONS else BASE_SCHEMA_VERSION
+
+
+def _run_migrations(conn: sqlite3.Connection) -> None:
+    """Áp dụng các migration còn thiếu trong một transaction duy nhất."""
+    # BEGIN IMMEDIATE giữ write lock để nhiều worker khởi động cùng lúc không chạy trùng
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current_version = _get_schema_version(conn)
+        if current_version > SCHEMA_VERSION:
+            logger.warning(
+                f"Database schema version {current_version} is newer than this build ({SCHEMA_VERSION})"
+            )
+        pending = [(v, fn) for v, fn in MIGRATIONS if v > current_version]
+        for version, migrate in pending:
+            logger.info(f"Applying schema migration v{version}")
+            migrate(conn)
+            _set_schema_version(conn, version)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
 def init_db(seed: bool = True) -> None:
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     with get_conn() as conn:
         cur = conn.cursor()
 
-        # Nếu schema cũ hoặc chưa có, làm sạch và tạo mới
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        logger.info(f"SQLite journal_mode={journal_mode}")
+
         current_version = _get_schema_version(conn)
-        if current_version != SCHEMA_VERSION:
-            # Drop tất cả bảng có thể có từ schema cũ/mới để tránh xung đột
+        if 0 < current_version < BASE_SCHEMA_VERSION:
+            # Schema từ trước khi có migration không thể nâng cấp, làm sạch và tạo mới
+            logger.warning(f"Legacy schema version {current_version}, recreating database")
+            current_version = 0
             tables_to_drop = [
                 "chat_messages",
                 "chat_sessions",
@@ -345,8 +625,12 @@ def init_db(seed: bool = True) -> None:
         cur.execute("CREATE INDEX IF NOT EXISTS idx_foods_category ON foods(category);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_token ON user_sessions(token_hash);")
         
-        # Ghi version
-        _set_schema_version(conn, SCHEMA_VERSION)
+        # Database mới: ghi version của schema gốc, sau đó chạy các migration
+        if current_version == 0:
+            _set_schema_version(conn, BASE_SCHEMA_VERSION)
+        conn.commit()
+
+        _run_migrations(conn)
 
     if seed:
         seed_foods_from_csv()
@@ -492,8 +776,12 @@ def update_health_profile(profile_id: int, user_id: int, **updates) -> bool:
 
 def delete_health_profile(profile_id: int, user_id: int) -> bool:
     """Xóa hồ sơ sức khỏe (cascade sẽ xóa documents và chats)"""
-    with get_conn() as conn:
+    with get_conn() as conn, conn:
         cur = conn.execute("DELETE FROM health_profiles WHERE id=? AND user_id=?", (profile_id, user_id))
+        if cur.rowcount:
+            # Kết nối không bật PRAGMA foreign_keys nên xóa tài liệu trực tiếp trước khi dọn nội dung dùng chung
+            conn.execute("DELETE FROM documents WHERE health_profile_id=?", (profile_id,))
+            _delete_orphan_document_contents(conn)
         return cur.rowcount > 0
 
 
@@ -510,12 +798,23 @@ def add_document(health_profile_id: int, filename: str, original_content: str,
         return int(cur.lastrowid)
 
 
+# Cột của tài liệu; nội dung và tóm tắt lấy từ document_contents nếu bản ghi không tự lưu
+DOCUMENT_COLUMNS = """
+    d.id, d.health_profile_id, d.filename,
+    COALESCE(d.original_content, dc.original_content) AS original_content,
+    COALESCE(d.ai_summary, dc.ai_summary) AS ai_summary,
+    d.file_type, d.file_size, d.uploaded_at, d.content_hash, d.text_hash
+"""
+DOCUMENT_FROM = "documents d LEFT JOIN document_contents dc ON dc.text_hash = d.text_hash"
+
+
 def list_documents(health_profile_id: int, limit: int = 20) -> List[Dict[str, Any]]:
     """Lấy danh sách tài liệu theo profile"""
     with get_conn() as conn:
         cur = conn.execute(
-            """SELECT id, filename, ai_summary, file_type, file_size, uploaded_at 
-               FROM documents WHERE health_profile_id=? ORDER BY uploaded_at DESC LIMIT ?""",
+            f"""SELECT d.id, d.filename, COALESCE(d.ai_summary, dc.ai_summary) AS ai_summary,
+               d.file_type, d.file_size, d.uploaded_at
+               FROM {DOCUMENT_FROM} WHERE d.health_profile_id=? ORDER BY d.uploaded_at DESC LIMIT ?""",
             (health_profile_id, limit),
         )
         return [dict(r) for r in cur.fetchall()]
@@ -524,10 +823,50 @@ def list_documents(health_profile_id: int, limit: int = 20) -> List[Dict[str, An
 def get_document(doc_id: int, health_profile_id: int) -> Optional[sqlite3.Row]:
     """Lấy chi tiết tài liệu (với ownership check)"""
     with get_conn() as conn:
-        cur = conn.execute("SELECT * FROM documents WHERE id=? AND health_profile_id=?", (doc_id, health_profile_id))
+        cur = conn.execute(
+            f"SELECT {DOCUMENT_COLUMNS} FROM {DOCUMENT_FROM} WHERE d.id=? AND d.health_profile_id=?",
+            (doc_id, health_profile_id)
+        )
         return cur.fetchone()
 
 
+def document_text_hash(text: str) -> str:
+    """SHA-256 của text đã chuẩn hóa (Unicode NFC, gộp khoảng trắng) để nhận ra cùng một nội dung"""
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def get_document_content(text_hash: str, health_profile_id: int) -> Optional[Dict[str, Any]]:
+    """Lấy nội dung và tóm tắt đã lưu theo hash của text.
+
+    Chỉ tìm trong tài liệu của chính người dùng sở hữu health_profile_id, để việc dùng lại tóm tắt
+    không tiết lộ người dùng khác có tài liệu cùng nội dung hay không.
+    """
+    with get_conn() as conn:
+        row = conn.execute(
+            """
+            SELECT dc.text_hash, dc.original_content, dc.ai_summary FROM document_contents dc
+            WHERE dc.text_hash = ? AND EXISTS (
+                SELECT 1 FROM documents d
+                JOIN health_profiles hp ON hp.id = d.health_profile_id
+                WHERE d.text_hash = dc.text_hash
+                  AND hp.user_id = (SELECT user_id FROM health_profiles WHERE id = ?)
+            )
+            """,
+            (text_hash, health_profile_id)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def _delete_orphan_document_contents(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        DELETE FROM document_contents
+        WHERE text_hash NOT IN (SELECT text_hash FROM documents WHERE text_hash IS NOT NULL)
+        """
+    )
+
+
 # ====== CHAT MANAGEMENT ======
 def create_chat_session(health_profile_id: int, session_name: Optional[str] = None) -> int:
     """Tạo phiên chat mới"""
@@ -905,20 +1244,20 @@ def update_health_plan(plan_id: int, health_profile_id: int, **updates) -> bool:
     values.extend([plan_id, health_profile_id])
     
     with get_conn() as conn:
-        conn.execute(
+        cur = conn.execute(
             f"UPDATE health_plans SET {', '.join(set_clauses)} WHERE id = ? AND health_profile_id = ?",
             values
         )
-        return conn.total_changes > 0
+        return cur.rowcount > 0
 
 def delete_health_plan(plan_id: int, health_profile_id: int) -> bool:
     """Xóa kế hoạch sức khỏe"""
     with get_conn() as conn:
-        conn.execute(
+        cur = conn.execute(
             "DELETE FROM health_plans WHERE id = ? AND health_profile_id = ?",
             (plan_id, health_profile_id)
         )
-        return conn.total_changes > 0
+        return cur.rowcount > 0
 
 # ====== ACTIVITY PLANNING ======
 
@@ -948,6 +1287,49 @@ def add_plan_activity(
         )
         return cur.lastrowid
 
+def _insert_plan_activities(conn: sqlite3.Connection, activities: List[Dict[str, Any]]) -> int:
+    now = _now()
+    rows = [
+        (
+            a["health_plan_id"], a["date"], a["activity_type"], a["activity_name"],
+            a.get("duration_minutes"), a.get("intensity"), a.get("calories_target"),
+            a.get("instructions"), now
+        )
+        for a in activities
+    ]
+    conn.executemany(
+        """
+        INSERT INTO health_plan_activities (
+            health_plan_id, date, activity_type, activity_name,
+            duration_minutes, intensity, calories_target, instructions, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows
+    )
+    return len(rows)
+
+def save_plan_schedule(
+    activities: List[Dict[str, Any]],
+    meals: List[Dict[str, Any]],
+    replace_plan_id: Optional[int] = None,
+    replace_dates: Optional[List[str]] = None
+) -> Tuple[int, int]:
+    """Ghi lịch trình (hoạt động và bữa ăn) trong một transaction duy nhất.
+
+    Nếu có ``replace_dates`` thì trước đó xóa các hoạt động chưa hoàn thành của
+    ``replace_plan_id`` trong các ngày này. Lỗi ở bất kỳ bước nào sẽ rollback toàn bộ.
+    Trả về (số hoạt động, số bữa ăn) đã thêm.
+    """
+    with get_conn() as conn, conn:
+        if replace_dates:
+            conn.executemany(
+                "DELETE FROM health_plan_activities WHERE health_plan_id = ? AND date = ? AND is_completed = 0",
+                [(replace_plan_id, day) for day in replace_dates]
+            )
+        added_activities = _insert_plan_activities(conn, activities) if activities else 0
+        added_meals = _insert_plan_meals(conn, meals) if meals else 0
+    return added_activities, added_meals
+
 def get_plan_activities(health_plan_id: int, date: Optional[str] = None) -> List[Dict[str, Any]]:
     """Lấy hoạt động trong kế hoạch"""
     with get_conn() as conn:
@@ -966,7 +1348,7 @@ def get_plan_activities(health_plan_id: int, date: Optional[str] = None) -> List
 def complete_plan_activity(activity_id: int, actual_duration: int, actual_intensity: str, notes: Optional[str] = None) -> bool:
     """Hoàn thành hoạt động trong kế hoạch"""
     with get_conn() as conn:
-        conn.execute(
+        cur = conn.execute(
             """
             UPDATE health_plan_activities 
             SET is_completed = 1, completed_at = ?, actual_duration_minutes = ?, actual_intensity = ?, notes = ?
@@ -974,7 +1356,7 @@ def complete_plan_activity(activity_id: int, actual_duration: int, actual_intens
             """,
             (_now(), actual_duration, actual_intensity, notes, activity_id)
         )
-        return conn.total_changes > 0
+        return cur.rowcount > 0
 
 def update_plan_activity(
     activity_id: int,
@@ -1004,8 +1386,8 @@ def update_plan_activity(
         return False
     with get_conn() as conn:
         sql = f"UPDATE health_plan_activities SET {', '.join(fields)} WHERE id = ?"
-        conn.execute(sql, (*values, activity_id))
-        return conn.total_changes > 0
+        cur = conn.execute(sql, (*values, activity_id))
+        return cur.rowcount > 0
 
 # ====== MEAL PLANNING ======
 
@@ -1034,6 +1416,28 @@ def add_plan_meal(
         )
         return cur.lastrowid
 
+def _insert_plan_meals(conn: sqlite3.Connection, meals: List[Dict[str, Any]]) -> int:
+    now = _now()
+    rows = [
+        (
+            m["health_plan_id"], m["date"], m["meal_type"],
+            json.dumps(m.get("food_items") or [], ensure_ascii=False),
+            m.get("total_calories"), json.dumps(m.get("macros") or {}, ensure_ascii=False),
+            m.get("preparation_notes"), now
+        )
+        for m in meals
+    ]
+    conn.executemany(
+        """
+        INSERT INTO health_plan_meals (
+            health_plan_id, date, meal_type, food_items_json,
+            total_calories, macros_json, preparation_notes, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows
+    )
+    return len(rows)
+
 def get_plan_meals(health_plan_id: int, date: Optional[str] = None) -> List[Dict[str, Any]]:
     """Lấy bữa ăn trong kế hoạch"""
     with get_conn() as conn:
@@ -1066,7 +1470,7 @@ def get_plan_meals(health_plan_id: int, date: Optional[str] = None) -> List[Dict
 def complete_plan_meal(meal_id: int, actual_foods: List[Dict[str, Any]], deviation_notes: Optional[str] = None) -> bool:
     """Hoàn thành bữa ăn trong kế hoạch"""
     with get_conn() as conn:
-        conn.execute(
+        cur = conn.execute(
             """
             UPDATE health_plan_meals 
             SET is_completed = 1, completed_at = ?, actual_foods_json = ?, deviation_notes = ?
@@ -1074,7 +1478,7 @@ def complete_plan_meal(meal_id: int, actual_foods: List[Dict[str, Any]], deviati
             """,
             (_now(), json.dumps(actual_foods, ensure_ascii=False), deviation_notes, meal_id)
         )
-        return conn.total_changes > 0
+        return cur.rowcount > 0
 
 # ====== ACTIVITY & MEAL LOGGING ======
 
@@ -1303,3 +1707,293 @@ def find_similar_activities(activity_name: str, activity_type: str) -> List[str]
             
     return list(set(similar))
 
+
+# ====== VECTOR STORE OUTBOX (write-behind) ======
+
+def enqueue_vector_documents(documents: List[Dict[str, Any]]) -> int:
+    """Thêm tài liệu chờ ghi vào vector store.
+
+    Mỗi phần tử gồm ``id`` (ID trong vector store), ``text`` và ``metadata``.
+    Tài liệu trùng ``id`` sẽ được ghi đè.
+    """
+    if not documents:
+        return 0
+    now = _now()
+    rows = [
+        (d["id"], d["text"], json.dumps(d.get("metadata") or {}, ensure_ascii=False), now)
+        for d in documents
+    ]
+    with get_conn() as conn, conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO vector_outbox(doc_id, text, metadata_json, attempts, created_at)
+            VALUES (?, ?, ?, 0, ?)
+            """,
+            rows
+        )
+    return len(rows)
+
+def get_pending_vector_documents(limit: int = 64) -> List[Dict[str, Any]]:
+    """Lấy các tài liệu đến hạn ghi (theo thứ tự thêm vào)"""
+    with get_conn() as conn:
+        rows = conn.execute(
+            """
+            SELECT id, doc_id, text, metadata_json, attempts FROM vector_outbox
+            WHERE next_attempt_at IS NULL OR next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+            """,
+            (_now(), limit)
+        ).fetchall()
+    documents = []
+    for row in rows:
+        doc = dict(row)
+        try:
+            doc['metadata'] = json.loads(doc.pop('metadata_json') or "{}")
+        except Exception:
+            doc['metadata'] = {}
+        documents.append(doc)
+    return documents
+
+def delete_vector_documents(outbox_ids: List[int]) -> None:
+    """Xóa tài liệu đã ghi thành công khỏi outbox"""
+    if not outbox_ids:
+        return
+    with get_conn() as conn:
+        conn.executemany("DELETE FROM vector_outbox WHERE id = ?", [(i,) for i in outbox_ids])
+
+def mark_vector_documents_failed(outbox_ids: List[int], error: str, retry_at: str, count_attempt: bool = True) -> None:
+    """Ghi nhận lần ghi thất bại và hẹn thời điểm thử lại.
+
+    count_attempt=False dùng cho lỗi kết nối: chỉ dời lịch, không tính vào số lần thử của dòng.
+    """
+    if not outbox_ids:
+        return
+    increment = 1 if count_attempt else 0
+    with get_conn() as conn:
+        conn.executemany(
+            "UPDATE vector_outbox SET attempts = attempts + ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+            [(increment, error[:500], retry_at, i) for i in outbox_ids]
+        )
+
+
+# ====== EMBEDDING CACHE ======
+
+def get_cached_embeddings(keys: List[str]) -> Dict[str, bytes]:
+    """Lấy các vector đã cache theo key; key không có trong cache sẽ bị bỏ qua"""
+    if not keys:
+        return {}
+    result: Dict[str, bytes] = {}
+    with get_conn() as conn:
+        # Chia nhỏ để không vượt giới hạn số tham số của SQLite
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})",
+                chunk
+            ).fetchall()
+            result.update({row["key"]: row["vector"] for row in rows})
+    return result
+
+def save_cached_embeddings(items: List[Tuple[str, str, bytes]]) -> None:
+    """Lưu các vector embedding dạng (key, model, vector)"""
+    if not items:
+        return
+    now = _now()
+    with get_conn() as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO embedding_cache(key, model, vector, created_at) VALUES (?, ?, ?, ?)",
+            [(key, model, sqlite3.Binary(vector), now) for key, model, vector in items]
+        )
+
+
+# ====== DOCUMENT INGESTION JOBS ======
+
+# Các bước xử lý của một job, theo thứ tự
+DOCUMENT_JOB_STAGES = ('extracting', 'summarizing', 'saving')
+
+def create_document_job(job_id: str, health_profile_id: int, filename: str, file_path: str,
+                        file_size: int, content_hash: str, file_type: str = 'pdf') -> None:
+    """Tạo job xử lý tài liệu ở trạng thái chờ (file upload đã được lưu tại file_path)"""
+    now = _now()
+    with get_conn() as conn, conn:
+        conn.execute(
+            """
+            INSERT INTO document_jobs(id, health_profile_id, filename, file_type, file_size, file_path,
+                                      content_hash, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+            """,
+            (job_id, health_profile_id, filename, file_type, file_size, file_path, content_hash, now, now)
+        )
+
+def create_duplicate_document_job(job_id: str, health_profile_id: int, filename: str, file_size: int,
+                                  content_hash: str, file_type: str = 'pdf') -> Optional[int]:
+    """Người dùng (chủ health_profile_id) đã từng upload file này: thêm bản ghi tài liệu trỏ tới nội dung
+    sẵn có và một job đã xong, trả về ID tài liệu. Trả về None nếu chưa có file trùng.
+
+    Chỉ so với tài liệu của chính người dùng đó; tra cứu và ghi nằm trong cùng một transaction.
+    """
+    now = _now()
+    with get_conn() as conn:
+        # BEGIN IMMEDIATE giữ write lock để tài liệu tìm thấy không bị xóa trước khi ghi
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT d.text_hash FROM documents d
+                JOIN health_profiles hp ON hp.id = d.health_profile_id
+                JOIN document_contents dc ON dc.text_hash = d.text_hash
+                WHERE d.content_hash = ?
+                  AND hp.user_id = (SELECT user_id FROM health_profiles WHERE id = ?)
+                LIMIT 1
+                """,
+                (content_hash, health_profile_id)
+            ).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            cur = conn.execute(
+                """INSERT INTO documents(health_profile_id, filename, file_type, file_size, uploaded_at,
+                   content_hash, text_hash) VALUES (?,?,?,?,?,?,?)""",
+                (health_profile_id, filename, file_type, file_size, now, content_hash, row["text_hash"]),
+            )
+            doc_id = int(cur.lastrowid)
+            conn.execute(
+                """
+                INSERT INTO document_jobs(id, health_profile_id, filename, file_type, file_size, content_hash,
+                                          status, document_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'done', ?, ?, ?)
+                """,
+                (job_id, health_profile_id, filename, file_type, file_size, content_hash, doc_id, now, now)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return doc_id
+
+def claim_document_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """Nhận job chờ lâu nhất (chuyển sang bước đầu tiên, ghi lease cho worker_id); trả về None nếu không còn job"""
+    with get_conn() as conn:
+        while True:
+            row = conn.execute(
+                """
+                SELECT id, health_profile_id, filename, file_type, file_size, file_path, content, content_hash
+                FROM document_jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1
+                """
+            ).fetchone()
+            if row is None:
+                return None
+            # Chỉ nhận được nếu job vẫn đang chờ (worker khác có thể đã nhận trước)
+            now = _now()
+            with conn:
+                cur = conn.execute(
+                    """
+                    UPDATE document_jobs SET status = ?, worker_id = ?, heartbeat_at = ?, updated_at = ?
+                    WHERE id = ? AND status = 'queued'
+                    """,
+                    (DOCUMENT_JOB_STAGES[0], worker_id, now, now, row["id"])
+                )
+            if cur.rowcount:
+                return dict(row)
+
+def heartbeat_document_jobs(job_ids: List[str], worker_id: str) -> None:
+    """Gia hạn lease cho các job worker_id đang xử lý"""
+    if not job_ids:
+        return
+    now = _now()
+    with get_conn() as conn, conn:
+        conn.executemany(
+            "UPDATE document_jobs SET heartbeat_at = ? WHERE id = ? AND worker_id = ?",
+            [(now, job_id, worker_id) for job_id in job_ids]
+        )
+
+def update_document_job_status(job_id: str, worker_id: str, status: str, error: Optional[str] = None) -> int:
+    """Cập nhật bước đang xử lý của job (kèm gia hạn lease); job lỗi được xóa file gốc.
+
+    Chỉ cập nhật khi worker_id còn giữ job và job chưa kết thúc; trả về 0 nếu job đã mất lease
+    (đã bị đưa lại hàng đợi cho worker khác) hoặc đã done/failed.
+    """
+    now = _now()
+    with get_conn() as conn, conn:
+        if status == 'failed':
+            cur = conn.execute(
+                """
+                UPDATE document_jobs SET status = ?, error = ?, content = NULL, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status NOT IN ('done', 'failed')
+                """,
+                (status, (error or "")[:500], now, job_id, worker_id)
+            )
+        else:
+            cur = conn.execute(
+                """
+                UPDATE document_jobs SET status = ?, heartbeat_at = ?, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status NOT IN ('done', 'failed')
+                """,
+                (status, now, now, job_id, worker_id)
+            )
+        return cur.rowcount
+
+def complete_document_job(job_id: str, worker_id: str, health_profile_id: int, filename: str,
+                          original_content: str, ai_summary: str, file_type: str = 'pdf', file_size: int = 0,
+                          content_hash: Optional[str] = None) -> Optional[int]:
+    """Lưu tài liệu và đánh dấu job hoàn thành trong cùng một transaction.
+
+    Nội dung và tóm tắt được lưu một lần trong document_contents; nếu đã có thì giữ bản cũ.
+    Trả về None (không lưu gì) nếu worker_id không còn giữ job hoặc job đã kết thúc.
+    """
+    now = _now()
+    text_hash = document_text_hash(original_content)
+    with get_conn() as conn, conn:
+        # Chiếm job trước khi ghi để worker đã mất lease không tạo tài liệu trùng
+        cur = conn.execute(
+            """
+            UPDATE document_jobs SET status = 'done', content = NULL, updated_at = ?
+            WHERE id = ? AND worker_id = ? AND status NOT IN ('done', 'failed')
+            """,
+            (now, job_id, worker_id)
+        )
+        if not cur.rowcount:
+            return None
+        conn.execute(
+            "INSERT OR IGNORE INTO document_contents(text_hash, original_content, ai_summary, created_at) VALUES (?, ?, ?, ?)",
+            (text_hash, original_content, ai_summary, now)
+        )
+        cur = conn.execute(
+            """INSERT INTO documents(health_profile_id, filename, file_type, file_size, uploaded_at,
+               content_hash, text_hash) VALUES (?,?,?,?,?,?,?)""",
+            (health_profile_id, filename, file_type, file_size, now, content_hash, text_hash),
+        )
+        doc_id = int(cur.lastrowid)
+        conn.execute("UPDATE document_jobs SET document_id = ? WHERE id = ?", (doc_id, job_id))
+    return doc_id
+
+def get_document_job(job_id: str, health_profile_id: int) -> Optional[Dict[str, Any]]:
+    """Lấy trạng thái job (với ownership check, không kèm file gốc)"""
+    with get_conn() as conn:
+        row = conn.execute(
+            """
+            SELECT id, filename, file_size, status, document_id, error, created_at, updated_at
+            FROM document_jobs WHERE id = ? AND health_profile_id = ?
+            """,
+            (job_id, health_profile_id)
+        ).fetchone()
+    return dict(row) if row else None
+
+def requeue_interrupted_document_jobs(lease_seconds: float) -> int:
+    """Đưa các job xử lý dở về hàng đợi khi worker giữ job không còn gia hạn lease.
+
+    Job của worker đang chạy (ở process khác) vẫn được gia hạn đều đặn nên không bị lấy lại;
+    chỉ job có heartbeat cũ hơn lease_seconds (process đã dừng/crash) mới được xử lý lại.
+    """
+    placeholders = ",".join("?" * len(DOCUMENT_JOB_STAGES))
+    cutoff = (datetime.utcnow() - timedelta(seconds=lease_seconds)).isoformat()
+    with get_conn() as conn, conn:
+        cur = conn.execute(
+            f"""
+            UPDATE document_jobs SET status = 'queued', worker_id = NULL, heartbeat_at = NULL, updated_at = ?
+            WHERE status IN ({placeholders}) AND (heartbeat_at IS NULL OR heartbeat_at < ?)
+            """,
+            (_now(), *DOCUMENT_JOB_STAGES, cutoff)
+        )
+        return cur.rowcount
@@ -294,6 +294,10 @@ Chỉ trả về JSON, không có text khác.
         logger.info(f"Found {len(exercise_recs)} exercise recommendations")
         logger.info(f"Exercise recommendations: {[ex.get('activity', 'unknown') for ex in exercise_recs]}")
         
+        # Gom tất cả dòng rồi ghi một lần (một transaction) thay vì từng dòng
+        activity_rows: List[Dict[str, Any]] = []
+        meal_rows: List[Dict[str, Any]] = []
+        
         # Tạo hoạt động theo tuần với phân bố đều
         # Tạo lịch trình cho từng hoạt động riêng biệt
         for i, exercise in enumerate(exercise_recs):
@@ -348,23 +352,16 @@ Chỉ trả về JSON, không có text khác.
                 logger.info(f"Adding {activity_name} to {len(exercise_days)} days")
             for day_offset in exercise_days:
                 current_date = start_date + timedelta(days=day_offset)
-                date_str = current_date.isoformat()
-                
-                try:
-                    activity_id = db.add_plan_activity(
-                        health_plan_id=plan_id,
-                        date=date_str,
-                        activity_type=exercise.get('activity', 'general'),
-                        activity_name=activity_name,
-                        duration_minutes=exercise.get('duration_minutes', 30),
-                        intensity=exercise.get('intensity', 'medium'),
-                        calories_target=exercise.get('calories_per_session'),
-                        instructions=exercise.get('notes', '')
-                    )
-                    logger.debug(f"Added activity {activity_id} for {activity_name} on {date_str}")
-                except Exception as e:
-                    logger.error(f"Error adding activity {activity_name} on {date_str}: {str(e)}")
-                    raise
+                activity_rows.append({
+                    "health_plan_id": plan_id,
+                    "date": current_date.isoformat(),
+                    "activity_type": exercise.get('activity', 'general'),
+                    "activity_name": activity_name,
+                    "duration_minutes": exercise.get('duration_minutes', 30),
+                    "intensity": exercise.get('intensity', 'medium'),
+                    "calories_target": exercise.get('calories_per_session'),
+                    "instructions": exercise.get('notes', '')
+                })
         
         # Thêm bữa ăn hàng ngày cho tất cả các ngày
         logger.info("Adding meal plans")
@@ -377,27 +374,31 @@ Chỉ trả về JSON, không có text khác.
             date_str = current_date.isoformat()
             
             for meal_type in meal_timing:
-                try:
-                    meal_id = db.add_plan_meal(
-                        health_plan_id=plan_id,
-                        date=date_str,
-                        meal_type=meal_type,
-                        food_items=[{
-                            "name": "Thực phẩm được khuyến nghị",
-                            "amount": "khẩu phần vừa phải",
-                            "calories": calories_per_meal,
-                            "notes": "Tuân thủ hướng dẫn dinh dưỡng"
-                        }],
-                        total_calories=calories_per_meal,
-                        macros=nutrition.get('macros', {}),
-                        preparation_notes=f"Bữa {meal_type} theo kế hoạch"
-                    )
-                    logger.debug(f"Added meal {meal_id} for {meal_type} on {date_str}")
-                except Exception as e:
-                    logger.error(f"Error adding meal {meal_type} on {date_str}: {str(e)}")
-                    raise
-        
-        logger.info(f"Completed detailed schedule generation for plan {plan_id}")
+                meal_rows.append({
+                    "health_plan_id": plan_id,
+                    "date": date_str,
+                    "meal_type": meal_type,
+                    "food_items": [{
+                        "name": "Thực phẩm được khuyến nghị",
+                        "amount": "khẩu phần vừa phải",
+                        "calories": calories_per_meal,
+                        "notes": "Tuân thủ hướng dẫn dinh dưỡng"
+                    }],
+                    "total_calories": calories_per_meal,
+                    "macros": nutrition.get('macros', {}),
+                    "preparation_notes": f"Bữa {meal_type} theo kế hoạch"
+                })
+        
+        try:
+            added_activities, added_meals = db.save_plan_schedule(activity_rows, meal_rows)
+        except Exception as e:
+            logger.error(f"Error saving schedule for plan {plan_id}: {str(e)}")
+            raise
+        
+        logger.info(
+            f"Completed detailed schedule generation for plan {plan_id}: "
+            f"{added_activities} activities, {added_meals} meals"
+        )
     
     def adjust_plan_based_on_feedback(
         self,
@@ -518,28 +519,26 @@ Chỉ trả về JSON, không có text khác.
     ):
         """Cập nhật lịch trình trong database"""
         
-        for day_data in schedule:
-            date_str = day_data['date']
-            
-            # Xóa hoạt động cũ cho ngày này (nếu chưa hoàn thành)
-            with db.get_conn() as conn:
-                conn.execute(
-                    "DELETE FROM health_plan_activities WHERE health_plan_id = ? AND date = ? AND is_completed = 0",
-                    (plan_id, date_str)
-                )
-            
-            # Thêm hoạt động mới
-            for activity in day_data['activities']:
-                db.add_plan_activity(
-                    health_plan_id=plan_id,
-                    date=date_str,
-                    activity_type=activity['activity_type'],
-                    activity_name=activity['activity_name'],
-                    duration_minutes=activity['duration_minutes'],
-                    intensity=activity['intensity'],
-                    calories_target=activity.get('calories_target'),
-                    instructions=activity.get('adjustment_reason', '')
-                )
+        # Xóa hoạt động cũ chưa hoàn thành của các ngày điều chỉnh và thêm hoạt động mới trong cùng transaction
+        db.save_plan_schedule(
+            activities=[
+                {
+                    "health_plan_id": plan_id,
+                    "date": day_data['date'],
+                    "activity_type": activity['activity_type'],
+                    "activity_name": activity['activity_name'],
+                    "duration_minutes": activity['duration_minutes'],
+                    "intensity": activity['intensity'],
+                    "calories_target": activity.get('calories_target'),
+                    "instructions": activity.get('adjustment_reason', '')
+                }
+                for day_data in schedule
+                for activity in day_data['activities']
+            ],
+            meals=[],
+            replace_plan_id=plan_id,
+            replace_dates=[day_data['date'] for day_data in schedule]
+        )
 
 
 # Singleton instance
@@ -0,0 +1,199 @@
+"""
+Xử lý tài liệu upload ở background: trích xuất PDF, tóm tắt bằng LLM rồi lưu vào DB
+"""
+import os
+import logging
+import socket
+import threading
+import uuid
+from typing import List, Set, Tuple
+
+from . import db
+from . import pdf as pdfsvc
+from . import azure_openai as llm
+
+logger = logging.getLogger("ingest")
+
+DEFAULT_UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "uploads"))
+
+
+def remove_upload_file(path: str) -> None:
+    """Xóa file upload của job (bỏ qua nếu đã bị xóa)"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class DocumentIngestionWorker:
+    """Worker xử lý các job trong bảng ``document_jobs``.
+
+    Upload chỉ lưu file ra đĩa, tạo job và trả về ngay; các worker thread lần lượt nhận job và
+    cập nhật trạng thái theo từng bước (extracting → summarizing → saving → done/failed).
+    Số thread (INGEST_WORKERS) cũng là số tài liệu được tóm tắt đồng thời tối đa.
+
+    Job đang xử lý được giữ bằng lease (worker_id, heartbeat_at) gia hạn định kỳ; job có lease
+    hết hạn quá INGEST_LEASE_SECONDS (process giữ job đã dừng) được đưa lại hàng đợi.
+    """
+
+    def __init__(self):
+        self.workers = max(1, int(os.getenv("INGEST_WORKERS", "2")))
+        # Chu kỳ quét hàng đợi kể cả khi không được đánh thức (job từ process khác, job bị bỏ dở)
+        self.poll_seconds = float(os.getenv("INGEST_POLL_SECONDS", "30"))
+        self.upload_dir = os.getenv("DOCUMENT_UPLOAD_DIR", DEFAULT_UPLOAD_DIR)
+        self.lease_seconds = float(os.getenv("INGEST_LEASE_SECONDS", "300"))
+        self.worker_id = ""
+        self._active: Set[str] = set()
+        self._wake = threading.Semaphore(0)
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def prepare_upload(self) -> Tuple[str, str]:
+        """Tạo job ID mới và đường dẫn để lưu file upload của job"""
+        job_id = uuid.uuid4().hex
+        return job_id, os.path.join(self.upload_dir, job_id[:2], f"{job_id}.pdf")
+
+    def submit(self, job_id: str, health_profile_id: int, filename: str, file_path: str,
+               file_size: int, content_hash: str, file_type: str = "pdf") -> str:
+        """Tạo job cho file đã lưu tại file_path và đánh thức một worker. Trả về trạng thái job.
+
+        File trùng (cùng SHA-256) với tài liệu người dùng đã upload trước đó không cần trích xuất/tóm tắt
+        lại: chỉ thêm bản ghi tài liệu dùng lại nội dung sẵn có và job hoàn thành ngay.
+        """
+        doc_id = db.create_duplicate_document_job(
+            job_id, health_profile_id, filename, file_size, content_hash, file_type
+        )
+        if doc_id is not None:
+            remove_upload_file(file_path)
+            logger.info(f"Document job {job_id} reused existing content as document {doc_id}")
+            return "done"
+
+        db.create_document_job(job_id, health_profile_id, filename, file_path, file_size, content_hash, file_type)
+        self.start()
+        self._wake.release()
+        return "queued"
+
+    def start(self) -> None:
+        with self._lock:
+            if any(thread.is_alive() for thread in self._threads):
+                return
+            self._stop.clear()
+            # Tạo khi start (không phải lúc import) để mỗi process sau fork có ID riêng
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self._requeue_stale_jobs()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"document-ingest-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            self._threads.append(
+                threading.Thread(target=self._heartbeat, name="document-ingest-heartbeat", daemon=True)
+            )
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Dừng worker; job đang chạy dở sẽ được xử lý lại ở lần khởi động sau."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        if not threads:
+            return
+        self._stop.set()
+        for _ in threads:
+            self._wake.release()
+        for thread in threads:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = db.claim_document_job(self.worker_id)
+            except Exception as e:
+                logger.error(f"Failed to claim document job: {e}")
+                job = None
+            if job is None:
+                # Job bỏ dở bởi process đã dừng được nhận lại ở lần quét sau
+                if not self._requeue_stale_jobs():
+                    self._wake.acquire(timeout=self.poll_seconds)
+                continue
+            with self._lock:
+                self._active.add(job["id"])
+            try:
+                self._process(job)
+            finally:
+                with self._lock:
+                    self._active.discard(job["id"])
+
+    def _requeue_stale_jobs(self) -> int:
+        """Job xử lý dở có lease hết hạn được chạy lại từ đầu"""
+        try:
+            requeued = db.requeue_interrupted_document_jobs(self.lease_seconds)
+        except Exception as e:
+            logger.error(f"Failed to requeue stale document jobs: {e}")
+            return 0
+        if requeued:
+            logger.info(f"Requeued {requeued} interrupted document jobs")
+        return requeued
+
+    def _heartbeat(self) -> None:
+        """Gia hạn lease của các job đang xử lý (ba lần trong mỗi chu kỳ lease)"""
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                job_ids = list(self._active)
+            try:
+                db.heartbeat_document_jobs(job_ids, self.worker_id)
+            except Exception as e:
+                logger.error(f"Failed to renew document job leases: {e}")
+
+    def _process(self, job) -> None:
+        job_id = job["id"]
+        try:
+            # Job tạo trước khi có file_path vẫn giữ file trong cột content
+            extracted_text = pdfsvc.extract_text_from_pdf(job["file_path"] or job["content"])
+            if not extracted_text:
+                raise ValueError("Không trích xuất được nội dung từ file PDF")
+
+            # File khác nhưng cùng nội dung text (vd. xuất PDF lại) với tài liệu của chính người dùng
+            # thì dùng lại tóm tắt đã có
+            existing = db.get_document_content(db.document_text_hash(extracted_text), job["health_profile_id"])
+            if existing and existing["ai_summary"]:
+                ai_summary = existing["ai_summary"]
+            else:
+                if not db.update_document_job_status(job_id, self.worker_id, "summarizing"):
+                    return self._lease_lost(job_id)
+                ai_summary = llm.summarize_medical_text(extracted_text)
+
+            if not db.update_document_job_status(job_id, self.worker_id, "saving"):
+                return self._lease_lost(job_id)
+            doc_id = db.complete_document_job(
+                job_id,
+                self.worker_id,
+                health_profile_id=job["health_profile_id"],
+                filename=job["filename"],
+                original_content=extracted_text,
+                ai_summary=ai_summary,
+                file_type=job["file_type"],
+                file_size=job["file_size"],
+                content_hash=job["content_hash"],
+            )
+            if doc_id is None:
+                return self._lease_lost(job_id)
+            logger.info(f"Document job {job_id} completed as document {doc_id}")
+        except Exception as e:
+            logger.error(f"Document job {job_id} failed: {e}")
+            try:
+                if not db.update_document_job_status(job_id, self.worker_id, "failed", error=str(e)):
+                    return self._lease_lost(job_id)
+            except Exception as db_error:
+                logger.error(f"Failed to mark document job {job_id} as failed: {db_error}")
+                return
+        if job["file_path"]:
+            remove_upload_file(job["file_path"])
+
+    def _lease_lost(self, job_id: str) -> None:
+        """Job đã được giao cho worker khác hoặc đã kết thúc: dừng xử lý và giữ nguyên file upload"""
+        logger.warning(f"Document job {job_id} is no longer held by this worker; abandoning it")
+
+
+# Singleton instance
+document_ingestion_worker = DocumentIngestionWorker()
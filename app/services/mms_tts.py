@@ -3,10 +3,15 @@ Text-to-Speech service using Facebook MMS-TTS-VIE from Hugging Face
 """
 import os
 import io
+import wave
 import base64
+import struct
+import time
+import queue
 import logging
-import tempfile
-from typing import Optional
+import threading
+from concurrent.futures import Future
+from typing import Iterator, List, Optional, Tuple
 import numpy as np
 
 try:
@@ -16,29 +21,156 @@ try:
 except ImportError:
     raise RuntimeError("Missing dependencies. Please install with: pip install transformers torch torchaudio")
 
+from .audio_cache import audio_cache
+from .tts_text import normalize_for_tts, split_sentences
+
 # Logging configuration
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("mms_tts")
 
 
+AUDIO_MIME_TYPES = {
+    "wav": "audio/wav",
+    "flac": "audio/flac",
+    "mp3": "audio/mpeg",
+    "ogg": "audio/ogg",
+}
+
+
+class InferenceBatcher:
+    """Worker duy nhất chạy model MMS, gom các request đồng thời thành một batch.
+
+    Request đầu tiên mở một cửa sổ ngắn (MMS_TTS_BATCH_WINDOW_MS); các request đến trong cửa sổ đó
+    được pad chung và chạy một lần ``model(**inputs)``, sau đó waveform được cắt trả về từng caller.
+    Chỉ có một forward pass tại một thời điểm nên các request không tranh nhau thread pool của torch.
+    """
+
+    def __init__(self, service: "MMS_TTS_VIEService"):
+        self.service = service
+        self.max_batch_size = max(1, int(os.getenv("MMS_TTS_MAX_BATCH_SIZE", "8")))
+        self.window_seconds = float(os.getenv("MMS_TTS_BATCH_WINDOW_MS", "15")) / 1000
+        self.timeout_seconds = float(os.getenv("MMS_TTS_TIMEOUT_SECONDS", "120"))
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        """Gửi text vào hàng đợi, Future trả về waveform (float32, mono)"""
+        self._ensure_started()
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def synthesize(self, text: str) -> np.ndarray:
+        """Gửi text vào hàng đợi và chờ waveform"""
+        return self.submit(text).result(timeout=self.timeout_seconds)
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="mms-tts-inference", daemon=True)
+            self._thread.start()
+
+    def _collect_batch(self) -> List[Tuple[str, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            # Bỏ qua các request mà caller đã hủy/hết thời gian chờ
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                waveforms = self._infer([text for text, _ in batch])
+            except Exception as e:
+                logger.error(f"MMS-TTS batch inference failed ({len(batch)} requests): {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), waveform in zip(batch, waveforms):
+                future.set_result(waveform)
+
+    def _infer(self, texts: List[str]) -> List[np.ndarray]:
+        model = self.service.model
+        inputs = self.service.processor(text=texts, return_tensors="pt", padding=True)
+        device = next(model.parameters()).device
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+
+        logger.info(f"Generating speech for batch of {len(texts)} texts")
+        with torch.no_grad():
+            outputs = model(**inputs)
+
+        waveforms = outputs.waveform.cpu().numpy()
+        lengths = getattr(outputs, "sequence_lengths", None)
+        if lengths is None or len(texts) == 1:
+            lengths = [waveforms.shape[-1]] * len(texts)
+        else:
+            lengths = [int(length) for length in lengths.cpu().tolist()]
+
+        # Cắt phần padding ở cuối mỗi waveform
+        return [waveforms[i].reshape(-1)[:lengths[i]] for i in range(len(texts))]
+
+
 class MMS_TTS_VIEService:
     def __init__(self):
         self.model = None
         self.processor = None
         self._initialized = False
+        self._init_lock = threading.Lock()
+        self.batcher = InferenceBatcher(self)
+        # Trạng thái model: not_loaded -> loading -> warming_up -> ready (hoặc failed)
+        self.state = "not_loaded"
+        self.last_error: Optional[str] = None
+        self.ready_at: Optional[float] = None
+        self._warmup_thread: Optional[threading.Thread] = None
         self.model_name = "facebook/mms-tts-vie"
+        # Sample rate thực tế được đọc từ config của model khi khởi tạo
+        self.sample_rate = 16000
+        # wav (PCM16, không cần thư viện ngoài) hoặc định dạng nén mà torchaudio hỗ trợ (flac, mp3, ogg)
+        self.audio_format = os.getenv("MMS_TTS_AUDIO_FORMAT", "wav").lower()
+        # Văn bản dài được tách theo câu; các câu được đưa vào cùng một batch
+        self.chunk_max_chars = int(os.getenv("MMS_TTS_CHUNK_MAX_CHARS", "200"))
+        # Backend suy luận trên CPU: eager (mặc định), int8 (dynamic quantization) hoặc compile (torch.compile)
+        self.backend = os.getenv("MMS_TTS_BACKEND", "eager").lower()
+        self.parity_check = os.getenv("MMS_TTS_PARITY_CHECK", "true").lower() == "true"
+        self.parity_min_similarity = float(os.getenv("MMS_TTS_PARITY_MIN_SIMILARITY", "0.9"))
         
     def _initialize_service(self):
         """Khởi tạo MMS-TTS-VIE model (lazy loading)"""
         if self._initialized:
             return
-            
+        
+        with self._init_lock:
+            if self._initialized:
+                return
+            self._load_model()
+    
+    def _load_model(self, mark_ready: bool = True):
+        self.state = "loading"
         try:
             logger.info("Initializing Facebook MMS-TTS-VIE model...")
             
             # Load processor and model
             self.processor = AutoProcessor.from_pretrained(self.model_name)
             self.model = AutoModel.from_pretrained(self.model_name)
+            self.sample_rate = getattr(self.model.config, "sampling_rate", self.sample_rate)
+            
+            # Giới hạn số thread intra-op của torch (mặc định dùng toàn bộ core)
+            torch_threads = os.getenv("MMS_TTS_TORCH_THREADS")
+            if torch_threads:
+                torch.set_num_threads(int(torch_threads))
             
             # Move to GPU if available
             if torch.cuda.is_available():
@@ -46,133 +178,285 @@ class MMS_TTS_VIEService:
                 logger.info("Model loaded on GPU")
             else:
                 logger.info("Model loaded on CPU")
+                self.model = self._optimize_for_cpu(self.model)
             
             self._initialized = True
+            if mark_ready:
+                self._mark_ready()
             logger.info(f"Facebook MMS-TTS-VIE model initialized successfully")
             
         except Exception as e:
+            self.state = "failed"
+            self.last_error = str(e)
             logger.error(f"Error initializing MMS-TTS-VIE model: {str(e)}")
             raise
     
-    def text_to_speech(self, text: str, max_length: int = 500) -> Optional[str]:
+    def _mark_ready(self):
+        self.state = "ready"
+        self.last_error = None
+        self.ready_at = time.time()
+    
+    def warmup(self) -> bool:
+        """Tải model và chạy thử một câu để lần gọi đầu tiên không phải chờ"""
+        try:
+            with self._init_lock:
+                if not self._initialized:
+                    # Chỉ báo ready sau khi chạy thử xong
+                    self._load_model(mark_ready=False)
+                    self.state = "warming_up"
+            started = time.perf_counter()
+            self.batcher.synthesize("Xin chào.")
+            self._mark_ready()
+            logger.info(f"MMS-TTS warmup finished in {(time.perf_counter() - started) * 1000:.0f}ms")
+            return True
+        except Exception as e:
+            self.state = "failed"
+            self.last_error = str(e)
+            logger.error(f"MMS-TTS warmup failed: {str(e)}")
+            return False
+    
+    def start_warmup(self) -> None:
+        """Chạy warmup ở background thread (không chặn quá trình khởi động server)"""
+        if self._warmup_thread and self._warmup_thread.is_alive():
+            return
+        self._warmup_thread = threading.Thread(target=self.warmup, name="mms-tts-warmup", daemon=True)
+        self._warmup_thread.start()
+    
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+    
+    def get_status(self) -> dict:
+        """Trạng thái model cho readiness endpoint"""
+        return {
+            "state": self.state,
+            "ready": self.is_ready(),
+            "backend": self.backend,
+            "error": self.last_error,
+            "ready_at": self.ready_at,
+        }
+    
+    def _optimize_for_cpu(self, model):
+        """Áp dụng backend MMS_TTS_BACKEND; quay về eager nếu lỗi hoặc không qua được parity check"""
+        if self.backend == "eager":
+            return model
+        
+        model.eval()
+        try:
+            if self.backend == "int8":
+                # Lượng tử hóa động các lớp Linear (attention/FFN của text encoder) sang int8
+                optimized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            elif self.backend == "compile":
+                # Độ dài waveform phụ thuộc dữ liệu nên cần dynamic shapes
+                optimized = torch.compile(model, dynamic=True)
+            else:
+                logger.warning(f"Unknown MMS_TTS_BACKEND '{self.backend}', using eager model")
+                self.backend = "eager"
+                return model
+            
+            if self.parity_check and not self._check_parity(model, optimized):
+                self.backend = "eager"
+                return model
+        except Exception as e:
+            logger.error(f"Failed to build '{self.backend}' backend, using eager model: {str(e)}")
+            self.backend = "eager"
+            return model
+        
+        logger.info(f"Using optimized MMS-TTS backend: {self.backend}")
+        return optimized
+    
+    def _check_parity(self, reference, candidate, text: str = "Xin chào, tôi là trợ lý sức khỏe của bạn.") -> bool:
+        """So sánh output của model tối ưu với model eager trên cùng câu mẫu và cùng seed.
+        
+        Vì backend tối ưu có thể làm lệch nhẹ thời lượng từng âm, so sánh đường bao năng lượng (RMS theo frame)
+        sau khi kéo về cùng độ dài, cùng với tỉ lệ độ dài waveform.
+        """
+        inputs = self.processor(text=text, return_tensors="pt")
+        
+        def run(model):
+            torch.manual_seed(0)
+            started = time.perf_counter()
+            with torch.no_grad():
+                waveform = model(**inputs).waveform.cpu().numpy().reshape(-1)
+            return waveform, time.perf_counter() - started
+        
+        # Chạy candidate hai lần: lần đầu bao gồm chi phí compile/warmup
+        expected, reference_seconds = run(reference)
+        run(candidate)
+        actual, candidate_seconds = run(candidate)
+        
+        length_ratio = len(actual) / max(len(expected), 1)
+        similarity = self._envelope_similarity(expected, actual)
+        passed = abs(1 - length_ratio) <= 0.1 and similarity >= self.parity_min_similarity
+        
+        log = logger.info if passed else logger.warning
+        log(
+            f"MMS-TTS parity check ({self.backend}): similarity={similarity:.3f}, length_ratio={length_ratio:.3f}, "
+            f"eager={reference_seconds * 1000:.0f}ms, {self.backend}={candidate_seconds * 1000:.0f}ms"
+            + ("" if passed else " - falling back to eager model")
+        )
+        return passed
+    
+    @staticmethod
+    def _envelope_similarity(expected: np.ndarray, actual: np.ndarray, frame: int = 256) -> float:
+        """Hệ số tương quan giữa đường bao RMS của hai waveform"""
+        def envelope(waveform: np.ndarray) -> np.ndarray:
+            frames = max(len(waveform) // frame, 1)
+            trimmed = waveform[:frames * frame].reshape(frames, -1)
+            return np.sqrt(np.mean(trimmed ** 2, axis=1))
+        
+        a = envelope(expected)
+        b = envelope(actual)
+        b = np.interp(np.linspace(0, 1, len(a)), np.linspace(0, 1, len(b)), b)
+        if len(a) < 2 or np.std(a) == 0 or np.std(b) == 0:
+            return 0.0
+        return float(np.corrcoef(a, b)[0, 1])
+    
+    def text_to_speech(self, text: str) -> Optional[str]:
         """
         Chuyển đổi text thành audio sử dụng Facebook MMS-TTS-VIE
         
         Args:
-            text: Văn bản cần chuyển đổi
-            max_length: Độ dài tối đa của text
+            text: Văn bản cần chuyển đổi (không giới hạn độ dài, văn bản dài được tách theo câu)
             
         Returns:
             Base64 encoded audio data URL hoặc None nếu có lỗi
         """
         if not text or not text.strip():
             return None
-            
-        # Cắt ngắn text nếu quá dài
-        if len(text) > max_length:
-            text = text[:max_length] + "..."
         
         try:
-            # Khởi tạo service nếu chưa được tải
-            self._initialize_service()
-            
-            # Tiền xử lý text
-            text = self._preprocess_text(text)
-            
-            # Tokenize text
-            inputs = self.processor(text=text, return_tensors="pt")
-            
-            # Move inputs to same device as model
-            if torch.cuda.is_available():
-                inputs = {k: v.to("cuda") for k, v in inputs.items()}
-            
-            # Generate speech using the correct method
-            logger.info(f"Generating speech for text: {text[:50]}...")
-            with torch.no_grad():
-                # Use the forward method to generate speech
-                speech = self.model(**inputs).waveform
-            
-            # Convert to numpy array
-            speech = speech.cpu().numpy().squeeze()
-            
-            # Normalize audio
-            speech = speech / np.max(np.abs(speech)) * 0.9
-            
-            # Convert to WAV format
-            audio_data = self._numpy_to_wav(speech, sample_rate=24000)
-            
-            # Convert to base64
-            audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-            
-            # Trả về data URL cho WAV
-            return f"data:audio/wav;base64,{audio_base64}"
-                
+            result = self.synthesize(text)
+            return self._to_data_url(result[1]) if result else None
         except Exception as e:
             logger.error(f"MMS-TTS-VIE error: {str(e)}")
             return None
     
-    def _preprocess_text(self, text: str) -> str:
-        """Tiền xử lý text cho TTS tiếng Việt"""
-        # Loại bỏ các ký tự đặc biệt không cần thiết
-        text = text.strip()
-        
-        # Thay thế một số từ viết tắt phổ biến cho tiếng Việt
-        replacements = {
-            "kg": "ki-lô-gam",
-            "cm": "xen-ti-mét", 
-            "mm": "mi-li-mét",
-            "km": "ki-lô-mét",
-            "°C": "độ C",
-            "%": "phần trăm",
-            "&": "và",
-            "@": "a còng",
-            "vs": "so với",
-            "AI": "A-I",
-            "API": "A-P-I",
-            "URL": "U-R-L",
-            "=": "bằng",
-            "HTTP": "H-T-T-P",
-        }
-        
-        for old, new in replacements.items():
-            text = text.replace(old, new)
+    def synthesize(self, text: str) -> Optional[Tuple[str, bytes]]:
+        """Tổng hợp toàn bộ text thành audio theo MMS_TTS_AUDIO_FORMAT.
         
-        # Loại bỏ markdown formatting
-        text = text.replace("**", "").replace("*", "").replace("_", "")
-        text = text.replace("```", "").replace("`", "")
+        Returns:
+            (audio_id, audio bytes); audio_id là key trong audio cache, dùng cho URL /api/audio/{audio_id}
+        """
+        # Tiền xử lý text
+        text = self._preprocess_text(text)
+        if not text:
+            return None
         
-        # Loại bỏ các ký tự đặc biệt có thể gây lỗi
-        text = text.replace("<", "").replace(">", "").replace("&", "và")
+        # Trả về ngay nếu nội dung này đã được tổng hợp trước đó
+        cache_key = audio_cache.make_key("mms", self.model_name, self.audio_format, text)
+        cached_audio = audio_cache.get(cache_key)
+        if cached_audio is not None:
+            return cache_key, cached_audio
         
-        # Loại bỏ dấu xuống dòng liên tiếp
-        text = " ".join(text.split())
+        pcm = b"".join(self._iter_pcm(text))
+        audio_data = self._encode_audio(pcm, sample_rate=self.sample_rate)
+        audio_cache.put(cache_key, audio_data)
+        return cache_key, audio_data
+    
+    def iter_wav_stream(self, text: str) -> Iterator[bytes]:
+        """Stream WAV: header kèm PCM16 của câu đầu tiên, sau đó từng câu theo thứ tự ngay khi tổng hợp xong.
+
+        Header chỉ được trả về sau khi câu đầu tổng hợp thành công để lỗi model/batcher
+        xuất hiện ngay ở chunk đầu tiên (trước khi response bắt đầu).
+        """
+        text = self._preprocess_text(text)
+        if not text:
+            return
+        self._initialize_service()
+        pcm_chunks = self._iter_pcm(text)
+        try:
+            first_pcm = next(pcm_chunks, b"")
+            yield self._streaming_wav_header(self.sample_rate) + first_pcm
+            yield from pcm_chunks
+        finally:
+            pcm_chunks.close()
+    
+    def _iter_pcm(self, text: str) -> Iterator[bytes]:
+        """Tổng hợp các câu của text (đã tiền xử lý) thành PCM16, trả về theo thứ tự"""
+        pending = []
+        for chunk in split_sentences(text, self.chunk_max_chars):
+            chunk_key = audio_cache.make_key("mms", self.model_name, "pcm16", chunk)
+            cached_pcm = audio_cache.get(chunk_key)
+            if cached_pcm is not None:
+                pending.append((chunk_key, cached_pcm))
+                continue
+            # Khởi tạo service nếu chưa được tải
+            self._initialize_service()
+            logger.info(f"Generating speech for text: {chunk[:50]}...")
+            # Gửi tất cả câu cùng lúc để worker gom chúng vào chung batch
+            pending.append((chunk_key, self.batcher.submit(chunk)))
         
-        return text
+        try:
+            for chunk_key, item in pending:
+                if isinstance(item, bytes):
+                    yield item
+                    continue
+                speech = item.result(timeout=self.batcher.timeout_seconds)
+                
+                # Normalize audio
+                peak = np.max(np.abs(speech)) if speech.size else 0
+                if peak > 0:
+                    speech = speech / peak * 0.9
+                
+                pcm = self._to_pcm16(speech)
+                audio_cache.put(chunk_key, pcm)
+                yield pcm
+        finally:
+            # Client ngắt kết nối hoặc có lỗi: bỏ các câu chưa được đưa vào batch
+            for _, item in pending:
+                if isinstance(item, Future):
+                    item.cancel()
     
-    def _numpy_to_wav(self, audio_array: np.ndarray, sample_rate: int = 24000) -> bytes:
-        """Chuyển đổi numpy array thành WAV bytes"""
+    def _to_data_url(self, audio_data: bytes) -> str:
+        """Chuyển audio thành base64 data URL"""
+        audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+        return f"data:{self.mime_type};base64,{audio_base64}"
+    
+    @property
+    def mime_type(self) -> str:
+        return AUDIO_MIME_TYPES.get(self.audio_format, f"audio/{self.audio_format}")
+    
+    def _preprocess_text(self, text: str) -> str:
+        """Tiền xử lý text cho TTS tiếng Việt"""
+        return normalize_for_tts(text)
+    
+    def _encode_audio(self, pcm: bytes, sample_rate: int) -> bytes:
+        """Encode PCM16 theo MMS_TTS_AUDIO_FORMAT, không ghi ra file tạm"""
+        if self.audio_format == "wav":
+            return self._pcm16_to_wav(pcm, sample_rate)
+        
         try:
-            # Tạo temporary file
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-                temp_path = temp_file.name
-            
-            # Save as WAV using torchaudio
-            torch_tensor = torch.from_numpy(audio_array).float()
-            torchaudio.save(temp_path, torch_tensor.unsqueeze(0), sample_rate)
-            
-            # Read the file and return bytes
-            with open(temp_path, 'rb') as f:
-                audio_bytes = f.read()
-            
-            # Clean up temporary file
-            os.unlink(temp_path)
-            
-            return audio_bytes
-            
+            buffer = io.BytesIO()
+            audio_array = np.frombuffer(pcm, dtype="<i2").astype(np.float32) / 32767
+            torchaudio.save(buffer, torch.from_numpy(audio_array).unsqueeze(0), sample_rate, format=self.audio_format)
+            return buffer.getvalue()
         except Exception as e:
-            logger.error(f"Error converting numpy to WAV: {str(e)}")
+            logger.error(f"Error encoding audio as {self.audio_format}: {str(e)}")
             raise
     
+    def _to_pcm16(self, audio_array: np.ndarray) -> bytes:
+        """Lượng tử hóa float [-1, 1] về int16 little-endian (một nửa dung lượng so với float32)"""
+        return (np.clip(audio_array, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+    
+    def _pcm16_to_wav(self, pcm: bytes, sample_rate: int) -> bytes:
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(pcm)
+        return buffer.getvalue()
+    
+    @staticmethod
+    def _streaming_wav_header(sample_rate: int) -> bytes:
+        """WAV header cho stream chưa biết độ dài (kích thước đặt ở giá trị tối đa)"""
+        byte_rate = sample_rate * 2
+        return (
+            b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, byte_rate, 2, 16)
+            + b"data" + struct.pack("<I", 0xFFFFFFFF - 36)
+        )
+    
     def is_available(self) -> bool:
         """Kiểm tra xem MMS-TTS-VIE model có khả dụng không"""
         try:
@@ -188,8 +472,9 @@ class MMS_TTS_VIEService:
             "name": "Facebook MMS-TTS-VIE",
             "model_id": self.model_name,
             "language": "Vietnamese",
-            "sample_rate": 24000,
-            "format": "WAV"
+            "sample_rate": self.sample_rate,
+            "format": self.audio_format.upper(),
+            "backend": self.backend
         }
 
 
@@ -212,4 +497,18 @@ def generate_audio_mms(text: str) -> Optional[str]:
 
 def is_mms_tts_available() -> bool:
     """Kiểm tra xem MMS-TTS-VIE có khả dụng không"""
-    return mms_tts_service.is_available() 
\ No newline at end of file
+    return mms_tts_service.is_available() 
+
+
+def generate_audio_bytes_mms(text: str) -> Optional[Tuple[str, bytes]]:
+    """Helper function để sinh audio bytes từ text, trả về (audio_id, audio) hoặc None"""
+    try:
+        return mms_tts_service.synthesize(text)
+    except Exception as e:
+        logger.error(f"MMS-TTS-VIE error: {str(e)}")
+        return None
+
+
+def stream_audio_mms(text: str) -> Iterator[bytes]:
+    """Helper function để stream WAV từ text, từng câu một"""
+    return mms_tts_service.iter_wav_stream(text)
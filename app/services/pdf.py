@@ -1,12 +1,113 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple, Union
+
 import fitz  # PyMuPDF
 
 
-def extract_text_from_pdf(file_bytes: bytes) -> str:
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    texts = []
-    for page in doc:
-        texts.append(page.get_text("text"))
-    doc.close()
-    return "\n\n".join(texts).strip()
+# Số process trích xuất PDF (PyMuPDF giữ GIL nên dùng process thay vì thread)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Tài liệu từ số trang này trở lên được chia thành nhiều khoảng trang xử lý song song
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "24"))
+
+logger = logging.getLogger("pdf")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: không fork các thread của server (Speech SDK, worker...) sang process con
+            _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _discard_pool(broken: ProcessPoolExecutor) -> None:
+    """Bỏ pool đã hỏng (process con bị crash) để lần gọi sau tạo pool mới"""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Đường dẫn file hoặc bytes; process con nên nhận đường dẫn để khỏi phải pickle cả file
+PdfSource = Union[str, bytes]
+
+
+def _open(source: PdfSource) -> "fitz.Document":
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def _probe(source: PdfSource) -> Tuple[int, Optional[List[str]]]:
+    """Đếm số trang; tài liệu nhỏ được trích xuất luôn trong cùng lần gọi"""
+    with _open(source) as doc:
+        if len(_page_ranges(doc.page_count)) > 1:
+            return doc.page_count, None
+        return doc.page_count, [page.get_text("text") for page in doc]
+
+
+def _extract_page_range(source: PdfSource, start: int, end: int) -> List[str]:
+    """Trích xuất text của các trang [start, end) (chạy trong process con)"""
+    with _open(source) as doc:
+        return [doc[i].get_text("text") for i in range(start, end)]
+
+
+def _page_ranges(page_count: int) -> List[Tuple[int, int]]:
+    if page_count < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS <= 1:
+        return [(0, page_count)]
+    size = -(-page_count // PDF_WORKERS)
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def _join_pages(pages: List[str]) -> str:
+    return "\n\n".join(pages).strip()
+
+
+def _extract_with_pool(pool: ProcessPoolExecutor, source: PdfSource) -> str:
+    page_count, pages = pool.submit(_probe, source).result()
+    if pages is not None:
+        return _join_pages(pages)
+    futures = [
+        pool.submit(_extract_page_range, source, start, end)
+        for start, end in _page_ranges(page_count)
+    ]
+    return _join_pages([page for future in futures for page in future.result()])
+
+
+def extract_text_from_pdf(source: PdfSource) -> str:
+    """Trích xuất text trong process pool (chặn thread gọi, dùng trong worker thread).
 
+    Tài liệu lớn được chia thành các khoảng trang, trích xuất song song rồi ghép lại đúng thứ tự.
+    Nếu process con bị crash (PyMuPDF gặp file hỏng), pool được tạo lại và thử thêm một lần.
+    """
+    pool = _get_pool()
+    try:
+        return _extract_with_pool(pool, source)
+    except BrokenProcessPool:
+        logger.warning("PDF worker process crashed, recreating pool and retrying once")
+        _discard_pool(pool)
 
+    pool = _get_pool()
+    try:
+        return _extract_with_pool(pool, source)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise ValueError("Không đọc được file PDF (file có thể bị hỏng)")
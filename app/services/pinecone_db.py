@@ -2,14 +2,24 @@
 Pinecone service for managing chat history as a vector store.
 """
 import os
+import asyncio
+import hashlib
 import logging
-from typing import Optional
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
 from langchain_openai import AzureOpenAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
 from pinecone import Pinecone as PineconeClient, ServerlessSpec
 
+from . import db
+
 # Tải biến môi trường
 load_dotenv()
 
@@ -17,70 +27,359 @@ load_dotenv()
 logger = logging.getLogger("pinecone_db")
 
 
+class CachedEmbeddings(Embeddings):
+    """Bọc một mô hình embeddings bằng cache theo hash nội dung.
+
+    Tầng 1 là LRU trong bộ nhớ, tầng 2 (tùy chọn) là bảng ``embedding_cache`` trong SQLite.
+    Cả hai tầng lưu vector dạng float32 (``array('f')``) và chỉ đổi sang list khi trả về.
+    Chỉ các đoạn văn bản chưa có trong cache mới được gửi tới mô hình, mỗi lần một lô.
+    """
+
+    def __init__(self, underlying: Embeddings, model: str, max_entries: int = 2048, persist: bool = False):
+        self.underlying = underlying
+        self.model = model
+        self.max_entries = max_entries
+        self.persist = persist
+        self._memory: "OrderedDict[str, array]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: array) -> None:
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Tìm vector trong bộ nhớ, sau đó trong SQLite cho các key còn thiếu."""
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector.tolist()
+        missing = [key for key in keys if key not in found]
+        if self.persist and missing:
+            try:
+                for key, blob in db.get_cached_embeddings(missing).items():
+                    vector = array("f", blob)
+                    found[key] = vector.tolist()
+                    self._remember(key, vector)
+            except Exception as e:
+                logger.warning(f"Không đọc được embedding cache từ SQLite: {e}")
+        return found
+
+    def _store(self, items: Dict[str, List[float]]) -> None:
+        packed = {key: array("f", vector) for key, vector in items.items()}
+        for key, vector in packed.items():
+            self._remember(key, vector)
+        if self.persist and packed:
+            try:
+                db.save_cached_embeddings([
+                    (key, self.model, vector.tobytes()) for key, vector in packed.items()
+                ])
+            except Exception as e:
+                logger.warning(f"Không lưu được embedding cache vào SQLite: {e}")
+
+    def _plan(self, texts: List[str]):
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+        # Mỗi nội dung chưa có trong cache chỉ được embed một lần, kể cả khi lặp lại trong lô
+        pending: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in pending:
+                pending[key] = text
+        return keys, found, pending
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, pending = self._plan(texts)
+        if pending:
+            vectors = self.underlying.embed_documents(list(pending.values()))
+            computed = dict(zip(pending.keys(), vectors))
+            self._store(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        keys, found, pending = await loop.run_in_executor(None, self._plan, texts)
+        if pending:
+            vectors = await self.underlying.aembed_documents(list(pending.values()))
+            computed = dict(zip(pending.keys(), vectors))
+            await loop.run_in_executor(None, self._store, computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
 class PineconeService:
     def __init__(self):
         self.client: Optional[PineconeClient] = None
         self.index_name: str = os.getenv("PINECONE_INDEX_NAME", "chatgpu-history")
-        self.embeddings: Optional[AzureOpenAIEmbeddings] = None
+        self.embeddings: Optional[CachedEmbeddings] = None
+        self._index = None
+        self._vector_store: Optional[PineconeVectorStore] = None
         self._initialized: bool = False
+        # Thiếu cấu hình thì không cần thử khởi tạo lại
+        self._disabled: bool = False
+        # Sau khi khởi tạo lỗi, chờ một khoảng trước khi thử kết nối lại
+        self._retry_interval: float = float(os.getenv("PINECONE_RECONNECT_SECONDS", "30"))
+        self._next_retry_at: float = 0.0
+        self._lock = threading.Lock()
 
     def _initialize(self):
-        """Khởi tạo kết nối đến Pinecone và mô hình embeddings một cách lười biếng (lazy)."""
-        if self._initialized:
+        """Khởi tạo kết nối đến Pinecone, index handle và vector store một lần (lazy) rồi dùng lại."""
+        if self._initialized or self._disabled:
             return
 
-        api_key = os.getenv("PINECONE_API_KEY")
-        embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+        with self._lock:
+            if self._initialized or self._disabled or time.monotonic() < self._next_retry_at:
+                return
 
-        if not api_key or not embedding_deployment:
-            logger.warning("PINECONE_API_KEY hoặc AZURE_OPENAI_EMBEDDING_DEPLOYMENT chưa được cấu hình. Dịch vụ Pinecone đã bị vô hiệu hóa.")
-            return
+            api_key = os.getenv("PINECONE_API_KEY")
+            embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
 
-        try:
-            # Khởi tạo client Pinecone
-            self.client = PineconeClient(api_key=api_key)
+            if not api_key or not embedding_deployment:
+                logger.warning("PINECONE_API_KEY hoặc AZURE_OPENAI_EMBEDDING_DEPLOYMENT chưa được cấu hình. Dịch vụ Pinecone đã bị vô hiệu hóa.")
+                self._disabled = True
+                return
 
-            # Khởi tạo mô hình embeddings
-            self.embeddings = AzureOpenAIEmbeddings(
-                azure_deployment=embedding_deployment,
-                openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-06-01"),
-            )
+            try:
+                # Khởi tạo client Pinecone
+                client = PineconeClient(api_key=api_key)
 
-            # Kiểm tra và tạo index nếu cần
-            # Kiểm tra và tạo index nếu cần
-            if self.index_name not in self.client.list_indexes().names():
-                embedding_dimension = len(self.embeddings.embed_query("test"))
-                cloud = os.getenv("PINECONE_CLOUD", "aws")
-                region = os.getenv("PINECONE_REGION", "us-east-1")
-                self.client.create_index(
-                    name=self.index_name,
-                    dimension=embedding_dimension,
-                    metric="cosine",
-                    spec=ServerlessSpec(cloud=cloud, region=region)
+                # Khởi tạo mô hình embeddings (có cache để không embed lại cùng một nội dung)
+                # Giữ lại cache embedding qua các lần kết nối lại
+                embeddings = self.embeddings or CachedEmbeddings(
+                    AzureOpenAIEmbeddings(
+                        azure_deployment=embedding_deployment,
+                        openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-06-01"),
+                    ),
+                    model=embedding_deployment,
+                    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "2048")),
+                    persist=os.getenv("EMBEDDING_CACHE_PERSIST", "false").lower() == "true",
                 )
-                logger.info(f"Đã tạo chỉ mục Pinecone '{self.index_name}' với chiều {embedding_dimension} trên {cloud} tại {region}.")
-            
-            self._initialized = True
-            logger.info("Dịch vụ Pinecone đã được khởi tạo thành công.")
 
-        except Exception as e:
-            logger.error(f"Lỗi khi khởi tạo dịch vụ Pinecone: {e}")
+                # Kiểm tra và tạo index nếu cần
+                if self.index_name not in client.list_indexes().names():
+                    embedding_dimension = len(embeddings.embed_query("test"))
+                    cloud = os.getenv("PINECONE_CLOUD", "aws")
+                    region = os.getenv("PINECONE_REGION", "us-east-1")
+                    client.create_index(
+                        name=self.index_name,
+                        dimension=embedding_dimension,
+                        metric="cosine",
+                        spec=ServerlessSpec(cloud=cloud, region=region)
+                    )
+                    logger.info(f"Đã tạo chỉ mục Pinecone '{self.index_name}' với chiều {embedding_dimension} trên {cloud} tại {region}.")
+
+                # Giữ index handle và vector store dùng chung cho mọi request
+                index = client.Index(self.index_name)
+                self._vector_store = PineconeVectorStore(index=index, embedding=embeddings)
+                self._index = index
+                self.client = client
+                self.embeddings = embeddings
+                self._initialized = True
+                logger.info("Dịch vụ Pinecone đã được khởi tạo thành công.")
+
+            except Exception as e:
+                logger.error(f"Lỗi khi khởi tạo dịch vụ Pinecone: {e}")
+                self._next_retry_at = time.monotonic() + self._retry_interval
+
+    def refresh(self):
+        """Bỏ kết nối hiện tại để lần gọi sau tạo lại (dùng khi thao tác với Pinecone bị lỗi)."""
+        with self._lock:
+            if not self._initialized:
+                return
             self.client = None
+            self._index = None
+            self._vector_store = None
+            self._initialized = False
+            self._next_retry_at = 0.0
+        logger.warning("Đã reset kết nối Pinecone, sẽ kết nối lại ở lần gọi tiếp theo.")
 
     def get_vector_store(self) -> Optional[PineconeVectorStore]:
         """Lấy đối tượng LangChain VectorStore được kết nối với chỉ mục Pinecone."""
         self._initialize()
-        if not self.client or not self.embeddings:
-            return None
+        return self._vector_store
 
-        return PineconeVectorStore.from_existing_index(self.index_name, self.embeddings)
+    def is_configured(self) -> bool:
+        """Pinecone có được cấu hình không (không kết nối mạng, kể cả khi đang chờ kết nối lại)."""
+        if self._disabled:
+            return False
+        return bool(os.getenv("PINECONE_API_KEY") and os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"))
 
     def is_available(self) -> bool:
         """Kiểm tra xem dịch vụ có được cấu hình và sẵn sàng không."""
         if not self._initialized:
             self._initialize()
-        return self.client is not None
+        return self._initialized
+
+class ChatMemoryWriter:
+    """Hàng đợi write-behind để ghi tin nhắn chat vào Pinecone ở background.
+
+    Tin nhắn được lưu vào bảng ``vector_outbox`` trong SQLite trước (nên không mất khi restart),
+    sau đó một worker thread gom nhiều tin nhắn thành một lần ``add_texts`` (embedding + upsert theo lô).
+    Lô bị lỗi được thử lại với exponential backoff.
+    """
+
+    def __init__(self, service: PineconeService):
+        self.service = service
+        self.batch_size = int(os.getenv("PINECONE_UPSERT_BATCH_SIZE", "64"))
+        # Thời gian chờ gom thêm tin nhắn trước khi ghi một lô
+        self.linger_seconds = float(os.getenv("PINECONE_UPSERT_LINGER_SECONDS", "1.0"))
+        # Chu kỳ quét outbox kể cả khi không có tin nhắn mới (để thử lại các lô lỗi)
+        self.poll_seconds = float(os.getenv("PINECONE_UPSERT_POLL_SECONDS", "30"))
+        self.max_backoff_seconds = float(os.getenv("PINECONE_UPSERT_MAX_BACKOFF_SECONDS", "3600"))
+        # Số lần ghi lỗi tối đa trước khi bỏ tin nhắn khỏi outbox (tin nhắn vẫn còn trong chat_messages)
+        self.max_attempts = max(1, int(os.getenv("PINECONE_UPSERT_MAX_ATTEMPTS", "8")))
+        # Khi mất kết nối, dời lịch cả lô (không tính vào max_attempts) với backoff tối đa này
+        self.outage_backoff_seconds = float(os.getenv("PINECONE_UPSERT_OUTAGE_BACKOFF_SECONDS", "300"))
+        self._outage_failures = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, texts: List[str], metadatas: List[Dict[str, Any]], ids: List[str]) -> None:
+        """Lưu tin nhắn vào outbox và đánh thức worker."""
+        db.enqueue_vector_documents([
+            {"id": doc_id, "text": text, "metadata": metadata}
+            for text, metadata, doc_id in zip(texts, metadatas, ids)
+        ])
+        self.start()
+        self._wake.set()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="pinecone-write-behind", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Dừng worker sau khi thử ghi nốt các tin nhắn đang chờ."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if not thread:
+            return
+        self._stop.set()
+        self._wake.set()
+        thread.join(timeout)
+
+    def _run(self) -> None:
+        # Lần chạy đầu xử lý luôn các tin nhắn còn tồn từ lần chạy trước
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Lỗi trong worker ghi Pinecone: {e}")
+            if self._stop.is_set():
+                return
+            woke = self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            if woke and not self._stop.is_set():
+                self._stop.wait(self.linger_seconds)
+
+    def flush(self) -> int:
+        """Ghi tất cả tin nhắn đến hạn theo lô. Trả về số tin nhắn đã ghi."""
+        written = 0
+        while True:
+            batch = db.get_pending_vector_documents(self.batch_size)
+            if not batch:
+                return written
+            result = self._write_batch(batch)
+            if result is None:
+                # Mất kết nối: chờ tới lượt quét sau thay vì thử tiếp ngay
+                return written
+            written += result
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> Optional[int]:
+        """Ghi một lô; trả về số tin nhắn đã ghi, hoặc None nếu lỗi kết nối.
+
+        Lỗi không phải do kết nối (vd. một dòng không embed được) thì chia đôi lô để
+        các dòng còn lại vẫn được ghi; dòng lỗi được hẹn thử lại riêng.
+        """
+        try:
+            vector_store = self.service.get_vector_store()
+            if vector_store is None:
+                self._reschedule(batch, "Pinecone vector store không khả dụng")
+                return None
+            vector_store.add_texts(
+                texts=[doc["text"] for doc in batch],
+                metadatas=[doc["metadata"] for doc in batch],
+                ids=[doc["doc_id"] for doc in batch],
+            )
+        except Exception as e:
+            if _is_connection_error(e):
+                self.service.refresh()
+                self._reschedule(batch, str(e))
+                return None
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                first = self._write_batch(batch[:middle])
+                if first is None:
+                    return None
+                second = self._write_batch(batch[middle:])
+                return None if second is None else first + second
+            self._mark_failed(batch, str(e))
+            return 0
+
+        self._outage_failures = 0
+        db.delete_vector_documents([doc["id"] for doc in batch])
+        logger.info(f"Đã ghi {len(batch)} tin nhắn vào Pinecone")
+        return len(batch)
+
+    def _reschedule(self, batch: List[Dict[str, Any]], error: str) -> None:
+        """Pinecone không khả dụng: dời lịch cả lô mà không tăng attempts, để sự cố kéo dài không làm mất tin nhắn."""
+        self._outage_failures += 1
+        delay = min(self.outage_backoff_seconds, 2 ** self._outage_failures)
+        retry_at = (datetime.utcnow() + timedelta(seconds=delay)).isoformat()
+        db.mark_vector_documents_failed([doc["id"] for doc in batch], error, retry_at, count_attempt=False)
+        logger.warning(f"Không kết nối được Pinecone (lần {self._outage_failures}), thử lại {len(batch)} tin nhắn sau {delay:.0f}s: {error}")
+
+    def _mark_failed(self, batch: List[Dict[str, Any]], error: str) -> None:
+        """Dòng bị Pinecone từ chối: hẹn thử lại với exponential backoff, quá max_attempts lần thì bỏ khỏi outbox."""
+        dropped = [doc for doc in batch if doc["attempts"] + 1 >= self.max_attempts]
+        if dropped:
+            db.delete_vector_documents([doc["id"] for doc in dropped])
+            logger.error(
+                f"Bỏ {len(dropped)} tin nhắn khỏi outbox Pinecone sau {self.max_attempts} lần ghi lỗi "
+                f"({', '.join(doc['doc_id'] for doc in dropped)}): {error}"
+            )
+
+        dropped_ids = {doc["id"] for doc in dropped}
+        by_attempts: Dict[int, List[int]] = {}
+        for doc in batch:
+            if doc["id"] not in dropped_ids:
+                by_attempts.setdefault(doc["attempts"] + 1, []).append(doc["id"])
+        for attempts, outbox_ids in by_attempts.items():
+            delay = min(self.max_backoff_seconds, 2 ** attempts)
+            retry_at = (datetime.utcnow() + timedelta(seconds=delay)).isoformat()
+            db.mark_vector_documents_failed(outbox_ids, error, retry_at)
+            logger.warning(f"Ghi {len(outbox_ids)} tin nhắn vào Pinecone thất bại (lần {attempts}), thử lại sau {delay:.0f}s: {error}")
+
+
+def _is_connection_error(error: Exception) -> bool:
+    """Lỗi mạng/transport (cần kết nối lại) khác với lỗi dữ liệu của từng dòng"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    names = " ".join(cls.__name__ for cls in type(error).__mro__)
+    return any(marker in names for marker in ("Connection", "Timeout", "ProtocolError", "MaxRetry", "ServiceUnavailable"))
+
 
 # Tạo một instance singleton để sử dụng trong toàn bộ ứng dụng
 pinecone_service = PineconeService()
+chat_memory_writer = ChatMemoryWriter(pinecone_service)
 
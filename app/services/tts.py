@@ -4,34 +4,202 @@ Text-to-Speech service using Azure Speech Services
 import os
 import io
 import base64
+import queue
 import logging
-from typing import Optional
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, Iterator, Optional, Tuple, Union
 
 try:
     import azure.cognitiveservices.speech as speechsdk
 except ImportError:
     raise RuntimeError("Missing dependency 'azure-cognitiveservices-speech'. Please install with: pip install azure-cognitiveservices-speech")
 
+from .audio_cache import audio_cache
+from .tts_text import normalize_for_tts, split_sentences
+
 # Logging configuration
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("azure_tts")
 
 
+class _FileAudioCallback(speechsdk.audio.PullAudioInputStreamCallback):
+    """Cho SDK đọc audio trực tiếp từ file theo từng đoạn (không cần copy cả file vào bộ nhớ)"""
+
+    def __init__(self, audio_file: BinaryIO):
+        super().__init__()
+        self.audio_file = audio_file
+
+    def read(self, buffer: memoryview) -> int:
+        data = self.audio_file.read(buffer.nbytes)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        pass
+
+
+class SynthesizerPool:
+    """Pool các SpeechSynthesizer đã mở kết nối sẵn tới Azure.
+
+    Mỗi synthesizer chỉ được một request dùng tại một thời điểm. Tối đa ``size`` synthesizer
+    được dùng đồng thời: khi đã đủ, borrow() chờ tới khi có synthesizer được trả về; synthesizer
+    lỗi bị bỏ và lần mượn sau tạo cái mới thay thế.
+    """
+
+    def __init__(self, speech_config, size: int):
+        self.speech_config = speech_config
+        self.size = size
+        self._idle: "queue.LifoQueue" = queue.LifoQueue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _create(self):
+        synthesizer = speechsdk.SpeechSynthesizer(
+            speech_config=self.speech_config,
+            audio_config=None  # Sử dụng default để lấy audio data
+        )
+        try:
+            # Mở trước websocket để request đầu tiên không phải chờ bắt tay TLS/WebSocket
+            speechsdk.Connection.from_speech_synthesizer(synthesizer).open(True)
+        except Exception as e:
+            logger.warning(f"Failed to pre-connect speech synthesizer: {str(e)}")
+        return synthesizer
+
+    def prefill(self) -> None:
+        while not self._idle.full():
+            try:
+                self._idle.put_nowait(self._create())
+            except queue.Full:
+                return
+
+    @contextmanager
+    def borrow(self):
+        self._slots.acquire()
+        try:
+            try:
+                synthesizer = self._idle.get_nowait()
+            except queue.Empty:
+                synthesizer = self._create()
+            healthy = True
+            try:
+                yield synthesizer
+            except BaseException:
+                # Synthesizer lỗi (mất kết nối...) hoặc bị bỏ giữa chừng không được đưa lại vào pool
+                healthy = False
+                raise
+            finally:
+                synthesizer.synthesizing.disconnect_all()
+                synthesizer.synthesis_completed.disconnect_all()
+                synthesizer.synthesis_canceled.disconnect_all()
+                if healthy:
+                    try:
+                        self._idle.put_nowait(synthesizer)
+                    except queue.Full:
+                        pass
+        finally:
+            self._slots.release()
+
+
+class StreamingRecognitionSession:
+    """Phiên nhận diện giọng nói liên tục: audio được đẩy vào theo từng frame khi client gửi tới,
+    kết quả tạm thời (partial) và cuối cùng (final) được trả về qua callback ``on_event``.
+
+    ``on_event`` được gọi từ thread của Speech SDK với dict dạng ``{"type": ..., "text": ...}``.
+    """
+
+    # pcm: PCM16 16kHz mono (không cần thư viện ngoài); ogg: Ogg/Opus; webm/any: container bất kỳ (cần GStreamer)
+    SUPPORTED_FORMATS = ("pcm", "ogg", "webm")
+
+    def __init__(self, recognition_config, on_event: Callable[[Dict[str, Any]], None], audio_format: str = "pcm"):
+        if audio_format == "pcm":
+            stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=16000, bits_per_sample=16, channels=1)
+        elif audio_format == "ogg":
+            stream_format = speechsdk.audio.AudioStreamFormat(
+                compressed_stream_format=speechsdk.AudioStreamContainerFormat.OGG_OPUS
+            )
+        elif audio_format == "webm":
+            stream_format = speechsdk.audio.AudioStreamFormat(
+                compressed_stream_format=speechsdk.AudioStreamContainerFormat.ANY
+            )
+        else:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+
+        self.on_event = on_event
+        self.audio_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+        self.recognizer = speechsdk.SpeechRecognizer(
+            speech_config=recognition_config,
+            audio_config=speechsdk.audio.AudioConfig(stream=self.audio_stream)
+        )
+        self.recognizer.recognizing.connect(self._on_recognizing)
+        self.recognizer.recognized.connect(self._on_recognized)
+        self.recognizer.canceled.connect(self._on_canceled)
+        self.recognizer.session_stopped.connect(lambda evt: self.on_event({"type": "end"}))
+        self._stopped = False
+
+    def _on_recognizing(self, evt) -> None:
+        if evt.result.text:
+            self.on_event({"type": "partial", "text": evt.result.text})
+
+    def _on_recognized(self, evt) -> None:
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+            logger.info(f"Recognized: {evt.result.text}")
+            self.on_event({"type": "final", "text": evt.result.text})
+
+    def _on_canceled(self, evt) -> None:
+        if evt.reason == speechsdk.CancellationReason.Error:
+            logger.error(f"Speech recognition canceled: {evt.error_details}")
+            self.on_event({"type": "error", "error": evt.error_details})
+
+    def start(self) -> None:
+        self.recognizer.start_continuous_recognition_async().get()
+
+    def write(self, audio_chunk: bytes) -> None:
+        if audio_chunk and not self._stopped:
+            self.audio_stream.write(audio_chunk)
+
+    def stop(self) -> None:
+        """Đóng audio stream (để nhận nốt kết quả cuối) rồi dừng recognizer"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self.audio_stream.close()
+        self.recognizer.stop_continuous_recognition_async().get()
+
+
 class AzureSpeechService:
     def __init__(self):
         self.speech_config = None
+        self.recognition_config = None
+        self.synthesizer_pool: Optional[SynthesizerPool] = None
         self._initialized = False
+        self._init_lock = threading.Lock()
         
         # Azure Speech Service configuration
         self.speech_key = os.getenv("AZURE_SPEECH_KEY")
         self.speech_region = os.getenv("AZURE_SPEECH_REGION", "southeastasia")
         self.voice_name = "vi-VN-HoaiMyNeural"  # Vietnamese Neural voice
+        self.output_format = "Audio16Khz32KBitRateMonoMp3"
+        self.prosody_rate = "0.9"
+        
+        # Văn bản dài được tách theo câu và tổng hợp song song
+        self.chunk_max_chars = int(os.getenv("AZURE_TTS_CHUNK_MAX_CHARS", "300"))
+        self.max_parallel = int(os.getenv("AZURE_TTS_MAX_PARALLEL", "4"))
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.pool_size = int(os.getenv("AZURE_SPEECH_POOL_SIZE", str(self.max_parallel)))
+        # Thời gian chờ tối đa giữa hai gói audio khi stream (SDK không gửi sự kiện kết thúc thì báo lỗi)
+        self.stream_packet_timeout = float(os.getenv("AZURE_TTS_STREAM_TIMEOUT_SECONDS", "30"))
         
     def _initialize_service(self):
         """Khởi tạo Azure Speech Service (lazy loading)"""
         if self._initialized:
             return
-            
+        
+        with self._init_lock:
+            if not self._initialized:
+                self._create_configs()
+    
+    def _create_configs(self):
         if not self.speech_key:
             logger.error("AZURE_SPEECH_KEY not found in environment variables")
             raise ValueError("Azure Speech Key is required. Please set AZURE_SPEECH_KEY environment variable")
@@ -46,8 +214,17 @@ class AzureSpeechService:
             # Cấu hình voice và audio format
             self.speech_config.speech_synthesis_voice_name = self.voice_name
             self.speech_config.set_speech_synthesis_output_format(
-                speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
+                getattr(speechsdk.SpeechSynthesisOutputFormat, self.output_format)
             )
+            self.synthesizer_pool = SynthesizerPool(self.speech_config, self.pool_size)
+            threading.Thread(target=self.synthesizer_pool.prefill, name="azure-tts-prefill", daemon=True).start()
+            
+            # Cấu hình recognition dùng chung cho mọi request
+            self.recognition_config = speechsdk.SpeechConfig(
+                subscription=self.speech_key,
+                region=self.speech_region
+            )
+            self.recognition_config.speech_recognition_language = "vi-VN"
             
             self._initialized = True
             logger.info(f"Azure Speech Service initialized successfully with voice: {self.voice_name}")
@@ -56,72 +233,173 @@ class AzureSpeechService:
             logger.error(f"Error initializing Azure Speech Service: {str(e)}")
             raise
     
-    def text_to_speech(self, text: str, max_length: int = 1000) -> Optional[str]:
+    def text_to_speech(self, text: str) -> Optional[str]:
         """
         Chuyển đổi text thành audio sử dụng Azure Speech Service
         
         Args:
-            text: Văn bản cần chuyển đổi
-            max_length: Độ dài tối đa của text
+            text: Văn bản cần chuyển đổi (không giới hạn độ dài, văn bản dài được tách theo câu)
             
         Returns:
             Base64 encoded audio data URL hoặc None nếu có lỗi
         """
         if not text or not text.strip():
             return None
-            
-        # Cắt ngắn text nếu quá dài
-        if len(text) > max_length:
-            text = text[:max_length] + "..."
         
         try:
-            # Khởi tạo service nếu chưa được tải
-            self._initialize_service()
-            
-            # Tiền xử lý text
-            text = self._preprocess_text(text)
-            
-            # Tạo SSML để có thể điều chỉnh giọng nói
-            ssml = self._create_ssml(text)
-            
-            # Tạo synthesizer
-            synthesizer = speechsdk.SpeechSynthesizer(
-                speech_config=self.speech_config,
-                audio_config=None  # Sử dụng default để lấy audio data
-            )
-            
-            # Sinh audio
-            logger.info(f"Synthesizing text: {text[:50]}...")
-            result = synthesizer.speak_ssml_async(ssml).get()
-            
-            if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-                # Chuyển đổi audio data thành base64
-                audio_data = result.audio_data
-                audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-                
-                # Trả về data URL cho MP3
-                return f"data:audio/mp3;base64,{audio_base64}"
-                
-            elif result.reason == speechsdk.ResultReason.Canceled:
-                cancellation_details = speechsdk.CancellationDetails(result)
-                logger.error(f"Speech synthesis canceled: {cancellation_details.reason}")
-                if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                    logger.error(f"Error details: {cancellation_details.error_details}")
-                return None
-            else:
-                logger.error(f"Unexpected result reason: {result.reason}")
-                return None
-                
+            result = self.synthesize(text)
+            return self._to_data_url(result[1]) if result else None
         except Exception as e:
             logger.error(f"Azure TTS error: {str(e)}")
             return None
     
+    def synthesize(self, text: str) -> Optional[Tuple[str, bytes]]:
+        """Tổng hợp toàn bộ text thành MP3 (các đoạn MP3 được nối liền nhau).
+        
+        Returns:
+            (audio_id, audio bytes); audio_id là key trong audio cache, dùng cho URL /api/audio/{audio_id}
+        """
+        # Tiền xử lý text
+        text = self._preprocess_text(text)
+        if not text:
+            return None
+        
+        # Trả về ngay nếu nội dung này đã được tổng hợp trước đó
+        cache_key = self._cache_key(text)
+        cached_audio = audio_cache.get(cache_key)
+        if cached_audio is not None:
+            return cache_key, cached_audio
+        
+        audio_data = b"".join(self._iter_chunks(text))
+        audio_cache.put(cache_key, audio_data)
+        return cache_key, audio_data
+    
+    def iter_audio_chunks(self, text: str) -> Iterator[bytes]:
+        """Tổng hợp từng câu song song và trả về MP3 bytes theo đúng thứ tự.
+        
+        Câu đầu tiên được stream theo từng gói audio mà SDK trả về (sự kiện synthesizing),
+        các câu sau được tổng hợp song song trong lúc đó.
+        """
+        text = self._preprocess_text(text)
+        if not text:
+            return
+        yield from self._iter_chunks(text, stream_first=True)
+    
+    def _iter_chunks(self, text: str, stream_first: bool = False) -> Iterator[bytes]:
+        chunks = split_sentences(text, self.chunk_max_chars)
+        if not chunks:
+            return
+        if len(chunks) == 1 and not stream_first:
+            yield self._synthesize_chunk(chunks[0])
+            return
+        
+        futures = [self._get_executor().submit(self._synthesize_chunk, chunk) for chunk in chunks[1:]]
+        try:
+            if stream_first:
+                yield from self._stream_chunk(chunks[0])
+            else:
+                yield self._synthesize_chunk(chunks[0])
+            for future in futures:
+                yield future.result()
+        finally:
+            # Client ngắt kết nối hoặc có lỗi: hủy các câu chưa bắt đầu
+            for future in futures:
+                future.cancel()
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="azure-tts")
+        return self._executor
+    
+    def _cache_key(self, text: str) -> str:
+        return audio_cache.make_key("azure", f"{self.voice_name}@{self.prosody_rate}", self.output_format, text)
+    
+    def _synthesize_chunk(self, text: str) -> bytes:
+        """Tổng hợp một đoạn text (đã tiền xử lý) thành MP3 bytes"""
+        cache_key = self._cache_key(text)
+        cached_audio = audio_cache.get(cache_key)
+        if cached_audio is not None:
+            return cached_audio
+        
+        # Khởi tạo service nếu chưa được tải
+        self._initialize_service()
+        
+        # Tạo SSML để có thể điều chỉnh giọng nói
+        ssml = self._create_ssml(text)
+        
+        # Sinh audio bằng synthesizer mượn từ pool
+        logger.info(f"Synthesizing text: {text[:50]}...")
+        with self.synthesizer_pool.borrow() as synthesizer:
+            result = synthesizer.speak_ssml_async(ssml).get()
+            audio_data = self._check_result(result)
+        
+        audio_cache.put(cache_key, audio_data)
+        return audio_data
+    
+    def _stream_chunk(self, text: str) -> Iterator[bytes]:
+        """Tổng hợp một đoạn text và trả về từng gói MP3 ngay khi SDK sinh ra"""
+        cache_key = self._cache_key(text)
+        cached_audio = audio_cache.get(cache_key)
+        if cached_audio is not None:
+            yield cached_audio
+            return
+        
+        self._initialize_service()
+        ssml = self._create_ssml(text)
+        done = object()
+        packets: "queue.Queue" = queue.Queue()
+        
+        logger.info(f"Streaming synthesis for text: {text[:50]}...")
+        with self.synthesizer_pool.borrow() as synthesizer:
+            synthesizer.synthesizing.connect(lambda evt: packets.put(evt.result.audio_data))
+            synthesizer.synthesis_completed.connect(lambda evt: packets.put(done))
+            synthesizer.synthesis_canceled.connect(lambda evt: packets.put(done))
+            
+            result_future = synthesizer.speak_ssml_async(ssml)
+            streamed = bytearray()
+            while True:
+                try:
+                    packet = packets.get(timeout=self.stream_packet_timeout)
+                except queue.Empty:
+                    # Synthesizer bị coi là lỗi và không được trả lại pool
+                    raise TimeoutError(
+                        f"Azure TTS không trả về audio sau {self.stream_packet_timeout:g} giây"
+                    ) from None
+                if packet is done:
+                    break
+                if packet:
+                    streamed.extend(packet)
+                    yield packet
+            
+            audio_data = self._check_result(result_future.get())
+        
+        audio_cache.put(cache_key, audio_data or bytes(streamed))
+    
+    def _check_result(self, result) -> bytes:
+        """Trả về audio nếu tổng hợp thành công, ngược lại raise RuntimeError"""
+        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+            return result.audio_data
+        
+        if result.reason == speechsdk.ResultReason.Canceled:
+            cancellation_details = speechsdk.CancellationDetails(result)
+            logger.error(f"Speech synthesis canceled: {cancellation_details.reason}")
+            if cancellation_details.reason == speechsdk.CancellationReason.Error:
+                logger.error(f"Error details: {cancellation_details.error_details}")
+            raise RuntimeError(f"Speech synthesis canceled: {cancellation_details.reason}")
+        
+        raise RuntimeError(f"Unexpected result reason: {result.reason}")
+    
+    def _to_data_url(self, audio_data: bytes) -> str:
+        """Chuyển audio MP3 thành base64 data URL"""
+        audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+        return f"data:audio/mp3;base64,{audio_base64}"
+    
     def _create_ssml(self, text: str) -> str:
         """Tạo SSML cho Azure Speech Service"""
         ssml = f"""
         <speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="vi-VN">
             <voice name="{self.voice_name}">
-                <prosody rate="0.9" pitch="+0%">
+                <prosody rate="{self.prosody_rate}" pitch="+0%">
                     {text}
                 </prosody>
             </voice>
@@ -131,41 +409,7 @@ class AzureSpeechService:
     
     def _preprocess_text(self, text: str) -> str:
         """Tiền xử lý text cho TTS tiếng Việt"""
-        # Loại bỏ các ký tự đặc biệt không cần thiết
-        text = text.strip()
-        
-        # Thay thế một số từ viết tắt phổ biến cho tiếng Việt
-        replacements = {
-            "kg": "ki-lô-gam",
-            "cm": "xen-ti-mét", 
-            "mm": "mi-li-mét",
-            "km": "ki-lô-mét",
-            "°C": "độ C",
-            "%": "phần trăm",
-            "&": "và",
-            "@": "a còng",
-            "vs": "so với",
-            "AI": "A-I",
-            "API": "A-P-I",
-            "URL": "U-R-L",
-            "=": "bằng",
-            "HTTP": "H-T-T-P",
-        }
-        
-        for old, new in replacements.items():
-            text = text.replace(old, new)
-        
-        # Loại bỏ markdown formatting
-        text = text.replace("**", "").replace("*", "").replace("_", "")
-        text = text.replace("```", "").replace("`", "")
-        
-        # Loại bỏ các ký tự đặc biệt có thể gây lỗi SSML
-        text = text.replace("<", "").replace(">", "").replace("&", "và")
-        
-        # Loại bỏ dấu xuống dòng liên tiếp
-        text = " ".join(text.split())
-        
-        return text
+        return normalize_for_tts(text)
     
     def is_available(self) -> bool:
         """Kiểm tra xem Azure Speech Service có khả dụng không"""
@@ -175,12 +419,12 @@ class AzureSpeechService:
         except ImportError:
             return False
     
-    def speech_to_text(self, audio_data: bytes) -> Optional[str]:
+    def speech_to_text(self, audio: Union[bytes, BinaryIO]) -> Optional[str]:
         """
         Chuyển đổi audio thành text sử dụng Azure Speech Service
         
         Args:
-            audio_data: Raw audio data (WAV format)
+            audio: Raw audio data (WAV format), dạng bytes hoặc file đã mở (SDK đọc dần từ file)
             
         Returns:
             Recognized text hoặc None nếu có lỗi
@@ -189,37 +433,34 @@ class AzureSpeechService:
             # Khởi tạo service nếu chưa được tải
             self._initialize_service()
             
-            # Tạo audio input stream từ audio data
-            audio_stream = speechsdk.audio.PushAudioInputStream()
-            audio_config = speechsdk.audio.AudioConfig(stream=audio_stream)
+            if isinstance(audio, (bytes, bytearray)):
+                audio = io.BytesIO(audio)
+            header = audio.read(100)
+            audio.seek(0, os.SEEK_END)
+            audio_size = audio.tell()
+            audio.seek(0)
             
-            # Cấu hình recognition
-            recognition_config = speechsdk.SpeechConfig(
-                subscription=self.speech_key,
-                region=self.speech_region
-            )
-            recognition_config.speech_recognition_language = "vi-VN"
+            # SDK kéo audio từ file qua callback thay vì nhận một bản copy bytes
+            audio_stream = speechsdk.audio.PullAudioInputStream(_FileAudioCallback(audio))
+            audio_config = speechsdk.audio.AudioConfig(stream=audio_stream)
             
-            # Tạo recognizer
+            # Tạo recognizer (recognizer gắn với audio stream của request nên không dùng lại được,
+            # nhưng SpeechConfig thì dùng chung)
             recognizer = speechsdk.SpeechRecognizer(
-                speech_config=recognition_config,
+                speech_config=self.recognition_config,
                 audio_config=audio_config
             )
             
-            # Push audio data
-            audio_stream.write(audio_data)
-            audio_stream.close()
-            
             # Thực hiện recognition
-            logger.info(f"Starting speech recognition... Audio size: {len(audio_data)} bytes")
+            logger.info(f"Starting speech recognition... Audio size: {audio_size} bytes")
             
             # Detect audio format for debugging
             audio_format = "unknown"
-            if audio_data.startswith(b'RIFF'):
+            if header.startswith(b'RIFF'):
                 audio_format = "WAV"
-            elif audio_data.startswith(b'OggS'):
+            elif header.startswith(b'OggS'):
                 audio_format = "OGG"  
-            elif b'webm' in audio_data[:100].lower():
+            elif b'webm' in header.lower():
                 audio_format = "WebM"
                 
             logger.info(f"Detected audio format: {audio_format}")
@@ -246,6 +487,11 @@ class AzureSpeechService:
             logger.error(f"Speech recognition error: {str(e)}")
             return None
     
+    def create_recognition_session(self, on_event: Callable[[Dict[str, Any]], None], audio_format: str = "pcm") -> StreamingRecognitionSession:
+        """Tạo phiên nhận diện liên tục dùng chung SpeechConfig của service"""
+        self._initialize_service()
+        return StreamingRecognitionSession(self.recognition_config, on_event, audio_format)
+    
     def get_available_voices(self):
         """Lấy danh sách giọng nói Vietnamese có sẵn"""
         return [
@@ -271,17 +517,31 @@ def generate_audio(text: str) -> Optional[str]:
     return azure_speech_service.text_to_speech(text)
 
 
-def recognize_speech(audio_data: bytes) -> Optional[str]:
+def generate_audio_bytes(text: str) -> Optional[Tuple[str, bytes]]:
+    """Helper function để sinh MP3 bytes từ text, trả về (audio_id, audio) hoặc None"""
+    try:
+        return azure_speech_service.synthesize(text)
+    except Exception as e:
+        logger.error(f"Azure TTS error: {str(e)}")
+        return None
+
+
+def stream_audio(text: str) -> Iterator[bytes]:
+    """Helper function để stream MP3 từ text, từng câu một"""
+    return azure_speech_service.iter_audio_chunks(text)
+
+
+def recognize_speech(audio: Union[bytes, BinaryIO]) -> Optional[str]:
     """
     Helper function để nhận diện giọng nói thành text
     
     Args:
-        audio_data: Raw audio data (WAV format)
+        audio: Raw audio data (WAV format), dạng bytes hoặc file đã mở
         
     Returns:
         Recognized text hoặc None
     """
-    return azure_speech_service.speech_to_text(audio_data)
+    return azure_speech_service.speech_to_text(audio)
 
 
 def is_speech_available() -> bool:
@@ -0,0 +1,261 @@
+"""
+Xử lý văn bản dùng chung cho các dịch vụ TTS (chuẩn hóa và tách câu tiếng Việt)
+"""
+import os
+import re
+from functools import lru_cache
+from typing import List
+
+# Ranh giới câu: dấu kết thúc câu (kể cả "..." và "…") theo sau bởi khoảng trắng
+_SENTENCE_END = re.compile(r"(?<=[.!?…;:])\s+")
+# Ranh giới phụ để tách câu quá dài
+_CLAUSE_END = re.compile(r"(?<=[,–—])\s+")
+
+
+def _hard_split(text: str, max_chars: int) -> List[str]:
+    """Tách câu dài theo dấu phẩy, nếu vẫn dài thì theo khoảng trắng"""
+    pieces: List[str] = []
+    for clause in _CLAUSE_END.split(text):
+        while len(clause) > max_chars:
+            cut = clause.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(clause[:cut].strip())
+            clause = clause[cut:].strip()
+        if clause:
+            pieces.append(clause)
+    return _merge(pieces, max_chars)
+
+
+def _merge(pieces: List[str], max_chars: int) -> List[str]:
+    """Gộp các đoạn ngắn liền nhau miễn là không vượt quá max_chars"""
+    chunks: List[str] = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + 1 + len(piece) <= max_chars:
+            chunks[-1] = f"{chunks[-1]} {piece}"
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+def split_sentences(text: str, max_chars: int = 200) -> List[str]:
+    """Tách văn bản thành các đoạn theo ranh giới câu, mỗi đoạn tối đa max_chars ký tự.
+
+    Câu ngắn được gộp lại để giảm số lần tổng hợp; câu dài hơn max_chars được tách tiếp
+    theo dấu phẩy rồi theo khoảng trắng. Không bỏ mất nội dung nào.
+    """
+    text = " ".join(text.split())
+    if not text:
+        return []
+
+    pieces: List[str] = []
+    for sentence in _SENTENCE_END.split(text):
+        if len(sentence) > max_chars:
+            pieces.extend(_hard_split(sentence, max_chars))
+        elif sentence:
+            pieces.append(sentence)
+    return _merge(pieces, max_chars)
+
+
+# ====== CHUẨN HÓA VĂN BẢN CHO TTS ======
+
+_DIGITS = ["không", "một", "hai", "ba", "bốn", "năm", "sáu", "bảy", "tám", "chín"]
+_SCALES = ["", "nghìn", "triệu", "tỷ"]
+
+# Từ/ký hiệu được đọc thành chữ (chỉ khớp nguyên từ, không khớp bên trong từ khác)
+_WORD_REPLACEMENTS = {
+    "kg": "ki-lô-gam",
+    "cm": "xen-ti-mét",
+    "mm": "mi-li-mét",
+    "km": "ki-lô-mét",
+    "vs": "so với",
+    "AI": "A-I",
+    "API": "A-P-I",
+    "URL": "U-R-L",
+    "HTTP": "H-T-T-P",
+}
+
+_SYMBOL_REPLACEMENTS = {
+    "°C": "độ C",
+    "%": "phần trăm",
+    "&": "và",
+    "@": "a còng",
+    "=": "bằng",
+}
+
+# Mỗi bước là một lượt rẻ (str.replace/str.split hoặc regex bắt đầu bằng ký tự cố định) và chỉ
+# chạy khi văn bản có ký tự liên quan, thay vì một regex lớn phải thử mọi nhánh tại mọi vị trí
+_LINK = re.compile(r"\[([^\]\n]*)\]\([^)\n]*\)")
+_UNDERSCORES = re.compile(r"_+")
+# Heading/gạch đầu dòng ở đầu dòng (văn bản được thêm "\n" ở đầu để khớp cả dòng đầu tiên)
+_HEADING = re.compile(r"\n(?:#{1,6}|[-+•])[ \t]+")
+_NUMBER = re.compile(r"([0-9]+(?:[.,][0-9]+)*)")
+_THOUSANDS = re.compile(r"[0-9]{1,3}(?:\.[0-9]{3})+")
+_DIGIT_RUN = re.compile(r"[0-9]+")
+
+
+def _read_triple(number: int, full: bool) -> List[str]:
+    """Đọc số có 3 chữ số; full=True khi không phải nhóm đầu tiên (đọc cả "không trăm", "linh")"""
+    hundreds, tens, units = number // 100, number // 10 % 10, number % 10
+    words: List[str] = []
+    if hundreds or full:
+        words += [_DIGITS[hundreds], "trăm"]
+    if tens == 0:
+        if units and words:
+            words.append("linh")
+    elif tens == 1:
+        words.append("mười")
+    else:
+        words += [_DIGITS[tens], "mươi"]
+    if units == 1 and tens > 1:
+        words.append("mốt")
+    elif units == 5 and tens > 0:
+        words.append("lăm")
+    elif units:
+        words.append(_DIGITS[units])
+    return words
+
+
+@lru_cache(maxsize=4096)
+def read_number(digits: str) -> str:
+    """Đọc chuỗi chữ số thành chữ tiếng Việt (số dài hoặc có số 0 ở đầu được đọc từng chữ số)"""
+    if len(digits) > 12 or (len(digits) > 1 and digits.startswith("0")):
+        return " ".join(_DIGITS[int(d)] for d in digits)
+    number = int(digits)
+    if number == 0:
+        return _DIGITS[0]
+
+    groups = []
+    while number:
+        groups.append(number % 1000)
+        number //= 1000
+
+    words: List[str] = []
+    for scale in range(len(groups) - 1, -1, -1):
+        group = groups[scale]
+        if not group:
+            continue
+        words += _read_triple(group, full=bool(words))
+        if _SCALES[scale]:
+            words.append(_SCALES[scale])
+    return " ".join(words)
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+@lru_cache(maxsize=4096)
+def _spell_number(value: str) -> str:
+    """Đọc một cụm số (có thể có dấu chấm/phẩy) thành chữ"""
+    if value.isdigit():
+        return read_number(value)
+    if _THOUSANDS.fullmatch(value):
+        # 1.000.000 (dấu chấm phân cách hàng nghìn)
+        return read_number(value.replace(".", ""))
+    parts = re.split(r"[.,]", value)
+    if len(parts) == 2:
+        # 1,5 hoặc 1.5 (số thập phân)
+        return f"{read_number(parts[0])} phẩy {read_number(parts[1])}"
+    # Dãy số kiểu 1.2.3: đọc từng số, giữ nguyên dấu phân cách
+    return _DIGIT_RUN.sub(lambda m: read_number(m.group()), value)
+
+
+def _replace_numbers(text: str) -> str:
+    """Đọc số thành chữ; thêm khoảng trắng khi số dính liền với chữ (vd. "70kg" -> "bảy mươi kg")"""
+    parts = _NUMBER.split(text)
+    for i in range(1, len(parts), 2):
+        words = _spell_number(parts[i])
+        if parts[i - 1][-1:].isalpha():
+            words = " " + words
+        if parts[i + 1][:1].isalnum():
+            words += " "
+        parts[i] = words
+    return "".join(parts)
+
+
+def _replace_word(text: str, word: str, replacement: str) -> str:
+    """Thay từ/viết tắt chỉ khi nó không dính với chữ khác (vd. "pkg", "kgs" thì giữ nguyên).
+
+    Ranh giới với số đã được bước đọc số đệm khoảng trắng.
+    """
+    parts = text.split(word)
+    out = [parts[0]]
+    for i in range(1, len(parts)):
+        before = parts[i - 1][-1:] or (word[-1] if i > 1 else "")
+        after = parts[i][:1] or (word[0] if i < len(parts) - 1 else "")
+        standalone = not before.isalpha() and not _is_word_char(after)
+        out.append(replacement if standalone else word)
+        out.append(parts[i])
+    return "".join(out)
+
+
+def _replace_symbol(text: str, symbol: str, replacement: str) -> str:
+    """Thay ký hiệu, thêm khoảng trắng khi nó dính liền với chữ/số (vd. "70%")"""
+    parts = text.split(symbol)
+    out = [parts[0]]
+    for i in range(1, len(parts)):
+        left = " " if parts[i - 1][-1:].isalnum() else ""
+        right = " " if parts[i][:1].isalnum() else ""
+        out.append(f"{left}{replacement}{right}")
+        out.append(parts[i])
+    return "".join(out)
+
+
+def _strip_underscores(match: "re.Match") -> str:
+    """Chỉ bỏ dấu _ dùng để nhấn mạnh; giữ lại _ nằm giữa một từ (snake_case, file_name)"""
+    text, start, end = match.string, match.start(), match.end()
+    if 0 < start and end < len(text) and text[start - 1].isalnum() and text[end].isalnum():
+        return match.group()
+    return ""
+
+
+# Dấu câu thường dính vào từ; chuẩn hóa không thay đổi các ký tự này
+_PUNCTUATION = ".,;:!?()\"'"
+
+
+@lru_cache(maxsize=8192)
+def _normalize_token(token: str) -> str:
+    """Chuẩn hóa một cụm không chứa khoảng trắng (mọi bước dưới đây chỉ phụ thuộc ký tự trong cụm)"""
+    core = token.strip(_PUNCTUATION)
+    if core.isalpha() and core not in _WORD_REPLACEMENTS:
+        # Từ thường dính dấu câu ("bạn.", "(khoảng"): không có gì để thay
+        return token
+    if "`" in token:
+        token = token.replace("`", "")
+    if "*" in token:
+        token = token.replace("*", "")
+    if "_" in token:
+        token = _UNDERSCORES.sub(_strip_underscores, token)
+    if "<" in token or ">" in token:
+        token = token.replace("<", "").replace(">", "")
+    token = _replace_numbers(token)
+    for word, replacement in _WORD_REPLACEMENTS.items():
+        if word in token:
+            token = _replace_word(token, word, replacement)
+    for symbol, replacement in _SYMBOL_REPLACEMENTS.items():
+        if symbol in token:
+            token = _replace_symbol(token, symbol, replacement)
+    return " ".join(token.split())
+
+
+@lru_cache(maxsize=int(os.getenv("TTS_NORMALIZER_CACHE_SIZE", "1024")))
+def normalize_for_tts(text: str) -> str:
+    """Chuẩn hóa văn bản cho TTS tiếng Việt.
+
+    Bỏ markdown (code fence, **, _ nhấn mạnh, `, heading, link giữ lại chữ), đọc số thành chữ
+    (kể cả số thập phân và dấu chấm hàng nghìn), đọc đơn vị/viết tắt khi đứng thành từ riêng,
+    thay ký hiệu và gộp khoảng trắng.
+
+    Sau khi xử lý link/heading (có thể chứa khoảng trắng), văn bản được tách theo khoảng trắng:
+    cụm chỉ gồm chữ cái (phần lớn văn bản) giữ nguyên, các cụm còn lại đi qua _normalize_token
+    (được memoize theo cụm). Kết quả cả đoạn cũng được memoize cho các input lặp lại.
+    """
+    if "[" in text:
+        text = _LINK.sub(r"\1", text)
+    tokens = [
+        token if token.isalpha() and token not in _WORD_REPLACEMENTS else _normalize_token(token)
+        for token in _HEADING.sub("\n", "\n" + text).split()
+    ]
+    # Cụm chỉ gồm markup (vd. "**") trở thành rỗng
+    return " ".join(filter(None, tokens))
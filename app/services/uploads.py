@@ -0,0 +1,170 @@
+"""
+Xử lý upload theo luồng: giới hạn dung lượng sớm, ghi ra đĩa theo từng đoạn thay vì đọc cả file vào bộ nhớ
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+from typing import BinaryIO, List, Optional, Pattern, Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+MB = 1024 * 1024
+
+MAX_DOCUMENT_UPLOAD_BYTES = int(float(os.getenv("MAX_DOCUMENT_UPLOAD_MB", "50")) * MB)
+MAX_AUDIO_UPLOAD_BYTES = int(float(os.getenv("MAX_AUDIO_UPLOAD_MB", "25")) * MB)
+# File nhỏ hơn ngưỡng này được giữ trong bộ nhớ, lớn hơn thì ghi ra file tạm
+UPLOAD_SPOOL_THRESHOLD_BYTES = int(float(os.getenv("UPLOAD_SPOOL_THRESHOLD_MB", "1")) * MB)
+
+CHUNK_SIZE = 256 * 1024
+
+
+class UploadTooLarge(ValueError):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"File vượt quá giới hạn {max_bytes // MB} MB")
+        self.max_bytes = max_bytes
+
+
+async def save_upload(upload: UploadFile, dest_path: str, max_bytes: int,
+                      magic: Optional[bytes] = None) -> Tuple[int, str]:
+    """Ghi file upload ra dest_path theo từng đoạn, tính SHA-256 trong lúc ghi.
+
+    Trả về (số byte, sha256). Dừng ngay khi vượt max_bytes hoặc phần đầu file không khớp magic;
+    file ghi dở luôn bị xóa khi lỗi.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    # Ghi vào file tạm rồi rename để worker không bao giờ thấy file ghi dở
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await upload.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0 and magic and not chunk.startswith(magic):
+                    raise ValueError("Nội dung file không đúng định dạng")
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                digest.update(chunk)
+                await run_in_threadpool(out.write, chunk)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return size, digest.hexdigest()
+
+
+def spooled_upload_size(upload: UploadFile) -> int:
+    """Kích thước file upload (Starlette đã spool ra đĩa khi lớn) mà không đọc vào bộ nhớ"""
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    return size
+
+
+def decode_base64_to_file(data: str, max_bytes: int) -> BinaryIO:
+    """Giải mã base64 theo từng đoạn vào file tạm (giữ trong bộ nhớ tới UPLOAD_SPOOL_THRESHOLD_MB)"""
+    # Chấp nhận cả data URL ("data:audio/webm;base64,...")
+    if data.startswith("data:"):
+        data = data.partition(",")[2]
+    # Base64 bọc dòng kiểu MIME (xuống dòng mỗi 76 ký tự) hoặc có khoảng trắng: bỏ hết trước khi
+    # chia đoạn, nếu không ranh giới 4 ký tự bị lệch và validate=True sẽ từ chối dữ liệu hợp lệ
+    data = "".join(data.split())
+    if len(data) // 4 * 3 > max_bytes + 3:
+        raise UploadTooLarge(max_bytes)
+
+    out = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD_BYTES)
+    try:
+        # Độ dài mỗi đoạn là bội số của 4 để giải mã độc lập được
+        step = CHUNK_SIZE // 4 * 4
+        for start in range(0, len(data), step):
+            out.write(base64.b64decode(data[start:start + step], validate=True))
+        if out.tell() > max_bytes:
+            raise UploadTooLarge(max_bytes)
+    except BaseException:
+        out.close()
+        raise
+    out.seek(0)
+    return out
+
+
+class UploadSizeLimitMiddleware:
+    """ASGI middleware từ chối request upload quá lớn trước khi body được đọc/parse.
+
+    Kiểm tra Content-Length nếu có; với request không có Content-Length (chunked) thì đếm
+    số byte nhận được và dừng khi vượt giới hạn. Trả về 413.
+    """
+
+    def __init__(self, app, limits: List[Tuple[str, int]]):
+        self.app = app
+        self.limits: List[Tuple[Pattern, int]] = [(re.compile(pattern), limit) for pattern, limit in limits]
+
+    def _limit_for(self, path: str) -> Optional[int]:
+        for pattern, limit in self.limits:
+            if pattern.match(path):
+                return limit
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") not in ("POST", "PUT"):
+            return await self.app(scope, receive, send)
+        max_bytes = self._limit_for(scope["path"])
+        if max_bytes is None:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+            return await self._reject(send, max_bytes)
+
+        received = 0
+        exceeded = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    exceeded = True
+                    raise UploadTooLarge(max_bytes)
+            return message
+
+        async def limited_send(message):
+            nonlocal rejected
+            # Lỗi parse body do vượt giới hạn có thể đã được đổi thành response 400 ở tầng trong
+            if exceeded:
+                if not rejected:
+                    rejected = True
+                    await self._reject(send, max_bytes)
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except UploadTooLarge:
+            if not rejected:
+                rejected = True
+                await self._reject(send, max_bytes)
+
+    @staticmethod
+    async def _reject(send, max_bytes: int):
+        body = json.dumps(
+            {"detail": f"File vượt quá giới hạn {max_bytes // MB} MB"}, ensure_ascii=False
+        ).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
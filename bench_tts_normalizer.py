@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark bộ chuẩn hóa văn bản TTS so với cách cũ (nhiều lượt str.replace)
+
+Mỗi lần đo dùng một loạt câu trả lời khác nhau (số liệu thay đổi theo từng câu) để memo cả đoạn
+không che mất chi phí thật. "Cache trống" xóa mọi cache trước mỗi câu trả lời; "cache ấm" giữ
+cache theo cụm giữa các câu trả lời như khi server chạy lâu.
+
+Bộ mới làm nhiều việc hơn cách cũ (đọc số thành chữ, chỉ thay đơn vị khi đứng thành từ riêng), nên
+không nhanh hơn: với cache ấm thì ngang cách cũ (chênh lệch nằm trong nhiễu đo), khi cache trống thì
+chậm hơn khoảng 2 lần. Với câu trả lời của chatbot (vài nghìn ký tự) cả hai chỉ mất vài trăm µs.
+"""
+import sys
+import os
+import random
+import time
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from services import tts_text
+from services.tts_text import normalize_for_tts
+
+
+def legacy_preprocess_text(text: str) -> str:
+    """Bản sao _preprocess_text cũ trong tts.py / mms_tts.py"""
+    text = text.strip()
+    replacements = {
+        "kg": "ki-lô-gam",
+        "cm": "xen-ti-mét",
+        "mm": "mi-li-mét",
+        "km": "ki-lô-mét",
+        "°C": "độ C",
+        "%": "phần trăm",
+        "&": "và",
+        "@": "a còng",
+        "vs": "so với",
+        "AI": "A-I",
+        "API": "A-P-I",
+        "URL": "U-R-L",
+        "=": "bằng",
+        "HTTP": "H-T-T-P",
+    }
+    for old, new in replacements.items():
+        text = text.replace(old, new)
+    text = text.replace("**", "").replace("*", "").replace("_", "")
+    text = text.replace("```", "").replace("`", "")
+    text = text.replace("<", "").replace(">", "").replace("&", "và")
+    text = " ".join(text.split())
+    return text
+
+
+SAMPLE_REPLY = """
+## Kế hoạch dinh dưỡng cho bạn
+
+Với cân nặng **{weight}kg** và chiều cao {height} cm, chỉ số BMI của bạn là {bmi}.
+Mục tiêu: giảm 0.{loss} kg mỗi tuần, tương đương thâm hụt khoảng {deficit} kcal/ngày.
+
+- **Bữa sáng**: yến mạch {oats}g & sữa chua không đường, {fruit} quả chuối.
+- **Bữa trưa**: {chicken}g ức gà, rau xanh, 1 chén cơm gạo lứt.
+- **Bữa tối**: cá hồi áp chảo, salad; hạn chế tinh bột sau {hour} giờ.
+
+Hãy đi bộ nhanh {minutes} phút mỗi ngày (khoảng {distance} km) và uống đủ {water} ml nước.
+Nếu nhiệt độ cơ thể trên {temp}°C hoặc huyết áp > {systolic}/{diastolic} mmHg, hãy liên hệ bác sĩ ngay.
+Lưu ý: AI chỉ mang tính tham khảo, không thay thế tư vấn y tế = chuyên môn.
+"""
+
+
+def make_replies(count: int, seed: int = 0):
+    """Các câu trả lời cùng khuôn nhưng số liệu khác nhau"""
+    rng = random.Random(seed)
+    return [
+        SAMPLE_REPLY.format(
+            weight=rng.randint(40, 120), height=rng.randint(145, 195),
+            bmi=f"{rng.randint(17, 35)},{rng.randint(0, 9)}", loss=rng.randint(1, 9),
+            deficit=rng.randint(200, 900), oats=rng.randint(30, 80), fruit=rng.randint(1, 3),
+            chicken=rng.randint(100, 250), hour=rng.randint(18, 21), minutes=rng.randint(15, 60),
+            distance=rng.randint(1, 8), water=f"{rng.randint(1, 3)}.{rng.randint(0, 9)}00",
+            temp=rng.randint(37, 40), systolic=rng.randint(120, 160), diastolic=rng.randint(80, 100),
+        ) * 4
+        for _ in range(count)
+    ]
+
+
+def clear_caches():
+    normalize_for_tts.cache_clear()
+    tts_text._normalize_token.cache_clear()
+    tts_text._spell_number.cache_clear()
+    tts_text.read_number.cache_clear()
+
+
+def per_reply_us(fn, replies, before=None, repeat: int = 5) -> float:
+    """Thời gian trung bình (µs) cho mỗi câu trả lời, lấy lượt nhanh nhất trong repeat lượt.
+
+    before() chạy trước mỗi câu và không tính giờ.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        total = 0.0
+        for reply in replies:
+            if before:
+                before()
+            start = time.perf_counter()
+            fn(reply)
+            total += time.perf_counter() - start
+        best = min(best, total)
+    return best / len(replies) * 1e6
+
+
+def main():
+    replies = make_replies(500)
+    print(f"Input: {len(replies)} câu trả lời khác nhau, ~{len(replies[0])} ký tự mỗi câu")
+    print(f"Cũ : {legacy_preprocess_text(replies[0])[:160]}...")
+    print(f"Mới: {normalize_for_tts(replies[0])[:160]}...")
+
+    legacy = per_reply_us(legacy_preprocess_text, replies)
+    cold = per_reply_us(normalize_for_tts, replies, before=clear_caches)
+
+    def warm_up():
+        # Cache theo cụm được giữ giữa các câu trả lời; memo cả đoạn không có tác dụng vì câu nào cũng mới
+        clear_caches()
+        for reply in make_replies(200, seed=1):
+            normalize_for_tts(reply)
+
+    warm_up()
+    warm = per_reply_us(normalize_for_tts.__wrapped__, replies)
+    repeated = per_reply_us(normalize_for_tts, replies[:1] * len(replies))
+
+    print(f"Cũ (replace tuần tự)          : {legacy:8.1f} µs/câu")
+    print(f"Mới (cache trống)             : {cold:8.1f} µs/câu")
+    print(f"Mới (cache ấm, câu khác nhau) : {warm:8.1f} µs/câu")
+    print(f"Mới (lặp lại đúng một câu)    : {repeated:8.1f} µs/câu")
+
+
+if __name__ == "__main__":
+    main()
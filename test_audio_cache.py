@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test cache audio TTS (LRU trong bộ nhớ và giới hạn dung lượng trên đĩa)
+"""
+import sys
+import os
+
+import pytest
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from services.audio_cache import AudioCache, detect_mime_type
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("AUDIO_CACHE_DIR", str(tmp_path / "audio"))
+    return AudioCache()
+
+
+def _age(cache: AudioCache, key: str, mtime: float) -> None:
+    os.utime(cache._path(key), (mtime, mtime))
+
+
+def test_memory_tier_evicts_least_recently_used(cache):
+    cache.max_memory_bytes = 10
+    cache.max_disk_bytes = 0
+
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"  # a thành mới dùng nhất
+    cache.put("c", b"cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+
+
+def test_audio_larger_than_memory_limit_is_only_kept_on_disk(cache):
+    cache.max_memory_bytes = 4
+    cache.put("big", b"x" * 10)
+
+    assert "big" not in cache._memory
+    assert cache.get("big") == b"x" * 10
+
+
+def test_disk_tier_evicts_oldest_files_below_limit(cache):
+    cache.max_memory_bytes = 0
+    cache.max_disk_bytes = 100
+
+    for i, key in enumerate(["k1", "k2", "k3"]):
+        cache.put(key, b"x" * 30)
+        _age(cache, key, 1_000_000 + i)
+    cache.put("k4", b"x" * 30)  # 120 byte > 100: xóa tới khi còn <= 90
+
+    assert cache.get("k1") is None
+    assert cache.get("k2") is not None
+    assert cache.get("k4") is not None
+    remaining = sum(size for _, size, _ in cache._scan_disk())
+    assert remaining <= 90
+
+
+def test_reading_from_disk_protects_file_from_eviction(cache):
+    cache.max_memory_bytes = 0
+    cache.max_disk_bytes = 100
+
+    for i, key in enumerate(["k1", "k2", "k3"]):
+        cache.put(key, b"x" * 30)
+        _age(cache, key, 1_000_000 + i)
+    assert cache.get("k1") == b"x" * 30  # cập nhật mtime của k1
+    cache.put("k4", b"x" * 30)
+
+    assert cache.get("k1") is not None
+    assert cache.get("k2") is None
+
+
+def test_memory_only_cache_does_not_touch_disk(cache):
+    cache.max_disk_bytes = 0
+    cache.put("a", b"RIFFdata")
+    cache.clear_memory()
+
+    assert cache.get("a") is None
+    assert not os.path.exists(cache.cache_dir)
+
+
+def test_make_key_depends_on_every_parameter():
+    base = AudioCache.make_key("azure", "voice", "mp3", "xin chào")
+    assert base == AudioCache.make_key("azure", "voice", "mp3", "xin chào")
+    assert base != AudioCache.make_key("mms", "voice", "mp3", "xin chào")
+    assert base != AudioCache.make_key("azure", "voice2", "mp3", "xin chào")
+    assert base != AudioCache.make_key("azure", "voice", "wav", "xin chào")
+    assert base != AudioCache.make_key("azure", "voice", "mp3", "xin chào!")
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b"RIFF....WAVE", "audio/wav"),
+    (b"fLaC....", "audio/flac"),
+    (b"OggS....", "audio/ogg"),
+    (b"\xff\xf3....", "audio/mpeg"),
+])
+def test_detect_mime_type(data, expected):
+    assert detect_mime_type(data) == expected
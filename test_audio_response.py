@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Test trả audio theo Range/ETag (api._audio_response) và link audio có chữ ký
+"""
+import asyncio
+import time
+
+import pytest
+
+# api.py import toàn bộ các service; chỉ chạy khi môi trường đã cài đủ dependency
+for module in ("fastapi", "jose", "passlib", "langchain_core", "openai", "azure.cognitiveservices.speech"):
+    pytest.importorskip(module)
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from app import api
+
+AUDIO = bytes(range(10))
+AUDIO_ID = "a" * 64
+
+
+def _request(**headers) -> Request:
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": f"/api/audio/{AUDIO_ID}",
+        "query_string": b"",
+        "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()],
+    })
+
+
+def test_full_response_without_range():
+    response = api._audio_response(_request(), AUDIO, AUDIO_ID)
+
+    assert response.status_code == 200
+    assert response.body == AUDIO
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"] == f'"{AUDIO_ID}"'
+
+
+@pytest.mark.parametrize("range_header, start, end", [
+    ("bytes=2-5", 2, 5),
+    ("bytes=7-", 7, 9),
+    ("bytes=-3", 7, 9),
+    ("bytes=8-100", 8, 9),
+    ("bytes=-100", 0, 9),
+    ("bytes=0-0, 4-5", 0, 0),  # chỉ phục vụ khoảng đầu tiên
+])
+def test_range_returns_partial_content(range_header, start, end):
+    response = api._audio_response(_request(range=range_header), AUDIO, AUDIO_ID)
+
+    assert response.status_code == 206
+    assert response.body == AUDIO[start:end + 1]
+    assert response.headers["content-range"] == f"bytes {start}-{end}/{len(AUDIO)}"
+
+
+@pytest.mark.parametrize("range_header", ["bytes=10-", "bytes=5-2", "items=0-1", "bytes=abc"])
+def test_unsatisfiable_range_returns_416(range_header):
+    response = api._audio_response(_request(range=range_header), AUDIO, AUDIO_ID)
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(AUDIO)}"
+
+
+def test_matching_etag_returns_304():
+    response = api._audio_response(_request(if_none_match=f'"{AUDIO_ID}"'), AUDIO, AUDIO_ID)
+
+    assert response.status_code == 304
+    assert response.body == b""
+
+
+def test_audio_url_is_signed_and_expires():
+    url = api._audio_url(AUDIO_ID)
+    path, _, query = url.partition("?")
+    params = dict(part.split("=") for part in query.split("&"))
+
+    assert path == f"/api/audio/{AUDIO_ID}"
+    assert int(params["expires"]) > time.time()
+    assert params["sig"] == api._audio_signature(AUDIO_ID, int(params["expires"]))
+
+
+@pytest.mark.parametrize("expires_delta, bad_signature", [(60, True), (-1, False)])
+def test_get_audio_rejects_invalid_or_expired_links(expires_delta, bad_signature):
+    expires = int(time.time()) + expires_delta
+    sig = "0" * 64 if bad_signature else api._audio_signature(AUDIO_ID, expires)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(api.get_audio(AUDIO_ID, _request(), expires=expires, sig=sig))
+    assert error.value.status_code == 403
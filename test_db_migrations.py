@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Test migration schema SQLite (db._run_migrations / init_db)
+"""
+import sys
+import os
+import sqlite3
+
+import pytest
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from services import db
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """DB tạm với pool kết nối riêng (không chạm vào chatgpu.db)"""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(db, "_pool", db.ConnectionPool())
+    yield str(tmp_path / "test.db")
+    db.close_pool()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _columns(conn: sqlite3.Connection, table: str):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_init_db_creates_latest_schema(temp_db):
+    db.init_db(seed=False)
+
+    with db.get_conn() as conn:
+        assert db._get_schema_version(conn) == db.SCHEMA_VERSION
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        assert {"vector_outbox", "embedding_cache", "document_jobs", "document_contents"} <= tables
+        assert {"file_path", "worker_id", "heartbeat_at"} <= _columns(conn, "document_jobs")
+        assert {"content_hash", "text_hash"} <= _columns(conn, "documents")
+
+
+def test_init_db_is_idempotent(temp_db):
+    db.init_db(seed=False)
+    db.init_db(seed=False)
+
+    with db.get_conn() as conn:
+        assert db._get_schema_version(conn) == db.SCHEMA_VERSION
+
+
+def test_run_migrations_applies_only_pending_in_order(temp_db, monkeypatch):
+    applied = []
+    migrations = [
+        (v, lambda conn, v=v: applied.append(v))
+        for v in (4, 5, 6)
+    ]
+    monkeypatch.setattr(db, "MIGRATIONS", migrations)
+    monkeypatch.setattr(db, "SCHEMA_VERSION", 6)
+
+    conn = _connect(temp_db)
+    db._set_schema_version(conn, 4)
+    conn.commit()
+
+    db._run_migrations(conn)
+
+    assert applied == [5, 6]
+    assert db._get_schema_version(conn) == 6
+    assert not conn.in_transaction
+    conn.close()
+
+
+def test_run_migrations_rolls_back_all_pending_on_failure(temp_db, monkeypatch):
+    def create_table(conn):
+        conn.execute("CREATE TABLE created_by_v4 (id INTEGER)")
+
+    def fail(conn):
+        raise RuntimeError("migration failed")
+
+    monkeypatch.setattr(db, "MIGRATIONS", [(4, create_table), (5, fail)])
+    monkeypatch.setattr(db, "SCHEMA_VERSION", 5)
+
+    conn = _connect(temp_db)
+    db._set_schema_version(conn, 3)
+    conn.commit()
+
+    with pytest.raises(RuntimeError):
+        db._run_migrations(conn)
+
+    assert db._get_schema_version(conn) == 3
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert "created_by_v4" not in tables
+    conn.close()
+
+
+def test_run_migrations_skips_when_schema_is_newer(temp_db, monkeypatch):
+    applied = []
+    monkeypatch.setattr(db, "MIGRATIONS", [(4, lambda conn: applied.append(4))])
+    monkeypatch.setattr(db, "SCHEMA_VERSION", 4)
+
+    conn = _connect(temp_db)
+    db._set_schema_version(conn, 9)
+    conn.commit()
+
+    db._run_migrations(conn)
+
+    assert applied == []
+    assert db._get_schema_version(conn) == 9
+    conn.close()
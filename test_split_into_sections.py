@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Test chia văn bản dài theo token cho map-reduce tóm tắt (azure_openai.split_into_sections)
+"""
+import sys
+import os
+
+import pytest
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+pytest.importorskip("openai")
+pytest.importorskip("dotenv")
+
+from services import azure_openai as llm
+
+
+def test_short_text_is_one_section():
+    assert llm.split_into_sections("Đoạn một.\n\nĐoạn hai.", 1000) == ["Đoạn một.\nĐoạn hai."]
+
+
+def test_empty_text_has_no_sections():
+    assert llm.split_into_sections("\n\n  \n", 100) == []
+
+
+def test_sections_respect_token_limit_and_paragraph_order():
+    paragraphs = [f"Đoạn {i}: " + "kết quả xét nghiệm bình thường. " * 5 for i in range(20)]
+    paragraphs = [paragraph.strip() for paragraph in paragraphs]
+    text = "\n\n".join(paragraphs)
+    max_tokens = llm.count_tokens(paragraphs[0]) * 3
+
+    sections = llm.split_into_sections(text, max_tokens)
+
+    assert len(sections) > 1
+    assert all(llm.count_tokens(section) <= max_tokens for section in sections)
+    # Đoạn không bị cắt khi vừa giới hạn, và giữ đúng thứ tự
+    assert "\n".join(sections).split("\n") == paragraphs
+
+
+def test_long_paragraph_is_split_by_line():
+    lines = [(f"Dòng {i}: " + "chỉ số huyết áp ổn định. " * 4).strip() for i in range(10)]
+    max_tokens = llm.count_tokens(lines[0]) * 2
+
+    sections = llm.split_into_sections("\n".join(lines), max_tokens)
+
+    assert all(llm.count_tokens(section) <= max_tokens for section in sections)
+    assert "\n".join(sections).split("\n") == lines
+
+
+def test_line_longer_than_limit_is_hard_split():
+    line = ("xét nghiệm " * 400).strip()
+    max_tokens = 50
+
+    sections = llm.split_into_sections(line, max_tokens)
+
+    assert len(sections) > 1
+    assert all(llm.count_tokens(section) <= max_tokens + 1 for section in sections)
+    # Cắt cứng không làm mất hay thêm ký tự nào
+    assert "".join(section.replace("\n", "") for section in sections) == line
+
+
+def test_merge_keeps_tail_of_oversized_partial(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(llm, "SUMMARY_CHUNK_TOKENS", 100)
+    prompts = []
+
+    def fake_complete(client, system, user):
+        prompts.append(user)
+        return f"gộp {len(prompts)}"
+
+    monkeypatch.setattr(llm, "_complete", fake_complete)
+    oversized = "chỉ số bình thường " * 50 + "ĐUÔI"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        llm._merge_summaries(None, [oversized, "phần hai"], executor)
+
+    # Phần cuối của bản tóm tắt quá dài vẫn được đưa vào một lời gọi gộp
+    assert any("ĐUÔI" in prompt for prompt in prompts)
+
+
+def test_merge_stops_grouping_when_model_does_not_shorten(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(llm, "SUMMARY_CHUNK_TOKENS", 100)
+    calls = []
+
+    def fake_complete(client, system, user):
+        calls.append(user)
+        return "x" * len(user)
+
+    monkeypatch.setattr(llm, "_complete", fake_complete)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        llm._merge_summaries(None, ["y" * 2000] * 3, executor)
+
+    assert len(calls) < 100
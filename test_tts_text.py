@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Test xử lý văn bản dùng chung cho TTS (tách câu, chuẩn hóa, đọc số)
+"""
+import sys
+import os
+
+import pytest
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from services.tts_text import normalize_for_tts, read_number, split_sentences
+
+
+def test_split_sentences_merges_short_sentences():
+    assert split_sentences("Câu một. Câu hai! Câu ba?", 200) == ["Câu một. Câu hai! Câu ba?"]
+
+
+def test_split_sentences_breaks_at_sentence_boundaries():
+    assert split_sentences("Câu một. Câu hai! Câu ba?", 10) == ["Câu một.", "Câu hai!", "Câu ba?"]
+
+
+def test_split_sentences_splits_long_sentence_by_clause_then_space():
+    text = "Ăn nhiều rau xanh, uống đủ nước, ngủ đủ giấc và tập thể dục đều đặn mỗi ngày"
+    chunks = split_sentences(text, 30)
+    assert all(len(chunk) <= 30 for chunk in chunks)
+    assert " ".join(chunks) == text
+
+
+def test_split_sentences_hard_splits_words_longer_than_limit():
+    assert split_sentences("x" * 45, 20) == ["x" * 20, "x" * 20, "x" * 5]
+
+
+def test_split_sentences_keeps_all_content_and_collapses_whitespace():
+    text = "Xin chào.\n\n  Hôm nay   bạn thế nào?   Tôi khỏe."
+    assert " ".join(split_sentences(text, 15)) == "Xin chào. Hôm nay bạn thế nào? Tôi khỏe."
+
+
+def test_split_sentences_empty_text():
+    assert split_sentences("   \n ") == []
+
+
+@pytest.mark.parametrize("digits, expected", [
+    ("0", "không"),
+    ("10", "mười"),
+    ("15", "mười lăm"),
+    ("21", "hai mươi mốt"),
+    ("105", "một trăm linh năm"),
+    ("1005", "một nghìn không trăm linh năm"),
+    ("1234567", "một triệu hai trăm ba mươi bốn nghìn năm trăm sáu mươi bảy"),
+    ("2000000", "hai triệu"),
+    # Số có số 0 ở đầu hoặc quá dài được đọc từng chữ số
+    ("05", "không năm"),
+    ("1234567890123", "một hai ba bốn năm sáu bảy tám chín không một hai ba"),
+])
+def test_read_number(digits, expected):
+    assert read_number(digits) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Cân nặng 72kg", "Cân nặng bảy mươi hai ki-lô-gam"),
+    ("uống 2.000 ml", "uống hai nghìn ml"),
+    ("BMI 25,5", "BMI hai mươi lăm phẩy năm"),
+    ("nhiệt độ 38°C", "nhiệt độ ba mươi tám độ C"),
+    ("giảm 70%", "giảm bảy mươi phần trăm"),
+    ("phiên bản 1.2.3", "phiên bản một.hai.ba"),
+    ("A & B", "A và B"),
+])
+def test_normalize_reads_numbers_units_and_symbols(text, expected):
+    assert normalize_for_tts(text) == expected
+
+
+def test_normalize_replaces_units_only_as_whole_words():
+    assert normalize_for_tts("pkg kgs kg, kg.") == "pkg kgs ki-lô-gam, ki-lô-gam."
+    assert normalize_for_tts("API và APIs") == "A-P-I và APIs"
+
+
+def test_normalize_strips_markdown():
+    text = "## Kế hoạch\n- **Bữa sáng**: `yến mạch`\n+ xem [hướng dẫn](http://example.com)\n<b>hết</b>"
+    assert normalize_for_tts(text) == "Kế hoạch Bữa sáng: yến mạch xem hướng dẫn bhết/b"
+
+
+def test_normalize_strips_emphasis_underscores_but_keeps_identifiers():
+    assert normalize_for_tts("_nhấn mạnh_ và __đậm__") == "nhấn mạnh và đậm"
+    assert normalize_for_tts("file_name.py và snake_case") == "file_name.py và snake_case"
+
+
+def test_normalize_collapses_whitespace():
+    assert normalize_for_tts("  Xin   chào\n\n bạn  ") == "Xin chào bạn"
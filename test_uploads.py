@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Test giới hạn dung lượng upload (UploadSizeLimitMiddleware) và giải mã base64 theo đoạn
+"""
+import sys
+import os
+import asyncio
+import base64
+import binascii
+import json
+
+import pytest
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+pytest.importorskip("fastapi")
+
+from services import uploads
+from services.uploads import UploadSizeLimitMiddleware, UploadTooLarge, decode_base64_to_file
+
+
+# ====== decode_base64_to_file ======
+
+def test_decode_plain_and_data_url():
+    raw = os.urandom(1000)
+    encoded = base64.b64encode(raw).decode()
+
+    assert decode_base64_to_file(encoded, 2000).read() == raw
+    assert decode_base64_to_file(f"data:audio/webm;base64,{encoded}", 2000).read() == raw
+
+
+def test_decode_mime_wrapped_base64_across_chunks():
+    # Lớn hơn CHUNK_SIZE để dữ liệu được giải mã qua nhiều đoạn
+    raw = os.urandom(uploads.CHUNK_SIZE + 12345)
+    wrapped = base64.encodebytes(raw).decode().replace("\n", "\r\n")
+
+    assert decode_base64_to_file(wrapped, len(raw)).read() == raw
+
+
+def test_decode_rejects_payload_over_limit():
+    encoded = base64.b64encode(os.urandom(100)).decode()
+
+    with pytest.raises(UploadTooLarge):
+        decode_base64_to_file(encoded, 50)
+
+
+def test_decode_rejects_invalid_characters():
+    with pytest.raises(binascii.Error):
+        decode_base64_to_file("abc$def=", 100)
+
+
+# ====== UploadSizeLimitMiddleware ======
+
+async def _echo_app(scope, receive, send):
+    """App giả lập: đọc hết body rồi trả lại"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _parsing_app(scope, receive, send):
+    """Như FastAPI khi parse form lỗi: nuốt exception và trả về 400"""
+    try:
+        await _echo_app(scope, receive, send)
+    except Exception:
+        await send({"type": "http.response.start", "status": 400, "headers": []})
+        await send({"type": "http.response.body", "body": b"bad request"})
+
+
+def _call(app, chunks, path="/api/upload", method="POST", content_length=None):
+    scope = {"type": "http", "method": method, "path": path, "headers": []}
+    if content_length is not None:
+        scope["headers"].append((b"content-length", str(content_length).encode()))
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(UploadSizeLimitMiddleware(app, [(r"^/api/upload", 10)])(scope, receive, send))
+    status = sent[0]["status"]
+    body = b"".join(message.get("body", b"") for message in sent[1:])
+    return status, body
+
+
+def test_body_within_limit_passes_through():
+    assert _call(_echo_app, [b"12345", b"678"]) == (200, b"12345678")
+
+
+def test_content_length_over_limit_is_rejected_before_reading():
+    called = []
+
+    async def app(scope, receive, send):
+        called.append(True)
+
+    status, body = _call(app, [b""], content_length=11)
+
+    assert status == 413
+    assert "detail" in json.loads(body)
+    assert called == []
+
+
+def test_streamed_body_over_limit_is_rejected():
+    status, _ = _call(_echo_app, [b"123456", b"789012"])
+    assert status == 413
+
+
+def test_inner_error_response_is_replaced_by_413():
+    status, body = _call(_parsing_app, [b"123456", b"789012"])
+
+    assert status == 413
+    assert body != b"bad request"
+
+
+@pytest.mark.parametrize("path, method", [("/api/other", "POST"), ("/api/upload", "GET")])
+def test_unlimited_paths_and_methods_are_untouched(path, method):
+    assert _call(_echo_app, [b"x" * 50], path=path, method=method) == (200, b"x" * 50)